@@ -1,60 +1,102 @@
-from argparse import ArgumentParser, FileType
+from concurrent.futures import ProcessPoolExecutor
+from argparse import ArgumentParser
+from collections import Counter
 import json
 import os
 import re
 
-ap = ArgumentParser()
-ap.add_argument(
-    '--infile', 
-    required = True,
-    help = 'JSON file to be processed',
-    type = FileType('r', encoding='utf-8')
-)
-args = vars(ap.parse_args())
-# Example: python automa2txt.py --infile "Luc Van Tien/automa.json"
-
-out_dir = os.path.dirname(args['infile'].name)
-data = json.load(args['infile'])
-base_url = 'http://www.nomfoundation.org'
-# vocabs = []
-
-url_path = os.path.join(out_dir, 'url.txt')
-nom_path = os.path.join(out_dir, 'nom.txt')
-modern_path = os.path.join(out_dir, 'modern.txt')
-# vocabs_path = os.path.join(out_dir, 'vocabs.txt')
-
-with open(url_path, 'w', encoding='utf-8') as url_file, \
-     open(nom_path, 'w', encoding='utf-8') as nom_file, \
-     open(modern_path, 'w', encoding='utf-8') as modern_file: 
-     # open(vocabs_path, 'w', encoding='utf-8') as vocabs_file:
-
-    for page in data:
-        url_file.write(base_url + page['url'] + '\n')
-
-        # Remove line numbers and double new lines
-        text = re.sub(r'\n(\n|[0-9 ]+)', '\n', page['text']) 
-
-        # Remove position notes. Example: [1a*1*1]
-        text = re.sub(r'\. \[[0-9]+[ab]\*[0-9]+\*[0-9]+\]', '', text) 
-
-        # Unknown characters represented by ['[?]', '?', '-'] on the website
-        # Note: this not remove the '?' characters at the of a sentence or a quote
-        # text = re.sub(r'(\[\?\]|\?(?!\n|"))', '-', text)
-        text = text.split('\n')
-
-        for idx, sentence in enumerate(text):
-            sentence = sentence.strip()
-            if sentence in ['', '.']: continue
-
-            if idx % 2 == 0: 
-                sentence = re.sub(r'[!"#$%&()*+,.:;<=>@[\]^_`{|}~/\\\' ]', '', sentence)
-                sentence = re.sub(r'(matchu|vech0075|-)', '?', sentence)
-                nom_file.write(sentence + '\n')
-                # vocabs.extend(list(sentence))
-            else: 
-                sentence = sentence.replace('mat-chu', '[UNK]')
-                modern_file.write(sentence + '\n')
-
-    # vocabs = set(vocabs) # remove duplicates in vocabs
-    # vocabs.discard('-') # remove '-' from vocabs
-    # vocabs_file.write('\n'.join(vocabs))
+BASE_URL = 'http://www.nomfoundation.org'
+LINE_NUMBERS = re.compile(r'\n(\n|[0-9 ]+)') # Line numbers and double new lines
+POSITION_NOTES = re.compile(r'\. \[[0-9]+[ab]\*[0-9]+\*[0-9]+\]') # Example: [1a*1*1]
+
+# Punctuations removed from the Nom sentences, and '-' (an unknown character on the website) => '?'
+NOM_TABLE = str.maketrans({**dict.fromkeys('!"#$%&()*+,.:;<=>@[]^_`{|}~/\\\' '), '-': '?'})
+NOM_UNKNOWNS = ('matchu', 'vech0075')
+
+
+def iter_pages(json_path, chunk_size=1 << 20):
+    # Stream the pages of the Automa export (a JSON array of {"text", "url"}) or of a JSON lines file,
+    # so the whole scrape is never loaded in memory
+    decoder = json.JSONDecoder()
+    with open(json_path, 'r', encoding='utf-8') as file:
+        buffer, position, is_eof = '', 0, False
+        while True:
+            # Skip the separators of the array (and the new lines of JSON lines)
+            while position < len(buffer) and buffer[position] in '[,] \t\r\n': position += 1
+            try:
+                page, end = decoder.raw_decode(buffer, position)
+                yield page
+                position = end
+                continue
+            except ValueError as error:
+                if is_eof:
+                    if position >= len(buffer): return
+                    raise error
+
+            chunk = file.read(chunk_size) # The page is incomplete => read more
+            buffer, position, is_eof = buffer[position:] + chunk, 0, len(chunk) == 0
+
+
+def clean_nom(sentence):
+    sentence = sentence.translate(NOM_TABLE)
+    for unknown in NOM_UNKNOWNS: sentence = sentence.replace(unknown, '?')
+    return sentence
+
+
+def extract_book(json_path):
+    # One pass over the pages of a book => url.txt, nom.txt, modern.txt & vocabs.txt (Nom characters
+    # frequencies) next to its JSON file
+    out_dir = os.path.dirname(json_path)
+    vocabs = Counter()
+    num_pages, num_nom, num_modern = 0, 0, 0
+
+    with open(os.path.join(out_dir, 'url.txt'), 'w', encoding='utf-8') as url_file, \
+         open(os.path.join(out_dir, 'nom.txt'), 'w', encoding='utf-8') as nom_file, \
+         open(os.path.join(out_dir, 'modern.txt'), 'w', encoding='utf-8') as modern_file:
+
+        for page in iter_pages(json_path):
+            url_file.write(BASE_URL + page['url'] + '\n')
+            num_pages += 1
+
+            text = LINE_NUMBERS.sub('\n', page['text'])
+            text = POSITION_NOTES.sub('', text)
+            nom_lines, modern_lines = [], []
+
+            for idx, sentence in enumerate(text.split('\n')):
+                sentence = sentence.strip()
+                if sentence in ['', '.']: continue
+
+                if idx % 2 == 0:
+                    sentence = clean_nom(sentence)
+                    nom_lines.append(sentence + '\n')
+                    vocabs.update(sentence)
+                else:
+                    modern_lines.append(sentence.replace('mat-chu', '[UNK]') + '\n')
+
+            nom_file.writelines(nom_lines)
+            modern_file.writelines(modern_lines)
+            num_nom, num_modern = num_nom + len(nom_lines), num_modern + len(modern_lines)
+
+    vocabs.pop('?', None) # Unknown characters
+    with open(os.path.join(out_dir, 'vocabs.txt'), 'w', encoding='utf-8') as vocabs_file:
+        vocabs_file.writelines(f'{char}\t{count}\n' for char, count in vocabs.most_common())
+    return {'book': out_dir, 'pages': num_pages, 'nom': num_nom, 'modern': num_modern, 'vocabs': len(vocabs)}
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument(
+        '--infile',
+        required = True,
+        nargs = '+',
+        help = 'JSON file(s) to be processed (the Automa export of each book, or JSON lines)',
+    )
+    ap.add_argument('--workers', type=int, default=None, help='Number of processes (default: number of CPUs)')
+    args = vars(ap.parse_args())
+    # Example: python automa2txt.py --infile "Luc Van Tien/automa.json" "Tale of Kieu 1866/automa.json"
+
+    with ProcessPoolExecutor(min(args['workers'] or os.cpu_count(), len(args['infile']))) as executor:
+        for stats in executor.map(extract_book, args['infile']):
+            print(stats)
+            if stats['nom'] != stats['modern']:
+                print(f"=> Warning: {stats['nom']} Nom sentences but {stats['modern']} modern ones in {stats['book']}")
@@ -0,0 +1,258 @@
+'''
+Parallel runner of the auto annotation: convert the PPOCR bboxes detected on the rotated images back to 0 degree
+- The .cach lines are streamed and grouped by page (the +90 & -90 entries of a page if direction == 'both')
+- Chunks of pages are processed by a pool of processes, with a bounded number of chunks in flight
+- The results are written in the input order and `{output}.ckpt` keeps the progress (number of pages done
+and output offset), so an interrupted run restarts where it stopped. The checkpoint of another run (other
+input or options) is refused
+- annotate_images skips the rotated copies of the images: the pages are rotated in memory for the detector
+'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bbox_handler import BoundingBoxHandler
+from label_io import iter_labels, format_line
+from collections import deque
+import itertools
+import hashlib
+import json
+import time
+import cv2
+import os
+
+
+def read_cache(cache_path):
+    return iter_labels(cache_path) # JSON (PPOCRLabel) or Python literals (older outputs)
+
+
+def group_pages(items, direction):
+    group_size = 2 if direction == 'both' else 1
+    while True:
+        group = list(itertools.islice(items, group_size))
+        if len(group) == 0: return
+        if len(group) < group_size: raise Exception('Number of images to rotate must be even')
+        yield group
+
+
+def chunk_pages(groups, chunk_size, start_idx=0):
+    # (index of the first image, groups of pages) for each chunk
+    image_idx = start_idx
+    while True:
+        chunk = list(itertools.islice(groups, chunk_size))
+        if len(chunk) == 0: return
+        yield image_idx, chunk
+        image_idx += sum(map(len, chunk))
+
+
+def rotate_bboxes_to_0deg(image_idx, file_path, bboxes, direction, images_dir):
+    angle = int(os.path.splitext(file_path)[0][-3:])
+    if direction == 'both':
+        if (image_idx % 2 == 0 and angle != 90) or \
+            (image_idx % 2 == 1 and angle != -90):
+            raise Exception('''
+                \nImage must have the following format:
+                \n- "+90" postfix in name for even index
+                \n- "-90" postfix in name for odd index
+            ''')
+    elif int(direction) != angle:
+        raise Exception('Image not meet current right angle direction')
+
+    # The image size is read once per page (from its header) to rotate all of its bboxes together
+    return unrotate_bboxes(bboxes, angle, image_path=os.path.join(images_dir, os.path.basename(file_path)))
+
+
+def unrotate_bboxes(bboxes, angle, image_path=None, image_size=None):
+    # Bboxes detected on a page rotated by `angle` => rectangles on the page at 0 degree
+    bboxes = BoundingBoxHandler.RotatePageBoxes(image_path, bboxes, -angle, image_size)
+    rectangles = BoundingBoxHandler.RectanglesTransform([bbox['points'] for bbox in bboxes])
+    for bbox, points in zip(bboxes, rectangles.tolist()): bbox['points'] = points
+    return bboxes
+
+
+def merge_pages(final_paths, pages_bboxes, options):
+    # Filter (and merge the +90 & -90 bboxes of) each page => lines of the output .cach
+    if options['max_woh'] is not None:
+        pages_bboxes = [
+            BoundingBoxHandler.WidthOverHeightFilter(bboxes, max_ratio=options['max_woh'])
+            for bboxes in pages_bboxes
+        ]
+    if options['direction'] == 'both': # Suppress the overlapping bounding boxes of the chunk in one batch
+        pages_bboxes = BoundingBoxHandler.BatchNonMaximumSuppression(
+            pages_bboxes,
+            threshold = options['overlap'],
+            soft = options['soft_nms'],
+            use_polygon = options['polygon_nms'],
+        )
+    return [format_line(final_path, bboxes) for final_path, bboxes in zip(final_paths, pages_bboxes)]
+
+
+def convert_chunk(chunk, options):
+    image_idx, groups = chunk
+    final_paths, pages_bboxes = [], []
+    for group in groups:
+        page_bboxes = []
+        for file_path, bboxes in group:
+            page_bboxes += rotate_bboxes_to_0deg(image_idx, file_path, bboxes, options['direction'], options['images_dir'])
+            image_idx += 1
+
+        direction = '+90' if options['direction'] == 'both' else options['direction']
+        final_paths.append(group[0][0].replace(direction, '').replace(' - Rotate', ''))
+        pages_bboxes.append(page_bboxes)
+    return merge_pages(final_paths, pages_bboxes, options)
+
+
+class CacheWriter:
+    # Write the lines of the output .cach in order, with `{output}.ckpt` keeping the progress (number
+    # of pages done and output offset) after each write, so an interrupted run can restart from there.
+    # The checkpoint records what it belongs to (output path & `job`: input and options), the checkpoint
+    # of another run is refused instead of skipping the wrong pages
+    def __init__(self, output_path, resume=True, total=None, job=None):
+        self.ckpt_path = f'{output_path}.ckpt'
+        self.fingerprint = hashlib.sha1(
+            json.dumps([os.path.abspath(output_path), job], ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+        self.num_done, offset = 0, 0
+        if resume and os.path.exists(self.ckpt_path):
+            with open(self.ckpt_path, 'r') as ckpt_file:
+                try: ckpt = json.load(ckpt_file)
+                except ValueError: ckpt = {} # Written by an older version
+            if ckpt.get('fingerprint') != self.fingerprint:
+                raise ValueError(
+                    f'{self.ckpt_path} belongs to another run (input or options), '
+                    'delete it or use resume=False to start over'
+                )
+            if os.path.exists(output_path) and os.path.getsize(output_path) >= ckpt['offset']:
+                self.num_done, offset = ckpt['num_done'], ckpt['offset']
+                print('Resume after', self.num_done, 'pages')
+            else: print(f'{output_path} is missing or shorter than its checkpoint, start over')
+
+        self.file = open(output_path, 'r+b' if self.num_done else 'w+b')
+        self.file.seek(offset)
+        self.file.truncate() # Drop the lines written after the last checkpoint
+        self.start_time, self.num_new, self.total = time.perf_counter(), 0, total
+
+
+    def written_paths(self):
+        # Image paths of the lines already in the output (before any write)
+        self.file.seek(0)
+        return [line.split(b'\t', 1)[0].decode('utf-8') for line in self.file.read().splitlines()]
+
+
+    def write(self, lines):
+        self.file.write(''.join(lines).encode('utf-8'))
+        self.file.flush()
+        self.num_done, self.num_new = self.num_done + len(lines), self.num_new + len(lines)
+
+        with open(f'{self.ckpt_path}.tmp', 'w') as ckpt_file:
+            json.dump({'fingerprint': self.fingerprint, 'num_done': self.num_done, 'offset': self.file.tell()}, ckpt_file)
+        os.replace(f'{self.ckpt_path}.tmp', self.ckpt_path)
+        pages_per_second = self.num_new / (time.perf_counter() - self.start_time)
+        print(f'=> {self.num_done}{f"/{self.total}" if self.total else ""} pages done ({pages_per_second:.1f} pages/s)')
+
+
+    def close(self):
+        self.file.close()
+        if os.path.exists(self.ckpt_path): os.remove(self.ckpt_path) # The run is finished
+
+
+def run_pages(chunks, worker, worker_args, writer, workers=None):
+    # Submit the chunks to the pool (at most 2 per worker in flight, so the input is streamed) 
+    # and write their lines in order
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(worker, chunk, *worker_args))
+            if len(pending) >= 2 * workers: writer.write(pending.popleft().result())
+        while pending: writer.write(pending.popleft().result())
+    writer.close()
+    return writer.num_done
+
+
+def convert_cache(
+    input_path, output_path, direction, max_woh=None, overlap=None, soft_nms=None, polygon_nms=False,
+    images_dir=None, workers=None, chunk_size=16, resume=True
+):
+    options = {
+        'direction': direction, 'max_woh': max_woh, 'overlap': overlap, 'soft_nms': soft_nms,
+        'polygon_nms': polygon_nms, 'images_dir': images_dir or os.path.dirname(input_path),
+    }
+    input_stat = os.stat(input_path) # The pages are skipped by position: same input file required to resume
+    job = {'input': [os.path.abspath(input_path), input_stat.st_size, input_stat.st_mtime_ns], **options}
+    writer = CacheWriter(output_path, resume, job={**job, 'images_dir': os.path.abspath(options['images_dir'])})
+
+    # Skip the pages already written, the images indexes continue from there
+    groups = itertools.islice(group_pages(read_cache(input_path), direction), writer.num_done, None)
+    start_idx = writer.num_done * (2 if direction == 'both' else 1)
+    return run_pages(chunk_pages(groups, chunk_size, start_idx), convert_chunk, (options,), writer, workers)
+
+
+def paddle_detector(**kwargs):
+    # Text detection only with PaddleOCR (like the auto annotation of PPOCRLabel): images => bboxes.
+    # PaddleOCR's detector takes one image per call, so the images of a batch are still detected one by one:
+    # the batches only let the decoding & rotation of the next pages overlap the detection (see annotate_images)
+    from paddleocr import PaddleOCR
+    ocr = PaddleOCR(rec=False, show_log=False, **kwargs)
+
+    def detect(images):
+        pages_bboxes = []
+        for image in images:
+            boxes = ocr.ocr(image, rec=False, cls=False)[0] or []
+            pages_bboxes.append([
+                {'transcription': 'TEMPORARY', 'points': [list(map(float, point)) for point in box], 'difficult': False}
+                for box in boxes
+            ])
+        return pages_bboxes
+    return detect
+
+
+def annotate_images(
+    images_dir, output_path, detect, direction='both', max_woh=None, overlap=None, soft_nms=None, 
+    polygon_nms=False, batch_size=8, workers=None, resume=True
+):
+    ''' Rotation-free auto annotation: the pages are rotated in memory and fed to `detect` (a function of
+    a list of images returning their bboxes) by batches, then their bboxes are rotated back & merged in 
+    the same process. Only the final .cach is written, no rotated copy of the images. A detector running
+    whole batches gets them as is, paddle_detector loops over their images.
+    '''
+    options = {
+        'direction': direction, 'max_woh': max_woh, 'overlap': overlap,
+        'soft_nms': soft_nms, 'polygon_nms': polygon_nms,
+    }
+    rotations = {'+90': cv2.ROTATE_90_COUNTERCLOCKWISE, '-90': cv2.ROTATE_90_CLOCKWISE}
+    angles = ['+90', '-90'] if direction == 'both' else [direction]
+    file_names = sorted(
+        name for name in os.listdir(images_dir) if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png')
+    )
+    book_name = os.path.basename(os.path.normpath(images_dir))
+    job = {'images_dir': os.path.abspath(images_dir), **options}
+    writer = CacheWriter(output_path, resume, total=len(file_names), job=job)
+
+    def load_page(file_name):
+        image = cv2.imread(os.path.join(images_dir, file_name))
+        return [cv2.rotate(image, rotations[angle]) for angle in angles]
+
+    # Resumed by file name: the images added to the folder since are annotated (after the others), the removed
+    # ones are just not there anymore
+    done_names = {path.rsplit('/', 1)[-1] for path in writer.written_paths()}
+    remaining = [file_name for file_name in file_names if file_name not in done_names]
+
+    # OpenCV releases the GIL, so the next batch is decoded & rotated by threads during the detection
+    batches = [remaining[start:start + batch_size] for start in range(0, len(remaining), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        next_pages = [executor.submit(load_page, file_name) for file_name in batches[0]] if batches else []
+        for batch_idx, batch_names in enumerate(batches):
+            pages_images = [future.result() for future in next_pages]
+            if batch_idx + 1 < len(batches):
+                next_pages = [executor.submit(load_page, file_name) for file_name in batches[batch_idx + 1]]
+
+            detections = iter(detect([image for images in pages_images for image in images]))
+            pages_bboxes = [
+                [
+                    bbox for angle, image in zip(angles, images)
+                    for bbox in unrotate_bboxes(next(detections), int(angle), image_size=image.shape[:2])
+                ]
+                for images in pages_images
+            ]
+            final_paths = [f'{book_name}/{file_name}' for file_name in batch_names]
+            writer.write(merge_pages(final_paths, pages_bboxes, options))
+    writer.close()
+    return writer.num_done
@@ -0,0 +1,75 @@
+from argparse import ArgumentParser
+from annotation_runner import annotate_images, paddle_detector
+import sys
+import os
+
+ap = ArgumentParser()
+ap.add_argument('-i', '--input_dir', required=True, help='Path to images directory (not rotated)')
+ap.add_argument('-o', '--output', required=True, help='File name of the final .cach')
+ap.add_argument(
+    '-d',
+    '--direction',
+    required = False,
+    default = 'both',
+    choices = ['+90', '-90', 'both'],
+    help = 'Right angle direction to rotate the images before the detection'
+)
+ap.add_argument(
+    '--max_woh',
+    required = 'both' in sys.argv[-1],
+    type = float,
+    help = '(Required if direction == "both") Maximum ratio width over height to filter'
+)
+ap.add_argument(
+    '--overlap',
+    required = 'both' in sys.argv[-1],
+    type = float,
+    help = '(Required if direction == "both") Overlap threshold to suppress'
+)
+ap.add_argument(
+    '--soft_nms',
+    choices = ['linear', 'gaussian'],
+    help = 'Decay the scores of the overlapping bboxes instead of suppressing them'
+)
+ap.add_argument(
+    '--polygon_nms',
+    action = 'store_true',
+    help = 'Compute the overlaps on the rotated quadrangles instead of their corners'
+)
+ap.add_argument('--det_model_dir', default=None, help='PaddleOCR detection model (default: PaddleOCR one)')
+ap.add_argument('--use_gpu', action='store_true', help='Run the detection on GPU')
+ap.add_argument('--batch_size', type=int, default=8, help='Number of pages per detection batch')
+ap.add_argument('--workers', type=int, default=None, help='Number of threads to read & rotate the images')
+ap.add_argument('--no_resume', action='store_true', help='Start again instead of resuming from the checkpoint')
+args = vars(ap.parse_args())
+
+'''Example (same as rotated_generator.py + PPOCRLabel auto annotation + unrotated_convertor.py, 
+without writing the rotated images):
+python auto_annotator.py \
+    -i "Datasets/Tale of Kieu version 1871" \
+    -o "Datasets/Tale of Kieu version 1871/Cache.cach" \
+    -d "both" \
+    --max_woh 0.25 \
+    --overlap 0.5
+'''
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+input_dir = os.path.join(script_dir, args['input_dir'])
+output_path = os.path.join(script_dir, args['output'])
+
+detector_kwargs = {'use_gpu': args['use_gpu']}
+if args['det_model_dir']: detector_kwargs['det_model_dir'] = args['det_model_dir']
+
+annotate_images(
+    input_dir,
+    output_path,
+    paddle_detector(**detector_kwargs),
+    direction = args['direction'],
+    max_woh = args['max_woh'],
+    overlap = args['overlap'],
+    soft_nms = args['soft_nms'],
+    polygon_nms = args['polygon_nms'],
+    batch_size = args['batch_size'],
+    workers = args['workers'],
+    resume = not args['no_resume'],
+)
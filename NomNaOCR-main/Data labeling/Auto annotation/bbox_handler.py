@@ -1,8 +1,6 @@
-from scipy.spatial import distance
-from functools import reduce
+from label_io import order_points_clockwise
 import numpy as np
-import operator
-import math
+import struct
 import cv2
 
 
@@ -10,142 +8,255 @@ class BoundingBoxHandler:
     # https://stackoverflow.com/questions/51074984/sorting-according-to-clockwise-point-coordinates
     @staticmethod
     def BlhsingOrderPoints(points):
-        center = tuple(map(
-            operator.truediv,
-            reduce(lambda x, y: map(operator.add, x, y), points),
-            [len(points)] * 2
-        ))
-        sorted_points = sorted(points, key=lambda point: (
-            -45 - math.degrees(math.atan2(*tuple(
-                map(operator.sub, point, center)
-            )))) % 360)
-        return np.array(sorted_points, dtype='float32')
+        return BoundingBoxHandler.OrderPoints(points)
 
     # https://pyimagesearch.com/2016/03/21/ordering-coordinates-clockwise-with-python-and-opencv
-    @staticmethod # This function fails to sort this box [[67,432],[173,388],[177,442],[74,495]]
+    @staticmethod # The x-sorting of this method failed on boxes like [[67,432],[173,388],[177,442],[74,495]]
     def AdrianOrderPoints(points): 
-        # Sort the points based on their x-coordinates
-        xSorted = points[np.argsort(points[:, 0]), :]
-        # Grab the left-most and right-most points from the sorted x-roodinate points
-        leftMost, rightMost = xSorted[:2, :], xSorted[2:, :]
-        # Now, sort the left-most coordinates according to their y-coordinates 
-        # so we can grab the top-left and bottom-left points, respectively
-        leftMost = leftMost[np.argsort(leftMost[:, 1]), :]
-        (tl, bl) = leftMost
-        # Use the top-left coordinate as an anchor to calculate the Euclidean distance
-        # between the top-left and right-most points; by the Pythagorean theorem, 
-        # the point with the largest distance will be our bottom-right point
-        D = distance.cdist(tl[np.newaxis], rightMost, 'euclidean')[0]
-        (br, tr) = rightMost[np.argsort(D)[::-1], :]
-        # Return the coordinates in top-left, top-right, bottom-right, and bottom-left order
-        return np.array([tl, tr, br, bl], dtype='float32')
+        return BoundingBoxHandler.OrderPoints(points)
+
+    @staticmethod
+    def OrderPoints(points):
+        # (N, 4, 2) or (4, 2) points => top-left, top-right, bottom-right, bottom-left for all boxes at once
+        return order_points_clockwise(points)
 
     # https://pyimagesearch.com/2014/08/25/4-point-opencv-getperspective-transform-example
     @staticmethod
     def RectangleTransform(points):
-        quadrangle = BoundingBoxHandler.AdrianOrderPoints(np.array(points))
-        (tl, tr, br, bl) = quadrangle
-        # compute the width of the new image, which will be the
-        # maximum distance between bottom-right and bottom-left
-        # x-coordiates or the top-right and top-left x-coordinates
-        widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-        widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-        maxWidth = max(int(widthA), int(widthB)) + tl[0] - 1
-        # compute the height of the new image, which will be the
-        # maximum distance between the top-right and bottom-right
-        # y-coordinates or the top-left and bottom-left y-coordinates
-        heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-        heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-        maxHeight = max(int(heightA), int(heightB)) + tl[1] - 1
-        # now that we have the dimensions of the new image, construct
-        # the set of destination points to obtain a "birds eye view",
-        # (i.e. top-down view) of the image, again specifying points
-        # in the top-left, top-right, bottom-right, and bottom-left order
-        dst = np.array([
-            [tl[0], tl[1]], 
-            [maxWidth, tl[1]], 
-            [maxWidth, maxHeight], 
-            [tl[0], maxHeight]
-        ], dtype='float32')
-        # compute the perspective transform matrix and then apply it
-        M = cv2.getPerspectiveTransform(quadrangle, dst)
-        transformed = cv2.perspectiveTransform(np.array([quadrangle]), M)
-        return transformed[0].tolist()
+        return BoundingBoxHandler.RectanglesTransform([points])[0].tolist()
+
+    @staticmethod
+    def RectanglesTransform(bboxes_points):
+        # Vectorized RectangleTransform of (N, 4, 2) points => (N, 4, 2) "birds eye view" rectangles
+        points = np.asarray(bboxes_points, dtype='float32').reshape(-1, 4, 2)
+        tl, tr, br, bl = BoundingBoxHandler.OrderPoints(points).transpose(1, 0, 2)
+
+        # The perspective transform maps the quadrangle exactly onto these destination points, so 
+        # they are returned directly instead of computing & applying a matrix for each bounding box
+        length = lambda a, b: np.sqrt(((a[:, 0] - b[:, 0]) ** 2) + ((a[:, 1] - b[:, 1]) ** 2)).astype(int)
+        width = np.maximum(length(br, bl), length(tr, tl))
+        height = np.maximum(length(tr, br), length(tl, bl))
+        max_x = (width + tl[:, 0] - 1).astype('float32')
+        max_y = (height + tl[:, 1] - 1).astype('float32')
+        return np.stack([
+            np.stack([tl[:, 0], tl[:, 1]], axis=1), 
+            np.stack([max_x, tl[:, 1]], axis=1), 
+            np.stack([max_x, max_y], axis=1), 
+            np.stack([tl[:, 0], max_y], axis=1)
+        ], axis=1)
+
+    @staticmethod
+    def ReadImageSize(file_name):
+        # (height, width) from the PNG / JPEG header without decoding the pixels (decoded if not parsed), as
+        # cv2.imread gives it: swapped for the JPEG photos whose EXIF orientation transposes them
+        with open(file_name, 'rb') as file:
+            header = file.read(24)
+            if header.startswith(b'\x89PNG\r\n\x1a\n'): # IHDR chunk
+                width, height = struct.unpack('>II', header[16:24])
+                return height, width
+
+            if header.startswith(b'\xff\xd8'): # Walk the JPEG segments until the Start Of Frame
+                file.seek(2)
+                orientation = None
+                while True:
+                    byte = file.read(1)
+                    while byte and byte != b'\xff': byte = file.read(1)
+                    while byte == b'\xff': byte = file.read(1)
+                    if not byte: break
+                    marker = byte[0]
+                    if marker == 0x01 or 0xD0 <= marker <= 0xD9: continue # No length
+                    length = struct.unpack('>H', file.read(2))[0]
+                    if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack('>xHH', file.read(5))
+                        return (width, height) if orientation in (5, 6, 7, 8) else (height, width)
+                    if marker == 0xE1 and orientation is None: # APP1: Exif (or XMP)
+                        orientation = BoundingBoxHandler.ExifOrientation(file.read(length - 2))
+                        continue
+                    file.seek(length - 2, 1)
+        return cv2.imread(file_name).shape[:2]
+
+    @staticmethod
+    def ExifOrientation(segment):
+        # Orientation tag (1 to 8) in the IFD0 of an APP1 segment, None if it is not Exif or has no such tag
+        if not segment.startswith(b'Exif\x00\x00') or len(segment) < 14: return None
+        tiff = segment[6:]
+        endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+        if endian is None: return None
+        ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+        if ifd + 2 > len(tiff): return None
+        num_entries = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+        for entry in range(ifd + 2, min(ifd + 2 + 12 * num_entries, len(tiff) - 11), 12):
+            tag, value_type = struct.unpack(endian + 'HH', tiff[entry:entry + 4])
+            if tag == 0x0112 and value_type == 3: # SHORT
+                return struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])[0]
+        return None
 
     # https://cristianpb.github.io/blog/image-rotation-opencv
     @staticmethod
-    def RotateOneBox(file_name, bbox, angle):
-        image = cv2.imread(file_name)
-        height, width = image.shape[:2]
+    def RotationMatrix(height, width, angle):
         center_x, center_y = width / 2, height / 2
+        # OpenCV calculates standard transformation matrix
+        M = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
+        # Grab the rotation components of the matrix)
+        cos, sin = np.abs(M[0, 0]), np.abs(M[0, 1])
+        # Compute the new bounding dimensions of the image
+        new_width = (height * sin) + (width * cos)
+        new_height = (height * cos) + (width * sin)
+        # Adjust the rotation matrix to take into account translation
+        M[0, 2] += (new_width / 2) - center_x
+        M[1, 2] += (new_height / 2) - center_y
+        return M
+
+    @staticmethod
+    def RotateOneBox(file_name, bbox, angle):
+        return BoundingBoxHandler.RotatePageBoxes(file_name, [bbox], angle)[0]
+
+    @staticmethod
+    def RotatePageBoxes(file_name, bboxes, angle, image_size=None):
+        # Rotate all bounding boxes of a page: its size is read once and all their points are
+        # transformed with a single (N * 4, 3) @ M.T product
+        if len(bboxes) == 0: return bboxes
+        height, width = image_size or BoundingBoxHandler.ReadImageSize(file_name)
+        M = BoundingBoxHandler.RotationMatrix(height, width, angle)
+        points = np.array([bbox['points'] for bbox in bboxes], dtype='float64').reshape(-1, 2)
+        rotated = (np.hstack([points, np.ones((len(points), 1))]) @ M.T).reshape(len(bboxes), -1, 2)
+
+        for bbox, bbox_points in zip(bboxes, rotated.tolist()):
+            bbox['points'] = [tuple(point) for point in bbox_points]
+        return bboxes
+
+    @staticmethod
+    def AxisAlignedBoxes(points, use_corners=True):
+        # (..., 4, 2) points => (..., 4) [x1, y1, x2, y2] boxes. By default the top-left and bottom-right
+        # corners are used (like NonMaximumSuppression always did), else the extremes of the 4 points
+        points = np.asarray(points, dtype='float64')
+        if use_corners: return np.concatenate([points[..., 0, :], points[..., 2, :]], axis=-1)
+        return np.concatenate([points.min(axis=-2), points.max(axis=-2)], axis=-1)
+
+    @staticmethod
+    def BoxesOverlap(boxes_a, boxes_b, iou=False):
+        # Broadcasted overlap of [x1, y1, x2, y2] boxes: intersection over the area of boxes_b, or IoU
+        w = np.maximum(0, np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(boxes_a[..., 0], boxes_b[..., 0]) + 1)
+        h = np.maximum(0, np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(boxes_a[..., 1], boxes_b[..., 1]) + 1)
+        intersection = w * h
+        area_b = (boxes_b[..., 2] - boxes_b[..., 0] + 1) * (boxes_b[..., 3] - boxes_b[..., 1] + 1)
+        if not iou: return intersection / area_b
+        area_a = (boxes_a[..., 2] - boxes_a[..., 0] + 1) * (boxes_a[..., 3] - boxes_a[..., 1] + 1)
+        return intersection / (area_a + area_b - intersection)
+
+    @staticmethod
+    def PairwiseOverlap(boxes_a, boxes_b, iou=False, chunk_size=1024):
+        # (len(boxes_a), len(boxes_b)) overlap matrix, computed by chunks of rows to bound the memory
+        boxes_a = np.asarray(boxes_a, dtype='float64').reshape(-1, 4)
+        boxes_b = np.asarray(boxes_b, dtype='float64').reshape(-1, 4)
+        overlaps = np.empty((len(boxes_a), len(boxes_b)))
+        for start in range(0, len(boxes_a), chunk_size):
+            chunk = boxes_a[start:start + chunk_size, np.newaxis, :]
+            overlaps[start:start + chunk_size] = BoundingBoxHandler.BoxesOverlap(chunk, boxes_b[np.newaxis], iou)
+        return overlaps
+
+    @staticmethod
+    def PolygonAreas(polygons):
+        # Shoelace formula over the last 2 axes: (..., num_points, 2) => (...)
+        polygons = np.asarray(polygons, dtype='float64')
+        x, y = polygons[..., 0], polygons[..., 1]
+        return np.abs(np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)) / 2
+
+    @staticmethod
+    def PolygonOverlap(polygon, polygons, iou=False):
+        # Same as BoxesOverlap with the true areas of (rotated) convex quadrangles, for 1 polygon vs many
+        polygon, polygons = np.float32(polygon), np.float32(polygons)
+        overlaps = np.zeros(len(polygons))
+        areas = BoundingBoxHandler.PolygonAreas(polygons)
+        area = BoundingBoxHandler.PolygonAreas(polygon)
 
-        for idx, point in enumerate(bbox['points']):
-            # OpenCV calculates standard transformation matrix
-            M = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
-            # Grab the rotation components of the matrix)
-            cos, sin = np.abs(M[0, 0]), np.abs(M[0, 1])
-            # Compute the new bounding dimensions of the image
-            new_width = (height * sin) + (width * cos)
-            new_height = (height * cos) + (width * sin)
-            # Adjust the rotation matrix to take into account translation
-            M[0, 2] += (new_width / 2) - center_x
-            M[1, 2] += (new_height / 2) - center_y
-            # Perform the actual rotation and return the image
-            calculated = M @ [point[0], point[1], 1]
-            bbox['points'][idx] = (calculated[0], calculated[1])
-        return bbox
+        # Only the polygons whose extremes intersect the ones of `polygon` can overlap it
+        extremes = BoundingBoxHandler.AxisAlignedBoxes(polygons, use_corners=False)
+        extreme = BoundingBoxHandler.AxisAlignedBoxes(polygon, use_corners=False)
+        candidates = np.where(
+            (extremes[:, 0] <= extreme[2]) & (extremes[:, 2] >= extreme[0]) &
+            (extremes[:, 1] <= extreme[3]) & (extremes[:, 3] >= extreme[1])
+        )[0]
+
+        for idx in candidates:
+            intersection, _ = cv2.intersectConvexConvex(polygon, polygons[idx])
+            denominator = area + areas[idx] - intersection if iou else areas[idx]
+            if denominator > 0: overlaps[idx] = intersection / denominator
+        return overlaps
 
     # https://pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python
     @staticmethod
-    def NonMaximumSuppression(bboxes, threshold):
-        if len(bboxes) == 0: return []
-        points_in_bboxes = np.array([bbox['points'] for bbox in bboxes])
-        pick_idxs = []  # Initialize the list of picked indexes
-        pick_bboxes = [] 
-
-        x1 = points_in_bboxes[:, 0, 0] # x coordinate of the top-left corner
-        y1 = points_in_bboxes[:, 0, 1] # y coordinate of the top-left corner
-        x2 = points_in_bboxes[:, 2, 0] # x coordinate of the bottom-right corner
-        y2 = points_in_bboxes[:, 2, 1] # y coordinate of the bottom-right corner
-
-        # Compute the area of the bounding boxes and sort the bounding
-        # boxes by the bottom-right y-coordinate of the bounding box
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-        idxs = np.argsort(y2)
-
-        # Keep looping while some indexes still remain in the indexes list
-        while len(idxs) > 0:
-            # Grab the last index in the indexes list and add the
-            # index value to the list of picked indexes
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick_idxs.append(i)
-            pick_bboxes.append(bboxes[i])
-
-            # Find the largest (x, y) coordinates for the start of
-            # the bounding box and the smallest (x, y) coordinates
-            # for the end of the bounding box
-            xx1 = np.maximum(x1[i], x1[idxs[:last]])
-            yy1 = np.maximum(y1[i], y1[idxs[:last]])
-            xx2 = np.minimum(x2[i], x2[idxs[:last]])
-            yy2 = np.minimum(y2[i], y2[idxs[:last]])
-
-            # Compute the width and height of the bounding box
-            w = np.maximum(0, xx2 - xx1 + 1)
-            h = np.maximum(0, yy2 - yy1 + 1)
-
-            # Compute the ratio of overlap
-            overlap = (w * h) / area[idxs[:last]]
-
-            # Delete all indexes from the index list that have
-            idxs = np.delete(idxs, np.concatenate((
-                [last],
-                np.where(overlap > threshold)[0]
-            )))
-
-        # Return only the bounding boxes that 
-        # were picked using the integer data type
-        return pick_bboxes
+    def NonMaximumSuppression(bboxes, threshold, **kwargs):
+        return BoundingBoxHandler.BatchNonMaximumSuppression([bboxes], threshold, **kwargs)[0]
+
+    # https://arxiv.org/abs/1704.04503 (Soft-NMS)
+    @staticmethod
+    def BatchNonMaximumSuppression(
+        pages_bboxes, threshold, soft=None, sigma=0.5, min_score=1e-3, use_polygon=False, iou=False
+    ):
+        ''' Suppress the overlapping bounding boxes of all pages at once: at each step, every page picks its 
+        best remaining box and drops (or decays the score of, with soft = 'linear' / 'gaussian') the others 
+        overlapping it, so the Python loop runs max(boxes per page) times instead of once per box.
+        - The boxes are ranked by their 'score' (1 if missing) then their bottom-right y coordinate
+        - The overlap is the intersection over the area of the other box (or IoU if iou=True), computed
+        on the top-left & bottom-right corners, or on the true quadrangles if use_polygon=True
+        '''
+        pages_bboxes = [list(bboxes) for bboxes in pages_bboxes]
+        num_pages, max_boxes = len(pages_bboxes), max(map(len, pages_bboxes), default=0)
+        if max_boxes == 0: return [[] for _ in pages_bboxes]
+
+        # Pad the pages to max_boxes, with the boxes of each page sorted by priority (best first)
+        priorities = []
+        points = np.zeros((num_pages, max_boxes, 4, 2))
+        scores = np.full((num_pages, max_boxes), -np.inf)
+        for page_idx, bboxes in enumerate(pages_bboxes):
+            if len(bboxes) == 0: 
+                priorities.append(np.array([], dtype=int))
+                continue
+            page_points = np.array([bbox['points'] for bbox in bboxes], dtype='float64')
+            page_scores = np.array([bbox.get('score', 1.0) for bbox in bboxes], dtype='float64')
+            priority = np.argsort(page_points[:, 2, 1])[::-1] # By the bottom-right y coordinate
+            priority = priority[np.argsort(-page_scores[priority], kind='stable')]
+            priorities.append(priority)
+            points[page_idx, :len(bboxes)] = page_points[priority]
+            scores[page_idx, :len(bboxes)] = page_scores[priority]
+
+        boxes = BoundingBoxHandler.AxisAlignedBoxes(points)
+        active = np.isfinite(scores)
+        rows = np.arange(num_pages)
+        picks = [[] for _ in pages_bboxes]
+
+        for _ in range(max_boxes):
+            # argmax returns the 1st max, so the ties are broken by the priority order
+            best = np.argmax(np.where(active[rows], scores[rows], -np.inf), axis=1)
+            has_pick = active[rows, best]
+            rows, best = rows[has_pick], best[has_pick] # Only the pages with remaining boxes are kept
+            if len(rows) == 0: break
+            active[rows, best] = False
+            for page_idx, column in zip(rows.tolist(), best.tolist()): picks[page_idx].append(column)
+
+            if use_polygon: # Only against the remaining boxes, as each intersection is computed by OpenCV
+                overlaps = np.zeros((len(rows), max_boxes))
+                for row, (page_idx, column) in enumerate(zip(rows, best)):
+                    remaining = np.where(active[page_idx])[0]
+                    overlaps[row, remaining] = BoundingBoxHandler.PolygonOverlap(
+                        points[page_idx, column], points[page_idx, remaining], iou
+                    )
+            else: overlaps = BoundingBoxHandler.BoxesOverlap(boxes[rows, best][:, np.newaxis], boxes[rows], iou)
+
+            if soft is None: active[rows] &= ~(overlaps > threshold)
+            else:
+                if soft == 'linear': decay = np.where(overlaps > threshold, 1 - overlaps, 1)
+                elif soft == 'gaussian': decay = np.exp(-overlaps ** 2 / sigma)
+                else: raise ValueError('soft must be None, "linear" or "gaussian"')
+                scores[rows] = np.where(active[rows], scores[rows] * decay, scores[rows])
+                active[rows] &= scores[rows] >= min_score
+
+        # Return the picked bounding boxes of each page in the picking order
+        return [
+            [bboxes[priority[column]] for column in page_picks]
+            for bboxes, priority, page_picks in zip(pages_bboxes, priorities, picks)
+        ]
 
     @staticmethod
     def WidthOverHeightFilter(bboxes, max_ratio=0.5): 
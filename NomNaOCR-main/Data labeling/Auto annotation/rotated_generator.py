@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 import cv2
 import os
@@ -13,6 +14,7 @@ ap.add_argument(
     choices = ['+90', '-90', 'both'],
     help = 'Right angle direction to rotate'
 )
+ap.add_argument('--workers', type=int, default=None, help='Number of threads (default: depends on CPUs)')
 args = vars(ap.parse_args())
 # Example: python rotated_generator.py -i "Datasets/Tale of Kieu version 1871"
 
@@ -24,8 +26,7 @@ if not os.path.exists(output_dir):
     os.makedirs(output_dir)
     print('Created folder:', output_dir)
 
-for file_name in os.listdir(input_dir):
-    if not file_name.endswith(('.jpg', '.png', 'jpeg')): continue
+def rotate_image(file_name):
     image_name = os.path.splitext(file_name)[0]
     raw_image = cv2.imread(os.path.join(input_dir, file_name))
 
@@ -38,3 +39,9 @@ for file_name in os.listdir(input_dir):
         image = cv2.rotate(raw_image, cv2.ROTATE_90_CLOCKWISE)
         cv2.imwrite(os.path.join(output_dir, image_name + '-90.jpg'), image)
         print('Saved -90deg rotated images of', file_name, 'to', output_dir)
+
+
+# OpenCV releases the GIL while decoding, rotating and encoding, so the images are processed by threads
+file_names = [file_name for file_name in os.listdir(input_dir) if file_name.endswith(('.jpg', '.png', 'jpeg'))]
+with ThreadPoolExecutor(max_workers=args['workers']) as executor:
+    list(executor.map(rotate_image, file_names))
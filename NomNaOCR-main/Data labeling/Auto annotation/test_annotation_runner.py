@@ -0,0 +1,105 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from label_io import iter_labels
+from annotation_runner import annotate_images, CacheWriter
+
+
+batch_sizes = [] # Number of images of each call of fake_detect
+
+
+def fake_detect(images):
+    # One box over the top-left quarter of each (rotated) image
+    batch_sizes.append(len(images))
+    return [
+        [{'transcription': 'TEMPORARY', 'points': [[0, 0], [w / 2, 0], [w / 2, h / 2], [0, h / 2]], 'difficult': False}]
+        for h, w in (image.shape[:2] for image in images)
+    ]
+
+
+def test_annotate_images(tmp_path):
+    images_dir = tmp_path / 'Book'
+    images_dir.mkdir()
+    for name in ['a.jpg', 'b.JPG', 'c.jpeg', 'd.png', 'e.Jpeg']:
+        cv2.imwrite(str(images_dir / name), np.zeros((40, 20, 3), dtype=np.uint8))
+    (images_dir / 'notes.txt').write_text('not an image')
+    output_path = str(tmp_path / 'Book.cach')
+
+    batch_sizes.clear()
+    num_pages = annotate_images(str(images_dir), output_path, fake_detect, direction='+90', batch_size=2, workers=2)
+    pages = list(iter_labels(output_path))
+    assert num_pages == 5 and batch_sizes == [2, 2, 1]
+    assert [path for path, _ in pages] == ['Book/a.jpg', 'Book/b.JPG', 'Book/c.jpeg', 'Book/d.png', 'Book/e.Jpeg']
+
+    # The box detected on the page rotated by +90 degrees is rotated back on the pixels of the 20 x 40 page
+    points = np.array(pages[0][1][0]['points'])
+    np.testing.assert_allclose([points.min(axis=0), points.max(axis=0)], [[10, 0], [19, 19]], atol=1e-9)
+
+
+def make_book(tmp_path, names):
+    images_dir = tmp_path / 'Book'
+    images_dir.mkdir(exist_ok=True)
+    for name in names: cv2.imwrite(str(images_dir / name), np.zeros((40, 20, 3), dtype=np.uint8))
+    return str(images_dir), str(tmp_path / 'Book.cach')
+
+
+def interrupted_detect(num_batches):
+    # fake_detect, interrupted at its call number `num_batches` + 1
+    def detect(images):
+        if len(batch_sizes) == num_batches: raise KeyboardInterrupt
+        return fake_detect(images)
+    return detect
+
+
+def test_resume_by_file_name(tmp_path):
+    images_dir, output_path = make_book(tmp_path, ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg'])
+    batch_sizes.clear()
+    with pytest.raises(KeyboardInterrupt):
+        annotate_images(images_dir, output_path, interrupted_detect(1), direction='+90', batch_size=2)
+    assert os.path.exists(output_path + '.ckpt')
+
+    # An image added before the done ones & a done one removed => only the not done ones are annotated
+    os.remove(os.path.join(images_dir, 'b.jpg'))
+    make_book(tmp_path, ['0.jpg'])
+    batch_sizes.clear()
+    annotate_images(images_dir, output_path, fake_detect, direction='+90', batch_size=2)
+    assert batch_sizes == [2, 1]
+    assert [path for path, _ in iter_labels(output_path)] == ['Book/a.jpg', 'Book/b.jpg', 'Book/0.jpg', 'Book/c.jpg', 'Book/d.jpg']
+    assert not os.path.exists(output_path + '.ckpt')
+
+
+def test_resume_refused_with_other_options(tmp_path):
+    images_dir, output_path = make_book(tmp_path, ['a.jpg', 'b.jpg', 'c.jpg'])
+    batch_sizes.clear()
+    with pytest.raises(KeyboardInterrupt):
+        annotate_images(images_dir, output_path, interrupted_detect(1), direction='+90', batch_size=2)
+
+    with pytest.raises(ValueError, match='another run'):
+        annotate_images(images_dir, output_path, fake_detect, direction='-90', batch_size=2)
+    annotate_images(images_dir, output_path, fake_detect, direction='-90', batch_size=2, resume=False)
+    assert len(list(iter_labels(output_path))) == 3 and not os.path.exists(output_path + '.ckpt')
+
+
+def test_refuse_checkpoint_of_another_run(tmp_path):
+    output_path = str(tmp_path / 'Book.cach')
+    writer = CacheWriter(output_path, job={'input': 'a.cach'})
+    writer.write(['Book/a.jpg\t[]\n'])
+    writer.file.close()
+    with pytest.raises(ValueError, match='another run'):
+        CacheWriter(output_path, job={'input': 'b.cach'})
+    assert CacheWriter(output_path, job={'input': 'a.cach'}).num_done == 1
+
+
+def test_checkpoint_without_output_starts_over(tmp_path):
+    output_path = str(tmp_path / 'Book.cach')
+    writer = CacheWriter(output_path, job={'images_dir': 'Book'})
+    writer.write(['Book/a.jpg\t[]\n', 'Book/b.jpg\t[]\n'])
+    writer.file.close() # Interrupted: the checkpoint stays
+    os.remove(output_path)
+
+    writer = CacheWriter(output_path, job={'images_dir': 'Book'})
+    assert writer.num_done == 0 and writer.written_paths() == []
+    writer.write(['Book/a.jpg\t[]\n'])
+    writer.close()
+    assert [path for path, _ in iter_labels(output_path)] == ['Book/a.jpg']
@@ -0,0 +1,89 @@
+import struct
+import cv2
+import numpy as np
+import pytest
+from bbox_handler import BoundingBoxHandler
+
+
+def loop_nms(bboxes, threshold):
+    # The NonMaximumSuppression loop of pyimagesearch used before the batched version, as the reference
+    if len(bboxes) == 0: return []
+    points = np.array([bbox['points'] for bbox in bboxes])
+    x1, y1, x2, y2 = points[:, 0, 0], points[:, 0, 1], points[:, 2, 0], points[:, 2, 1]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs, picks = np.argsort(y2), []
+    while len(idxs) > 0:
+        last = len(idxs) - 1
+        i = idxs[last]
+        picks.append(bboxes[i])
+        w = np.maximum(0, np.minimum(x2[i], x2[idxs[:last]]) - np.maximum(x1[i], x1[idxs[:last]]) + 1)
+        h = np.maximum(0, np.minimum(y2[i], y2[idxs[:last]]) - np.maximum(y1[i], y1[idxs[:last]]) + 1)
+        overlap = (w * h) / area[idxs[:last]]
+        idxs = np.delete(idxs, np.concatenate(([last], np.where(overlap > threshold)[0])))
+    return picks
+
+
+def random_page(rng, num_boxes):
+    # Columns of text lines detected twice (like the +90 & -90 passes), so many boxes overlap
+    x1 = rng.uniform(0, 1000, num_boxes)
+    y1 = rng.uniform(0, 1500, num_boxes)
+    x2, y2 = x1 + rng.uniform(20, 60, num_boxes), y1 + rng.uniform(100, 600, num_boxes)
+    return [
+        {'transcription': str(idx), 'points': [[a, b], [c, b], [c, d], [a, d]]}
+        for idx, (a, b, c, d) in enumerate(zip(x1, y1, x2, y2))
+    ]
+
+
+@pytest.mark.parametrize('threshold', [0.3, 0.5, 0.8])
+def test_nms_matches_the_previous_loop(threshold):
+    rng = np.random.default_rng(0)
+    for num_boxes in [0, 1, 5, 80, 300]:
+        page = random_page(rng, num_boxes)
+        assert BoundingBoxHandler.NonMaximumSuppression(page, threshold) == loop_nms(page, threshold)
+
+
+def test_batch_nms_matches_each_page():
+    rng = np.random.default_rng(1)
+    pages = [random_page(rng, num_boxes) for num_boxes in [50, 0, 200, 3, 120]]
+    batched = BoundingBoxHandler.BatchNonMaximumSuppression(pages, 0.5)
+    assert batched == [loop_nms(page, 0.5) for page in pages]
+
+
+def test_soft_nms_keeps_more_boxes():
+    page = random_page(np.random.default_rng(2), 150)
+    hard = BoundingBoxHandler.NonMaximumSuppression(page, 0.5)
+    soft = BoundingBoxHandler.NonMaximumSuppression(page, 0.5, soft='gaussian', min_score=0.5)
+    assert len(hard) < len(soft) <= len(page)
+
+
+def test_polygon_nms_on_axis_aligned_boxes():
+    # For rectangles the true polygon overlap only differs from the corners overlap by the +1 pixel
+    page = random_page(np.random.default_rng(3), 100)
+    assert BoundingBoxHandler.NonMaximumSuppression(page, 0.5, use_polygon=True) == \
+        BoundingBoxHandler.NonMaximumSuppression(page, 0.5)
+
+
+def jpeg_with_orientation(path, orientation, endian='<'):
+    # 30 x 50 JPEG with an APP1 Exif segment whose IFD0 only has the Orientation tag
+    jpeg = cv2.imencode('.jpg', np.zeros((30, 50, 3), dtype=np.uint8))[1].tobytes()
+    byte_order = b'II' if endian == '<' else b'MM'
+    tiff = byte_order + struct.pack(endian + 'HI', 42, 8) + struct.pack(endian + 'H', 1) + \
+        struct.pack(endian + 'HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack(endian + 'I', 0)
+    segment = b'Exif\x00\x00' + tiff
+    path.write_bytes(jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment + jpeg[2:])
+    return str(path)
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('orientation', range(1, 9))
+def test_image_size_with_exif_orientation(tmp_path, orientation, endian):
+    file_name = jpeg_with_orientation(tmp_path / 'photo.jpg', orientation, endian)
+    size = BoundingBoxHandler.ReadImageSize(file_name)
+    assert size == cv2.imread(file_name).shape[:2]
+    assert size == ((50, 30) if orientation >= 5 else (30, 50))
+
+
+def test_image_size_png_and_plain_jpeg(tmp_path):
+    for name in ['page.png', 'page.jpg']:
+        cv2.imwrite(str(tmp_path / name), np.zeros((30, 50, 3), dtype=np.uint8))
+        assert BoundingBoxHandler.ReadImageSize(str(tmp_path / name)) == (30, 50)
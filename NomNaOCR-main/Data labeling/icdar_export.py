@@ -0,0 +1,119 @@
+'''
+Bulk export of the PPOCRLabel pages to ICDAR 2015 ground truths ("x1,y1,...,x4,y4,transcription" lines):
+- The pages are streamed, the points of a page are ordered at once and formatted with a single format
+string (like numpy.savetxt), instead of one conversion per number
+- The files are written by a pool of threads, or packed into a single .zip / .tar(.gz) archive for CLEval
+- The statistics of each page (number of lines & difficult boxes) are collected while writing
+'''
+from concurrent.futures import ThreadPoolExecutor
+from label_io import order_points_clockwise
+from collections import deque
+import numpy as np
+import itertools
+import tarfile
+import zipfile
+import time
+import io
+import os
+
+ICDAR_LINE = '%r,%r,%r,%r,%r,%r,%r,%r,%s\n' # The coordinates are written like str(float)
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+
+def format_icdar_pages(pages, difficult_text=None):
+    '''
+    Params:
+        pages (list): The PageLabel of each page (label_io.iter_pages or to_page_label), their points are
+            ordered all together.
+        difficult_text (str): The transcription written for the difficult bboxes (e.g. '###'),
+            None to keep their transcription.
+    Returns:
+        (list, list): The ICDAR text and the statistics of each page.
+    '''
+    if len(pages) == 0: return [], []
+    all_points = np.concatenate([page.points for page in pages])
+    all_points = order_points_clockwise(all_points, dtype='float64').reshape(-1, 8).tolist()
+    texts, stats, start = [], [], 0
+    for page in pages:
+        num_lines, values = len(page.transcriptions), []
+        for coordinates, text, difficult in zip(
+            all_points[start:start + num_lines], page.transcriptions, page.difficult.tolist()
+        ):
+            values += coordinates
+            values.append(difficult_text if difficult and difficult_text is not None else text)
+
+        texts.append((ICDAR_LINE * num_lines) % tuple(values))
+        stats.append({'lines': num_lines, 'difficult': int(np.count_nonzero(page.difficult))})
+        start += num_lines
+    return texts, stats
+
+
+def format_icdar_page(page, difficult_text=None):
+    texts, stats = format_icdar_pages([page], difficult_text)
+    return texts[0], stats[0]
+
+
+def _write_files(paths, texts):
+    for path, text in zip(paths, texts):
+        with open(path, 'w', encoding='utf-8') as file: file.write(text)
+
+
+class _ArchiveWriter:
+    # Same interface for the .zip & .tar archives: add(name, text), then close()
+    def __init__(self, archive_path):
+        if archive_path.endswith('.zip'):
+            self.archive = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED)
+            self.add = lambda name, text: self.archive.writestr(name, text.encode('utf-8'))
+        else:
+            self.archive = tarfile.open(archive_path, 'w:gz' if archive_path.endswith(('.gz', '.tgz')) else 'w')
+            self.add = self._add_to_tar
+        self.close = self.archive.close
+
+
+    def _add_to_tar(self, name, text):
+        data = text.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime = len(data), time.time()
+        self.archive.addfile(info, io.BytesIO(data))
+
+
+def export_icdar(pages, output, difficult_text=None, max_workers=16, chunk_size=256):
+    '''
+    Params:
+        pages (iterable): The (file name of the ICDAR page, PageLabel) pairs, streamed.
+        output (str): The output folder, or an archive path ending with .zip, .tar, .tar.gz or .tgz.
+        difficult_text (str): The transcription written for the difficult bboxes (see format_icdar_pages).
+        max_workers (int): The number of threads writing the files (unused for the archives).
+        chunk_size (int): The number of pages formatted together & written by the same thread.
+    Returns:
+        stats (list): The {'page', 'lines', 'difficult'} of each page, in the input order.
+    '''
+    pages, stats = iter(pages), []
+    chunks = iter(lambda: list(itertools.islice(pages, chunk_size)), [])
+    if output.endswith(ARCHIVE_EXTENSIONS): # The archive is written sequentially, while streaming the pages
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        archive = _ArchiveWriter(output)
+        try:
+            for chunk in chunks:
+                texts, chunk_stats = format_icdar_pages([page for _, page in chunk], difficult_text)
+                for (page_name, _), text, page_stats in zip(chunk, texts, chunk_stats):
+                    archive.add(page_name, text)
+                    stats.append({'page': page_name, **page_stats})
+        finally: archive.close()
+        return stats
+
+    created_dirs = set()
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = deque() # At most 2 chunks per thread in flight, so the pages are streamed
+        for chunk in chunks:
+            texts, chunk_stats = format_icdar_pages([page for _, page in chunk], difficult_text)
+            paths = [os.path.join(output, page_name) for page_name, _ in chunk]
+            for dir_path in set(map(os.path.dirname, paths)) - created_dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                created_dirs.add(dir_path)
+
+            pending.append(executor.submit(_write_files, paths, texts))
+            if len(pending) >= 2 * max_workers: pending.popleft().result()
+            stats += [{'page': page_name, **page_stats} for (page_name, _), page_stats in zip(chunk, chunk_stats)]
+        while pending: pending.popleft().result()
+    return stats
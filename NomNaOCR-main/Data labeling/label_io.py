@@ -0,0 +1,95 @@
+'''
+Shared reading & writing of the PPOCRLabel files (Label.txt, Cache.cach and the .cach of the auto annotation):
+- Each line is "<image path>\t<list of bboxes>", the bboxes being JSON (written by PPOCRLabel) or Python
+literals (written by the old unrotated_convertor), so both dialects are parsed
+- The files are streamed line by line, as (image path, bboxes) or as PageLabel records whose points are
+a single NumPy array for the whole page (used by the ICDAR export)
+- The lines are always written back as canonical JSON
+- The 4 points of the bboxes are put in clockwise order for all of them at once
+'''
+from collections import namedtuple
+import numpy as np
+import json
+import ast
+import re
+
+
+# Python literal tokens that differ from JSON, strings first so that their content is never replaced
+LITERAL_TOKENS = re.compile(r"'((?:[^'\\]|\\.)*)'|\"(?:[^\"\\]|\\.)*\"|\b(True|False|None)\b")
+LITERAL_KEYWORDS = {'True': 'true', 'False': 'false', 'None': 'null'}
+PageLabel = namedtuple('PageLabel', ['path', 'points', 'transcriptions', 'difficult'])
+
+
+def _literal_token_to_json(match):
+    single_quoted, keyword = match.group(1), match.group(2)
+    if keyword: return LITERAL_KEYWORDS[keyword]
+    if single_quoted is None: return match.group(0) # Already a double quoted string
+    if '\\' in single_quoted or '"' in single_quoted: # Escapes differ between Python and JSON
+        return json.dumps(ast.literal_eval(match.group(0)), ensure_ascii=False)
+    return f'"{single_quoted}"'
+
+
+def parse_bboxes(text):
+    try: return json.loads(text) # Fast path: PPOCRLabel files & the files written with format_line
+    except json.JSONDecodeError: pass
+    try: return json.loads(LITERAL_TOKENS.sub(_literal_token_to_json, text)) # Python literals as JSON
+    except json.JSONDecodeError: return ast.literal_eval(text) # Tuples or other literals, slow path
+
+
+def validate_bboxes(bboxes):
+    if not isinstance(bboxes, list): raise ValueError('The bboxes of a page must be a list')
+    for bbox in bboxes:
+        if not isinstance(bbox, dict) or 'points' not in bbox or 'transcription' not in bbox:
+            raise ValueError(f'Each bbox must be a dict with "points" and "transcription": {bbox}')
+        if len(bbox['points']) == 0 or any(len(point) != 2 for point in bbox['points']):
+            raise ValueError(f'The points of a bbox must be [x, y] pairs: {bbox["points"]}')
+    return bboxes
+
+
+def parse_line(line, validate=True):
+    image_path, bboxes = line.rstrip('\r\n').split('\t', 1)
+    bboxes = parse_bboxes(bboxes)
+    return image_path, validate_bboxes(bboxes) if validate else bboxes
+
+
+def iter_labels(file_path, validate=True):
+    # Stream the (image path, bboxes) of a label file, the errors tell the line they come from
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line_idx, line in enumerate(file, start=1):
+            if not line.strip(): continue
+            try: yield parse_line(line, validate)
+            except (ValueError, SyntaxError) as error:
+                raise ValueError(f'{file_path}:{line_idx}: {error}') from error
+
+
+def to_page_label(image_path, bboxes):
+    # The points of all bboxes of a page => (num_bboxes, num_points, 2) array (4 points for PPOCRLabel)
+    if len(bboxes) == 0: points = np.zeros((0, 4, 2)) # Pages without any text
+    else: points = np.array([bbox['points'] for bbox in bboxes], dtype='float64').reshape(len(bboxes), -1, 2)
+    transcriptions = [bbox['transcription'] for bbox in bboxes]
+    difficult = np.array([bool(bbox.get('difficult', False)) for bbox in bboxes], dtype=bool)
+    return PageLabel(image_path, points, transcriptions, difficult)
+
+
+def iter_pages(file_path):
+    for image_path, bboxes in iter_labels(file_path): yield to_page_label(image_path, bboxes)
+
+
+def order_points_clockwise(points, dtype='float32'):
+    # (N, 4, 2) or (4, 2) points => same shape in top-left, top-right, bottom-right, bottom-left order.
+    # The points are sorted by their angle around the center (clockwise in image coordinates), then the
+    # cycle starts from the one with the smallest x + y, so each point is kept once even for the boxes
+    # rotated around 45 degrees or when the 2 left-most points are not the left side of the box
+    points = np.asarray(points, dtype=dtype)
+    boxes = points.reshape(-1, 4, 2)
+    rows = np.arange(len(boxes))[:, np.newaxis]
+
+    deltas = boxes.astype('float64') - boxes.mean(axis=1, keepdims=True, dtype='float64')
+    clockwise = np.argsort(np.arctan2(deltas[:, :, 1], deltas[:, :, 0]), axis=1, kind='stable')
+    boxes = boxes[rows, clockwise]
+    start = np.argmin(boxes.sum(axis=2), axis=1)[:, np.newaxis]
+    return boxes[rows, (start + np.arange(4)) % 4].reshape(points.shape)
+
+
+def format_line(image_path, bboxes):
+    return f'{image_path}\t{json.dumps(bboxes, ensure_ascii=False)}\n'
@@ -5,9 +5,8 @@ Implementation of label mapping process:
 '''
 import os
 import re
-import ast
-import glob
-import numpy as np
+from label_io import parse_line, to_page_label
+from icdar_export import export_icdar
 
 
 ROOT_PATH = ''
@@ -25,26 +24,8 @@ LIST_DATA = [
 ]
 
 
-def order_points_clockwise(box_points):
-    points = np.array(box_points)
-    s = points.sum(axis=1)
-    diff = np.diff(points, axis=1)
-    quad_box = np.zeros((4, 2), dtype=np.float32)
-    quad_box[0] = points[np.argmin(s)]
-    quad_box[2] = points[np.argmax(s)]
-    quad_box[1] = points[np.argmin(diff)]
-    quad_box[3] = points[np.argmax(diff)]
-    return quad_box
-
-
 def split_detail(text):
-    url, list_dict = text.split('\t')
-    list_dict = ast.literal_eval(
-        list_dict
-        .replace('\n', '')
-        .replace('false', 'False')
-        .replace('true', 'True')
-    )
+    url, list_dict = parse_line(text)
     
     total_word = 0
     for idx, elem in enumerate(list_dict):
@@ -69,32 +50,18 @@ def split_detail(text):
     }
     
     
+long_pages = []
 for path in LIST_DATA:
-    dataset = []
-    with open(os.path.join(ROOT_PATH, path, 'Label.txt'), 'r') as f:
-        dataset = [split_detail(data) for data in f.readlines()]
-
-    if not os.path.exists(os.path.join(ROOT_PATH, path, MAP_FOLDER_NAME)):
-        os.makedirs(os.path.join(ROOT_PATH, path, MAP_FOLDER_NAME))
-
-    for data in dataset:
-        final_detect_data = []
-        for box in data['bbox']:
-            text = box['transcription']
-            if box['difficult']: text = '###'
-            
-            points = list(order_points_clockwise(box['points']).flat)
-            points = ','.join([str(num) for num in points])
-            final_detect_data.append(f"{points},{text}")
-        
-        saved_path = os.path.join(ROOT_PATH, path, MAP_FOLDER_NAME, data['img'].replace('jpg', 'txt'))
-        with open(saved_path, 'w+') as f:
-            f.write('\n'.join(final_detect_data))
-            
+    map_path = os.path.join(ROOT_PATH, path, MAP_FOLDER_NAME)
+    with open(os.path.join(ROOT_PATH, path, 'Label.txt'), 'r', encoding='utf-8') as f:
+        pages = (
+            (data['img'].replace('jpg', 'txt'), to_page_label(data['url'], data['bbox']))
+            for data in map(split_detail, f)
+        )
+        stats = export_icdar(pages, map_path, difficult_text='###') # Lines & difficult boxes of each page
+    long_pages += [os.path.join(map_path, page['page']) for page in stats if page['lines'] > 35]
 
-for path in glob.glob(f'{ROOT_PATH}/*/{MAP_FOLDER_NAME}/*.txt'):
-    with open(path, 'r', encoding='utf-8') as f:
-        if len(f.readlines()) > 35: print(path)
+for path in long_pages: print(path)
         
 ''' Output:
 ROOT_PATH/DVSKTT-2 Ngoai ky toan thu/MAP_FOLDER_NAME/DVSKTT_ngoai_II_17a.txt
@@ -1,6 +1,7 @@
 from argparse import ArgumentParser, FileType
 from tqdm import tqdm
-import json
+from label_io import iter_pages
+from icdar_export import export_icdar
 import os
 import re
 
@@ -15,21 +16,18 @@ ap.add_argument(
     '-o', 
     '--output_dir', 
     required = True, 
-    help = 'Output directory for IC15 *.txt files'
+    help = 'Output directory for IC15 *.txt files, or a .zip / .tar / .tar.gz archive of them (for CLEval)'
 )
+ap.add_argument('--workers', type=int, default=16, help='Number of threads writing the files')
 
 args = vars(ap.parse_args())
-if not os.path.exists(args['output_dir']):
-    os.makedirs(args['output_dir'])
-
-with open(args['input_file'], 'r', encoding='utf-8') as paddle_txt:
-    for line in tqdm(paddle_txt):
-        page_path, page_boxes = line.strip().split('\t')
-        page_name = page_path.replace('imgs/', '').split('.jpg')[0]
-        page_boxes = json.loads(page_boxes)
-
-        with open(f"{args['output_dir']}/{page_name}.txt", 'w', encoding='utf-8') as ic15_txt:
-            for box in page_boxes:
-                flatten_box = sum(box['points'], [])
-                ic15_box = ','.join([str(num * 1.0) for num in flatten_box])
-                ic15_txt.write(f'{ic15_box},{box["transcription"]}\n')
+pages = (
+    (page.path.replace('imgs/', '').split('.jpg')[0] + '.txt', page)
+    for page in tqdm(iter_pages(args['input_file']))
+)
+stats = export_icdar(pages, args['output_dir'], max_workers=args['workers'])
+print(
+    len(stats), 'pages,', 
+    sum(page['lines'] for page in stats), 'lines,', 
+    sum(page['difficult'] for page in stats), 'difficult'
+)
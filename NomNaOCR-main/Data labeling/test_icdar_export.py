@@ -0,0 +1,30 @@
+import zipfile
+from label_io import to_page_label
+from icdar_export import format_icdar_page, export_icdar
+
+BBOXES = [ # Points not in clockwise order, the export orders them
+    {'transcription': '門公', 'points': [[30, 40], [1, 40], [1, 2], [30, 2]], 'difficult': False},
+    {'transcription': '以衛', 'points': [[5, 6], [50, 6], [50, 60], [5, 60]], 'difficult': True},
+]
+
+
+def test_format_icdar_page():
+    text, stats = format_icdar_page(to_page_label('a.jpg', BBOXES), difficult_text='###')
+    assert text == '1.0,2.0,30.0,2.0,30.0,40.0,1.0,40.0,門公\n5.0,6.0,50.0,6.0,50.0,60.0,5.0,60.0,###\n'
+    assert stats == {'lines': 2, 'difficult': 1}
+
+
+def test_export_empty_page(tmp_path):
+    pages = [('a.txt', to_page_label('a.jpg', BBOXES)), ('empty.txt', to_page_label('empty.jpg', []))]
+    stats = export_icdar(pages, str(tmp_path))
+    assert [page['lines'] for page in stats] == [2, 0]
+    assert (tmp_path / 'a.txt').read_text(encoding='utf-8').count('\n') == 2
+    assert (tmp_path / 'empty.txt').read_text(encoding='utf-8') == ''
+
+
+def test_export_archive(tmp_path):
+    pages = [(f'book/{i}.txt', to_page_label(f'{i}.jpg', BBOXES)) for i in range(5)]
+    export_icdar(pages, str(tmp_path / 'gt.zip'), chunk_size=2)
+    with zipfile.ZipFile(tmp_path / 'gt.zip') as archive:
+        assert sorted(archive.namelist()) == [f'book/{i}.txt' for i in range(5)]
+        assert archive.read('book/0.txt').decode('utf-8').endswith(',以衛\n')
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from label_io import parse_bboxes, parse_line, iter_labels, to_page_label, iter_pages, order_points_clockwise, format_line
+
+BBOXES = [
+    {'transcription': '門公', 'points': [[1, 2], [30, 2], [30, 40], [1, 40]], 'difficult': False},
+    {'transcription': "it's \"quoted\"", 'points': [[5, 6], [50, 6], [50, 60], [5, 60]], 'difficult': True},
+]
+
+
+def test_parse_bboxes_json():
+    assert parse_bboxes(format_line('a.jpg', BBOXES).split('\t', 1)[1]) == BBOXES
+
+
+def test_parse_bboxes_python_literals():
+    # Written with str(list) by the old unrotated_convertor: single quotes, True/False, escaped quotes
+    assert parse_bboxes(str(BBOXES)) == BBOXES
+    assert parse_bboxes("[{'transcription': 'None True', 'points': ((1, 2), (3, 4))}]") == [
+        {'transcription': 'None True', 'points': ((1, 2), (3, 4))}
+    ]
+
+
+def test_parse_line_rejects_invalid_bboxes():
+    with pytest.raises(ValueError):
+        parse_line('a.jpg\t[{"points": [[1, 2]]}]\n')
+
+
+def test_iter_labels_tells_the_line(tmp_path):
+    label_path = tmp_path / 'Label.txt'
+    label_path.write_text(format_line('a.jpg', BBOXES) + '\n' + 'b.jpg\t[{"transcription": "x"}]\n', encoding='utf-8')
+    with pytest.raises(ValueError, match=r'Label.txt:3'):
+        list(iter_labels(str(label_path)))
+
+
+def test_to_page_label():
+    page = to_page_label('a.jpg', BBOXES)
+    assert page.points.shape == (2, 4, 2) and page.points.dtype == np.float64
+    assert page.transcriptions == ['門公', "it's \"quoted\""]
+    np.testing.assert_array_equal(page.difficult, [False, True])
+
+
+def test_to_page_label_empty_page():
+    page = to_page_label('empty.jpg', [])
+    assert page.points.shape == (0, 4, 2)
+    assert page.transcriptions == [] and page.difficult.shape == (0,)
+
+
+def test_iter_pages(tmp_path):
+    label_path = tmp_path / 'Label.txt'
+    label_path.write_text(format_line('a.jpg', BBOXES) + format_line('empty.jpg', []), encoding='utf-8')
+    pages = list(iter_pages(str(label_path)))
+    assert [page.path for page in pages] == ['a.jpg', 'empty.jpg']
+    assert [len(page.points) for page in pages] == [2, 0]
+
+
+def test_order_points_clockwise_rotated_rectangles():
+    # Shuffled corners of random rotated rectangles => the same clockwise cycle from the top-left corner
+    rng = np.random.default_rng(0)
+    angles = rng.uniform(-np.pi / 2, np.pi / 2, 1000)
+    corners = np.array([[-2, -1], [2, -1], [2, 1], [-2, 1]], dtype='float64') * rng.uniform(5, 50, (1000, 1, 1))
+    rotation = np.stack([np.cos(angles), -np.sin(angles), np.sin(angles), np.cos(angles)], axis=1).reshape(-1, 2, 2)
+    boxes = corners @ rotation.transpose(0, 2, 1) + rng.uniform(0, 1000, (1000, 1, 2))
+    shuffled = np.array([box[rng.permutation(4)] for box in boxes])
+
+    ordered = order_points_clockwise(shuffled, dtype='float64')
+    start = np.argmin(boxes.sum(axis=2), axis=1)
+    expected = boxes[np.arange(1000)[:, None], (start[:, None] + np.arange(4)) % 4]
+    np.testing.assert_allclose(ordered, expected)
+
+
+def test_order_points_single_box():
+    box = [[173, 388], [74, 495], [177, 442], [67, 432]]
+    assert order_points_clockwise(box).tolist() == [[67, 432], [173, 388], [177, 442], [74, 495]]
@@ -4,8 +4,8 @@ Implementation of the R-score algorithm for the IHRNomDB dataset:
 - Implemnted by: Nguyen Duc Duy Anh (https://github.com/duyanh1909)
 '''
 
-from tqdm.notebook import tqdm
-from collections import Counter
+import numpy as np
+from scipy.sparse import csr_matrix
 
 
 def print_intersection(val_data, train_data):
@@ -37,25 +37,57 @@ def frequence_in_D(dataset, char):
     Returns:
         (int): The number of appearances of a character.
     """
-    return ''.join(dataset).count(char)
+    return sum(s.count(char) for s in dataset)
 
 
-def max_N(dataset):
+def occurrence_matrix(dataset):
     """
-    Calculate 
+    Count the characters of all sentences at once (instead of a Counter for each of them).
+    Params:
+        dataset (list): The list of sentences.
+    Returns:
+        counts (csr_matrix): The sentence × character matrix of occurrences.
+        char_counts (np.ndarray): The number of appearances of each character in the dataset (D).
     """
-    max_score = 0
-    vocab = dict(Counter(''.join(dataset)).most_common())
+    lengths = np.fromiter(map(len, dataset), dtype=np.int64, count=len(dataset))
+    codes = np.frombuffer(''.join(dataset).encode('utf-32-le'), dtype=np.uint32) # 1 code point per char
+    chars, char_idxs = np.unique(codes, return_inverse=True)
+    sentence_idxs = np.repeat(np.arange(len(dataset)), lengths)
+
+    counts = csr_matrix( # Duplicated (sentence, char) pairs are summed
+        (np.ones(len(codes), dtype=np.int64), (sentence_idxs, char_idxs)), 
+        shape = (len(dataset), len(chars))
+    )
+    counts.sum_duplicates()
+    char_counts = np.asarray(counts.sum(axis=0), dtype=np.int64).ravel()
+    return counts, char_counts
+
 
-    for idx, s in tqdm(enumerate(dataset)):
-        dataset_not_s = dataset[:idx] + dataset[idx:]
-        list_s = list(s)
-        vocab_not_s = vocab.copy()
-        for word in list_s: vocab_not_s[word] -= 1
-        
-        sum_word_distinct = sum([vocab_not_s[word] for word in set(list_s)])
-        if max_score < sum_word_distinct: max_score = sum_word_distinct
-    return max_score
+def counts_not_s(dataset):
+    """
+    Number of appearances in D - {s} of each character of each sentence s: N_i - (count of i in s).
+    Params:
+        dataset (list): The list of sentences.
+    Returns:
+        counts (csr_matrix): The sentence × character matrix of occurrences.
+        not_s (csr_matrix): The counts in D - {s}, with the same sparsity as counts.
+    """
+    counts, char_counts = occurrence_matrix(dataset)
+    not_s = counts.copy()
+    not_s.data = char_counts[counts.indices] - counts.data
+    return counts, not_s
+
+
+def max_N(dataset):
+    """
+    Calculate the max over the sentences s of the sum of N_i (in D - {s}) for the distinct characters i of s.
+    Params:
+        dataset (list): The list of sentences.
+    Returns:
+        (int): The max score.
+    """
+    _, not_s = counts_not_s(dataset)
+    return int(np.asarray(not_s.sum(axis=1), dtype=np.int64).max(initial=0))
 
 
 def calculate_r_scores(dataset):
@@ -67,18 +99,13 @@ def calculate_r_scores(dataset):
         results (list): The list of Chinese character sequences with their r-scores.
     """
     vob = list(map(lambda elm: elm[1], dataset))
-    results = []
-    max_score = max_N(vob)
-    vocab = dict(Counter(''.join(vob)).most_common())
-
-    for idx, s in tqdm(enumerate(dataset)):
-        list_s = list(s[1])
-        vocab_not_s = vocab.copy()
-        
-        for word in list_s: vocab_not_s[word] -= 1
-        sum_word_distinct = sum([vocab_not_s[word] for word in set(list_s)])
-        sum_word = sum([vocab_not_s[word] for word in list_s])
-        
-        r = sum_word_distinct * max_score + sum_word
-        results.append([s[0], s[1], r])
-    return results
\ No newline at end of file
+    if len(vob) == 0: return []
+    counts, not_s = counts_not_s(vob)
+
+    # Sums over the distinct characters of s, and over all of them (each one weighted by its count in s)
+    sum_word_distinct = np.asarray(not_s.sum(axis=1), dtype=np.int64).ravel()
+    sum_word = np.asarray(not_s.multiply(counts).sum(axis=1), dtype=np.int64).ravel()
+    max_score = int(sum_word_distinct.max(initial=0))
+    
+    r_scores = sum_word_distinct * max_score + sum_word
+    return [[s[0], s[1], r] for s, r in zip(dataset, r_scores.tolist())]
@@ -4,6 +4,7 @@ Implementation of pages splitting:
 - GitHub: https://github.com/duyanh1909
 '''
 import os
+import json
 import glob
 import shutil
 from tqdm.notebook import tqdm
@@ -11,8 +12,8 @@ from utils import read_pages, split_pages
 
 
 tool_label = {}
-tool_label['Train'] = []
-tool_label['Validate'] = []
+tool_label['Train'] = set()
+tool_label['Validate'] = set()
 train_labels, val_labels = [], []
 
 for path in os.listdir('final_datasets/label_text/'):
@@ -22,7 +23,7 @@ for path in os.listdir('final_datasets/label_text/'):
 
     for paths, status in zip([train, val], ['Train', 'Validate']):
         target_path = split_pages(paths, '/tmp/Pages')
-        tool_label[status].extend(list(map(lambda x: x[0], target_path)))
+        tool_label[status].update(img for img, _ in target_path)
         
         if status == 'Train':
             train_labels.extend([f'{img}\t{label}' for img, label in target_path])
@@ -47,8 +48,9 @@ for path in glob.glob('final_datasets/label_text/*/Label.txt'):
     with open(path, 'r', encoding='utf-8') as f:
         dataset.extend([read_pages(data) for data in f.readlines()])
         
-train_paths = list(map(lambda x: x.replace('imgs/', ''), tool_label['Train']))
-val_paths = list(map(lambda x: x.replace('imgs/', ''), tool_label['Validate']))
+# Hash sets for the membership checks below (instead of scanning lists for each page)
+train_paths = {path.replace('imgs/', '') for path in tool_label['Train']}
+val_paths = {path.replace('imgs/', '') for path in tool_label['Validate']}
 label_train, label_val = [], []
 
 for data in dataset:
@@ -5,11 +5,9 @@ Implementation of patches splitting:
 '''
 import os
 import glob
-import numpy as np
-import pandas as pd
 
 from tqdm.notebook import tqdm
-from IHRNomDB_Rs import calculate_r_scores, print_intersection
+from stratified_split import stratified_split, split_coverage, write_split
 from utils import read_patches, split_patches
 
 PATH_LABELS = glob.glob("/tmp/crop/Patches/*/Transcription.txt")
@@ -22,38 +20,16 @@ for path in PATH_LABELS:
     dataset.extend(read_patches(path))
 print(max([len(x[1]) for x in dataset])) # 24      
 
-# Split patches into train & val DataFrames using IHR-NomDB R-Score       
-r_scores = calculate_r_scores(dataset)
-r_scores_sorted = sorted(r_scores, key=lambda x: x[2], reverse=True)
-print(r_scores_sorted[:10)
-''' Output:
-[
-    'DVSKTT-4 Ban ky thuc luc/DVSKTT_ban_thuc_XIV_53a_4.jpg',
-    '門公以衛士不義遂殺之十二月初一日帝飲',
-    1449896006
-]
-'''
-
-df = pd.DataFrame(data=np.array(r_scores_sorted)[:, :2], columns=['path', 'text'])
-df = df[df['path'] != 'DVSKTT-5 Ban ky tuc bien/DVSKTT_ban_tuc_XIX_23a_7.jpg']
-df_train = df.sample(frac=0.8)
-df_val = df.drop(df_train.index)
-
-print_intersection(df_val['text'].tolist(), df_train['text'].tolist())
-''' Output:
-Characters intersection train 93.2405165456013
-Characters intersection val 64.41315862838026
-'''
-print(len(df)) # 38318
-
-# Apply splitting on the real data based on above DataFrames
-label_train = [f'{path}\t{text}' for path, text in df_train.values]
-with open(os.path.join(PATH_TARGET, 'Train.txt'), 'w+', encoding='utf-8') as f:
-    f.write('\n'.join(label_train))
-
-label_val = [f'{path}\t{text}' for path, text in df_val.values]
-with open(os.path.join(PATH_TARGET, 'Validate.txt'), 'w+', encoding='utf-8') as f:
-    f.write('\n'.join(label_val))
-    
-split_patches(df_train['path'])
-split_patches(df_val['path'])
+# Split patches into train & val sets with the same characters ratio, every val character is also in train
+patches = [patch for patch in dataset if patch[0] != 'DVSKTT-5 Ban ky tuc bien/DVSKTT_ban_tuc_XIX_23a_7.jpg']
+is_val = stratified_split(patches, val_ratio=0.2, min_coverage=1.0, seed=0)
+print(split_coverage(patches, is_val))
+print(len(patches)) # 38318
+
+# Apply splitting on the real data based on the above split
+write_split(patches, is_val, PATH_TARGET)
+manifest = split_patches(
+    [path for path, _ in patches], PATH_SOURCE, PATH_TARGET, 
+    manifest_path = os.path.join(PATH_TARGET, 'manifest.json')
+)
+print({key: value for key, value in manifest.items() if key != 'files'})
@@ -0,0 +1,102 @@
+'''
+Stratified splitting of the patches into train & val sets:
+- Each character is spread between the 2 sets in the same ratio as the whole split (as much as possible)
+- The characters of the val set must also be present in the train set (at least min_coverage of them)
+'''
+import os
+import numpy as np
+from IHRNomDB_Rs import occurrence_matrix
+
+
+def stratified_split(patches, val_ratio=0.2, min_coverage=1.0, balance_weight=10.0, seed=None):
+    """
+    Greedily assign each patch to the train or val set in one pass over them, from the ones having the
+    rarest characters to the most common ones (the rare characters are the hardest to cover & balance).
+    Params:
+        patches (list): The list of [path, text].
+        val_ratio (float): The fraction of patches in the val set, the others are in the train set.
+        min_coverage (float): The minimum fraction of the distinct val characters also present in train.
+        balance_weight (float): How much the characters balance can move the split away from val_ratio.
+        seed (int): The seed to shuffle the patches having the same rarest character frequency.
+    Returns:
+        is_val (np.ndarray): The boolean mask of the val patches, aligned with `patches`.
+    """
+    texts = [text for _, text in patches]
+    counts, char_counts = occurrence_matrix(texts)
+    indptr, char_idxs, char_freqs = counts.indptr, counts.indices.tolist(), counts.data.tolist()
+
+    # Rarest character frequency of each patch (the empty ones are processed last)
+    rarest_freqs = np.full(len(texts), np.iinfo(np.int64).max)
+    non_empty = np.diff(indptr) > 0
+    rarest_freqs[non_empty] = np.minimum.reduceat(char_counts[counts.indices], indptr[:-1][non_empty])
+    order = np.random.default_rng(seed).permutation(len(texts))
+    order = order[np.argsort(rarest_freqs[order], kind='stable')]
+
+    seen = [0] * len(char_counts) # Occurrences of each character in the patches processed so far
+    train_freqs, val_freqs = [0] * len(char_counts), [0] * len(char_counts)
+    num_val_chars, num_uncovered = 0, 0 # Distinct val characters, and those not in train (yet)
+    is_val = np.zeros(len(texts), dtype=bool)
+    num_val = 0
+
+    for processed, idx in enumerate(order.tolist(), start=1):
+        chars = char_idxs[indptr[idx]:indptr[idx + 1]]
+        freqs = char_freqs[indptr[idx]:indptr[idx + 1]]
+        char_deficit = 0.0 # How much the characters of this patch are missing in val (relative to seen)
+        new_val_chars, new_uncovered = 0, 0
+
+        for char, freq in zip(chars, freqs):
+            seen[char] += freq
+            char_deficit += (val_ratio * seen[char] - val_freqs[char]) / seen[char]
+            if val_freqs[char] == 0:
+                new_val_chars += 1
+                if train_freqs[char] == 0: new_uncovered += 1
+        if chars: char_deficit *= balance_weight / len(chars)
+
+        # The global deficit keeps the ratio of the split, the characters deficit decides at the margin
+        is_covered = num_uncovered + new_uncovered <= (1 - min_coverage) * (num_val_chars + new_val_chars)
+        if is_covered and val_ratio * processed - num_val + char_deficit > 0:
+            is_val[idx] = True
+            num_val += 1
+            num_val_chars += new_val_chars
+            num_uncovered += new_uncovered
+            for char, freq in zip(chars, freqs): val_freqs[char] += freq
+        else:
+            for char, freq in zip(chars, freqs):
+                if train_freqs[char] == 0 and val_freqs[char] > 0: num_uncovered -= 1
+                train_freqs[char] += freq
+    return is_val
+
+
+def split_coverage(patches, is_val):
+    """
+    Calculate the characters intersection of the split (like print_intersection) without joining the texts.
+    Params:
+        patches (list): The list of [path, text].
+        is_val (np.ndarray): The boolean mask of the val patches.
+    Returns:
+        (dict): The sizes and the percentages of val characters in train and of train characters in val.
+    """
+    counts, _ = occurrence_matrix([text for _, text in patches])
+    in_train = np.asarray(counts[~is_val].sum(axis=0)).ravel() > 0
+    in_val = np.asarray(counts[is_val].sum(axis=0)).ravel() > 0
+    in_both = np.count_nonzero(in_train & in_val)
+    return {
+        'train_size': int(np.count_nonzero(~is_val)),
+        'val_size': int(np.count_nonzero(is_val)),
+        'val_chars_in_train': in_both / max(np.count_nonzero(in_val), 1) * 100,
+        'train_chars_in_val': in_both / max(np.count_nonzero(in_train), 1) * 100,
+    }
+
+
+def write_split(patches, is_val, target_dir, train_name='Train.txt', val_name='Validate.txt'):
+    """
+    Write the train & val label files in one pass over the patches.
+    Params:
+        patches (list): The list of [path, text].
+        is_val (np.ndarray): The boolean mask of the val patches.
+        target_dir (str): The folder of the label files.
+    """
+    train_path, val_path = os.path.join(target_dir, train_name), os.path.join(target_dir, val_name)
+    with open(train_path, 'w', encoding='utf-8') as train_file, open(val_path, 'w', encoding='utf-8') as val_file:
+        for (path, text), to_val in zip(patches, is_val.tolist()):
+            (val_file if to_val else train_file).write(f'{path}\t{text}\n')
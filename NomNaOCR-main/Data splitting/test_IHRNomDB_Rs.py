@@ -0,0 +1,55 @@
+from collections import Counter
+import numpy as np
+import pytest
+from IHRNomDB_Rs import calculate_r_scores, max_N, frequence_in_D
+
+
+def loop_max_N(dataset):
+    # The loop used before the sparse matrix version, as the reference
+    max_score = 0
+    vocab = dict(Counter(''.join(dataset)).most_common())
+    for s in dataset:
+        vocab_not_s = vocab.copy()
+        for word in s: vocab_not_s[word] -= 1
+        max_score = max(max_score, sum([vocab_not_s[word] for word in set(s)]))
+    return max_score
+
+
+def loop_r_scores(dataset):
+    vob = [elm[1] for elm in dataset]
+    max_score = loop_max_N(vob)
+    vocab = dict(Counter(''.join(vob)).most_common())
+    results = []
+    for s in dataset:
+        vocab_not_s = vocab.copy()
+        for word in s[1]: vocab_not_s[word] -= 1
+        sum_word_distinct = sum([vocab_not_s[word] for word in set(s[1])])
+        sum_word = sum([vocab_not_s[word] for word in s[1]])
+        results.append([s[0], s[1], sum_word_distinct * max_score + sum_word])
+    return results
+
+
+def random_corpus(seed, num_sentences=200):
+    # Few characters (many repeated in & across the sentences), some outside the BMP, some empty sentences
+    rng = np.random.default_rng(seed)
+    chars = [chr(0x4E00 + i) for i in range(40)] + ['𠀀', '𡗶', 'a']
+    return [
+        [f'patch_{i}.jpg', ''.join(rng.choice(chars, size=rng.integers(0, 15)))]
+        for i in range(num_sentences)
+    ]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_r_scores_match_the_previous_loop(seed):
+    dataset = random_corpus(seed)
+    assert calculate_r_scores(dataset) == loop_r_scores(dataset)
+    assert max_N([s for _, s in dataset]) == loop_max_N([s for _, s in dataset])
+
+
+def test_small_corpora():
+    for dataset in [[], [['a.jpg', '']], [['a.jpg', '門門公']], [['a.jpg', '門公'], ['b.jpg', '公以衛公']]]:
+        assert calculate_r_scores(dataset) == loop_r_scores(dataset)
+
+
+def test_frequence_in_D():
+    assert frequence_in_D(['門公', '公以衛公', ''], '公') == ''.join(['門公', '公以衛公']).count('公') == 3
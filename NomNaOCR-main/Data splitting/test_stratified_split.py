@@ -0,0 +1,26 @@
+import numpy as np
+from stratified_split import stratified_split, split_coverage
+
+
+def make_patches(num_patches=2000, seed=0):
+    # Zipf-like characters, so some of them only appear in a few patches
+    rng = np.random.default_rng(seed)
+    chars = [chr(0x4E00 + i) for i in range(300)]
+    weights = 1 / np.arange(1, len(chars) + 1)
+    return [
+        [f'patch_{i}.jpg', ''.join(rng.choice(chars, size=rng.integers(1, 12), p=weights / weights.sum()))]
+        for i in range(num_patches)
+    ]
+
+
+def test_val_characters_covered_by_train():
+    patches = make_patches()
+    is_val = stratified_split(patches, val_ratio=0.2, min_coverage=1.0, seed=0)
+    coverage = split_coverage(patches, is_val)
+    assert coverage['val_chars_in_train'] == 100
+    assert abs(coverage['val_size'] / len(patches) - 0.2) < 0.02
+
+
+def test_same_seed_same_split():
+    patches = make_patches()
+    np.testing.assert_array_equal(stratified_split(patches, seed=1), stratified_split(patches, seed=1))
@@ -1,31 +1,65 @@
 import os
 import re
-import ast
+import glob
+import json
+import time
 import shutil
+import hashlib
 from tqdm.notebook import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from label_io import parse_line
 
 
 def read_patches(path):
     path_file = re.findall(r'Patches\/(.*)?\/', path)[0]
     with open(path, 'r', encoding='utf-8') as f:
-        
-        
+        lines = (line.rstrip('\n').split('\t') for line in f if line.strip())
+        return [[f'{path_file}/{img_path}', text] for img_path, text in lines]
+
+
 def read_pages(text):
-    url, list_dict = text.split('\t')
-    list_dict = ast.literal_eval(
-        list_dict.replace('\n', '')
-        .replace('false', 'False')
-        .replace('true', 'True')
-    )
+    url, list_dict = parse_line(text) # JSON or Python literals
     return [url, list_dict]
 
 
-def split_pages(source_paths, target):
+def link_or_copy(source, target):
+    # Hard link the file (no bytes copied), or copy it (with its mtime) if the target is on another device
+    if os.path.exists(target):
+        if os.path.samefile(source, target): return 'skipped'
+        os.remove(target)
+    try: os.link(source, target)
+    except OSError: 
+        shutil.copy2(source, target)
+        return 'copied'
+    return 'linked'
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_file(source, target, use_hash=False):
+    # Only link / copy the file if the target is missing or differs (size & mtime, or content hash)
+    source_stat = os.stat(source)
+    if os.path.exists(target):
+        target_stat = os.stat(target)
+        is_same = source_stat.st_size == target_stat.st_size and (
+            file_digest(source) == file_digest(target) if use_hash 
+            else source_stat.st_mtime_ns == target_stat.st_mtime_ns
+        )
+        if is_same: return 'skipped', source_stat.st_size
+    return link_or_copy(source, target), source_stat.st_size
+
+
+def split_pages(source_paths, target, max_workers=16):
     folder_imgs = 'imgs'
     folder_labels = 'gts'
-    target_path = []
+    target_path, copies = [], []
     
-    for source_label in tqdm(source_paths):
+    for source_label in source_paths:
         dir_name = re.findall(r'.*\/label_text\/(.*)\/label_?', source_label)[0]
         label_name = os.path.basename(source_label)
         img_name = label_name.replace('txt', 'jpg')
@@ -34,28 +68,62 @@ def split_pages(source_paths, target):
         target_label = os.path.join(target, dir_name, folder_labels, label_name)
         target_img = os.path.join(target, dir_name, folder_imgs, img_name)
         tool_img = os.path.join(target, 'PPOCRLabel', dir_name, folder_imgs, img_name)
-
-        shutil.copy(source_label, target_label)
-        shutil.copy(source_img, target_img)
-        shutil.copy(source_img, tool_img)
+        copies.extend([(source_label, target_label), (source_img, target_img), (source_img, tool_img)])
 
         target_path.append([
             target_img.replace('/tmp/Pages/', ''), 
             target_label.replace('/tmp/Pages/', '')
         ])
+
+    # The files are independent, so they are linked / copied in parallel (I/O bound)
+    for folder in {os.path.dirname(target) for _, target in copies}: os.makedirs(folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(tqdm(executor.map(lambda paths: link_or_copy(*paths), copies), total=len(copies)))
     return target_path
 
 
-def split_patches(labels):
-    for elm in tqdm(labels):
+def split_patches(labels, path_source, path_target, max_workers=16, use_hash=False, manifest_path=None):
+    ''' Materialize the patches of the split manifest (lines of "path\ttext" or paths) in path_target.
+    Unchanged patches are skipped, so re-splitting after a label fix only touches the changed ones.
+    Returns a manifest with the status & bytes of each patch and the totals / timing of the run.
+    '''
+    start_time = time.perf_counter()
+    copies = []
+    for elm in labels:
         path = elm.split('\t')[0]
-        source = os.path.join(PATH_SOURCE, path)
+        source = os.path.join(path_source, path)
         source = source.replace('crop_img/', '')
 
         target = path.replace('crop_img/', '')
         target = target.replace('_crop', '')
-        target = os.path.join(PATH_TARGET, target)
-        shutil.copy(source, target)
+        target = os.path.join(path_target, target)
+        copies.append((source, target))
+
+    for folder in {os.path.dirname(target) for _, target in copies}: os.makedirs(folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor: # Bounded pool, the work is I/O bound
+        results = list(tqdm(
+            executor.map(lambda paths: sync_file(*paths, use_hash=use_hash), copies), 
+            total = len(copies)
+        ))
+
+    files = [
+        {'source': source, 'target': target, 'status': status, 'bytes': num_bytes}
+        for (source, target), (status, num_bytes) in zip(copies, results)
+    ]
+    totals = {status: 0 for status in ('linked', 'copied', 'skipped')}
+    for file in files: totals[file['status']] += 1
+    manifest = {
+        **totals,
+        'bytes': sum(file['bytes'] for file in files),
+        'bytes_written': sum(file['bytes'] for file in files if file['status'] == 'copied'),
+        'seconds': time.perf_counter() - start_time,
+        'files': files,
+    }
+
+    if manifest_path:
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
         
         
 def check_pages_quality():
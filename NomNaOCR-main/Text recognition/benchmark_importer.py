@@ -0,0 +1,95 @@
+# Times DataImporter (parsing, remove_rare_chars & the parsed samples cache) on a synthetic labels file,
+# against the previous version: os.path.getsize & a regex compiled per line, recursive remove_rare_chars
+import os
+import re
+import time
+import argparse
+import tempfile
+import numpy as np
+from string import printable
+from collections import Counter
+from loader import DataImporter, NOT_NOM_CHARS
+
+
+class PreviousDataImporter(DataImporter):
+    def __init__(self, dataset_dir, labels_path, min_length=4):
+        img_paths, labels = [], []
+        with open(labels_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                img_name, text = line.rstrip('\n').split('\t')
+                img_path = os.path.join(dataset_dir, img_name)
+                text = text.strip().lower()
+                if os.path.getsize(img_path) and len(text) >= min_length and self.is_clean_text(text):
+                    img_paths.append(img_path)
+                    labels.append(text)
+        self.img_paths, self.labels = np.array(img_paths), np.array(labels)
+        self.vocabs = dict(Counter(''.join(self.labels)).most_common())
+        self.size = len(self.labels)
+
+
+    def remove_rare_chars(self, threshold=1):
+        if threshold < 2: return self
+        rare_chars = [char for char, freq in reversed(self.vocabs.items()) if freq < threshold]
+        idxs_to_remove = [idx for idx, label in enumerate(self.labels) if any(char in label for char in rare_chars)]
+        self.img_paths = np.delete(self.img_paths, np.array(idxs_to_remove, dtype=int))
+        self.labels = np.delete(self.labels, np.array(idxs_to_remove, dtype=int))
+        self.vocabs = dict(Counter(''.join(self.labels)).most_common())
+        self.size = len(self.labels)
+        smallest_freq = list(self.vocabs.values())[-1] if self.vocabs else threshold + 1
+        return self.remove_rare_chars(threshold) if smallest_freq < threshold else self
+
+
+    def is_clean_text(self, text):
+        pattern = re.compile(f'[{NOT_NOM_CHARS}{re.escape(printable)}]')
+        return not bool(re.search(pattern, text.lower()))
+
+
+def write_dataset(dataset_dir, labels_path, num_lines, num_images, num_chars, seed=0):
+    # Labels of 4 to 20 Zipf-distributed characters, several lines per image like the patches of a page
+    rng = np.random.default_rng(seed)
+    os.makedirs(dataset_dir, exist_ok=True)
+    for i in range(num_images):
+        with open(os.path.join(dataset_dir, f'{i}.jpg'), 'wb') as file: file.write(b'\xff\xd8image')
+
+    chars = np.array([chr(0x4E00 + i) for i in range(num_chars)])
+    probs = 1 / np.arange(1, num_chars + 1)
+    lengths = rng.integers(4, 21, num_lines)
+    text_chars = rng.choice(chars, size=lengths.sum(), p=probs / probs.sum())
+    starts = np.concatenate([[0], np.cumsum(lengths)])
+    with open(labels_path, 'w', encoding='utf-8') as file:
+        for i in range(num_lines):
+            file.write(f'{i % num_images}.jpg\t{"".join(text_chars[starts[i]:starts[i + 1]])}\n')
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1_000_000)
+    parser.add_argument('--images', type=int, default=100_000)
+    parser.add_argument('--chars', type=int, default=6000)
+    parser.add_argument('--threshold', type=int, default=200)
+    parser.add_argument('--skip_previous', action='store_true', help='The previous remove_rare_chars takes minutes')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_dir, labels_path = os.path.join(tmp_dir, 'patches'), os.path.join(tmp_dir, 'labels.txt')
+        write_dataset(dataset_dir, labels_path, args.lines, args.images, args.chars)
+
+        dataset, init_time = timed(lambda: DataImporter(dataset_dir, labels_path))
+        dataset, remove_time = timed(lambda: dataset.remove_rare_chars(args.threshold))
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        DataImporter(dataset_dir, labels_path, cache_dir=cache_dir)
+        _, cached_time = timed(lambda: DataImporter(dataset_dir, labels_path, cache_dir=cache_dir))
+        print(f'after:  init {init_time:.1f}s, remove_rare_chars {remove_time:.1f}s, persisted init {cached_time:.1f}s')
+
+        if not args.skip_previous:
+            previous, init_time = timed(lambda: PreviousDataImporter(dataset_dir, labels_path))
+            previous, remove_time = timed(lambda: previous.remove_rare_chars(args.threshold))
+            print(f'before: init {init_time:.1f}s, remove_rare_chars {remove_time:.1f}s')
+            assert np.array_equal(previous.labels, dataset.labels) and previous.vocabs == dataset.vocabs
+            print('Same samples and vocabs')
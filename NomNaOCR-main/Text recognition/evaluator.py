@@ -1,5 +1,6 @@
 import os
 import csv
+import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
 from loader import DataImporter
@@ -12,7 +13,15 @@ class Evaluator:
         self.tf_dataset = None
         
         
-    def evaluate(self, data_handler, batch_size, drop_remainder=False):
+    def evaluate(self, data_handler, batch_size, drop_remainder=False, cache_dir=None):
+        self.data_handler = data_handler
+        if cache_dir: # Reuse the preprocessed samples on disk instead of decoding the images again
+            images, tokens = data_handler.load_disk_cache(cache_dir, self.dataset.img_paths, self.dataset.labels)
+            self.tf_dataset = data_handler.disk_cache_dataset(
+                images, tokens, np.arange(self.dataset.size), batch_size, drop_remainder
+            )
+            return self.model.evaluate(self.tf_dataset, return_dict=True)
+
         self.tf_dataset = tf.data.Dataset.from_tensor_slices((self.dataset.img_paths, self.dataset.labels))
         self.tf_dataset = self.tf_dataset.map(
             lambda img_path, label: (
@@ -21,7 +30,6 @@ class Evaluator:
             ), num_parallel_calls = tf.data.AUTOTUNE
         ).batch(batch_size, drop_remainder=drop_remainder)
         
-        self.data_handler = data_handler
         self.tf_dataset = self.tf_dataset.cache().prefetch(tf.data.AUTOTUNE)  
         return self.model.evaluate(self.tf_dataset, return_dict=True)
     
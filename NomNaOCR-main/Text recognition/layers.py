@@ -1,12 +1,20 @@
 import tensorflow as tf
 from tensorflow.keras.layers import (
     Convolution2D, MaxPooling2D, BatchNormalization, Dense, Multiply,
-    Activation, LeakyReLU, Reshape, Permute, Lambda, RepeatVector
+    Activation, LeakyReLU, Reshape, Permute, Lambda, RepeatVector, Rescaling
 )
 
 
+def image_normalization(image_input, name='normalization'):
+    # First layer for the uint8 images of DataHandler(keep_uint8=True) => Input(..., dtype='uint8'). 
+    # The float32 conversion and [0, 1] scaling are then done on the device instead of the host
+    if image_input.dtype != tf.uint8: return image_input # Already normalized by the DataHandler
+    return Rescaling(1 / 255.0, name=name)(image_input)
+
+
 def custom_cnn(config, image_input, alpha=0):
     # Generate Convolutional blocks by config
+    image_input = image_normalization(image_input)
     for idx, (block_name, block_config) in enumerate(config.items()):
         num_conv, filters, pool_size = block_config.values()
         for conv_idx in range(1, num_conv + 1):
@@ -1,5 +1,7 @@
 import os
 import re
+import json
+import hashlib
 import numpy as np
 import tensorflow as tf
 
@@ -8,59 +10,109 @@ from string import printable
 from collections import defaultdict, Counter
 
 
+# Compiled once: Vietnamese letters, whitespaces, Latin letters, numbers and punctuations are not Nom
+NOT_NOM_CHARS = r'\sáàảãạăắằẳẵặâấầẩẫậéèẻẽẹêếềểễệóòỏõọôốồổỗộơớờởỡợíìỉĩịúùủũụưứừửữựýỳỷỹỵđ'
+NOT_NOM_PATTERN = re.compile(f'[{NOT_NOM_CHARS}{re.escape(printable)}]')
+
+
 class DataImporter:
-    def __init__(self, dataset_dir, labels_path, min_length=4):
-        self.img_paths, self.labels = [], []
+    def __init__(self, dataset_dir, labels_path, min_length=4, cache_dir=None):
+        file_stats = self._scan_file_stats(dataset_dir)
+        cache_path = None
+        if cache_dir: cache_path = self._get_cache_path(cache_dir, dataset_dir, labels_path, min_length, file_stats)
+        if cache_path and os.path.exists(cache_path): # Same labels file, images and min_length
+            with np.load(cache_path) as cache: 
+                self.img_paths, self.labels = cache['img_paths'], cache['labels']
+        else:
+            self.img_paths, self.labels = self._parse_labels(dataset_dir, labels_path, min_length, file_stats)
+            if cache_path: self._save_cache(cache_path)
+
+        assert len(self.img_paths) == len(self.labels), 'img_paths and labels must have same size'
+        self.vocabs = dict(Counter(''.join(self.labels)).most_common())
+        self.size = len(self.labels)
+
+
+    def _parse_labels(self, dataset_dir, labels_path, min_length, file_stats):
+        img_paths, labels = [], []
         with open(labels_path, 'r', encoding='utf-8') as file:
             for line in file:
                 img_name, text = line.rstrip('\n').split('\t')
                 img_path = os.path.join(dataset_dir, img_name)
                 text = text.strip().lower()
 
-                if os.path.getsize(img_path) and len(text) >= min_length and self.is_clean_text(text):
-                    self.img_paths.append(img_path)
-                    self.labels.append(text)
-        
-        assert len(self.img_paths) == len(self.labels), 'img_paths and labels must have same size'
-        self.img_paths = np.array(self.img_paths)
-        self.labels = np.array(self.labels)
-        self.vocabs = dict(Counter(''.join(self.labels)).most_common())
-        self.size = len(self.labels)
+                # Names with sub-folders or not found by the scan fall back to a stat (raises if missing)
+                img_size, _ = file_stats.get(img_name, (None, None))
+                if img_size is None: img_size = os.path.getsize(img_path)
+                if img_size and len(text) >= min_length and self.is_clean_text(text):
+                    img_paths.append(img_path)
+                    labels.append(text)
+        return np.array(img_paths), np.array(labels)
+
+
+    @staticmethod
+    def _scan_file_stats(dataset_dir):
+        # One pass over the folder instead of an os.path.getsize for each line of the labels file => name: (size, mtime)
+        with os.scandir(dataset_dir) as entries:
+            return {
+                entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns) 
+                for entry in entries if entry.is_file()
+            }
+
+
+    @staticmethod
+    def _get_cache_path(cache_dir, dataset_dir, labels_path, min_length, file_stats):
+        # The parsed samples are only reused if the labels file and each image (size & mtime) are unchanged. 
+        # The folder mtime is not enough: it does not change when an image is rewritten in place
+        labels_stat = os.stat(labels_path)
+        cache_key = hashlib.sha1(json.dumps({
+            'dataset_dir': os.path.abspath(dataset_dir),
+            'file_stats': sorted(file_stats.items()),
+            'labels_path': os.path.abspath(labels_path),
+            'labels_mtime': labels_stat.st_mtime_ns,
+            'labels_size': labels_stat.st_size,
+            'min_length': min_length,
+        }).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir, f'importer_{cache_key}.npz')
+
+
+    def _save_cache(self, cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.tmp.npz' # Written then renamed so that a partial file is never loaded
+        np.savez(tmp_path, img_paths=self.img_paths, labels=self.labels)
+        os.replace(tmp_path, cache_path)
 
 
     def remove_rare_chars(self, threshold=1):
         if threshold < 2: return self
-        rare_chars, idxs_to_remove = [], []
-        is_satisfy_threshold = True
-
-        # Vocabs need to be sorted (for faster checking)
-        for char, freq in reversed(self.vocabs.items()):
-            if freq < threshold: rare_chars.append(char)
-            else: break
-
+        char_freqs = Counter(self.vocabs)
+        char2idxs = defaultdict(list) # Inverted index: character => samples containing it
         for idx, label in enumerate(self.labels):
-            if any((char in label) for char in rare_chars):
-                idxs_to_remove.append(idx)
+            for char in set(label): char2idxs[char].append(idx)
+
+        # Removing a sample lowers the frequencies of its characters, which can make them rare in turn. 
+        # Each sample is removed at most once, so the fixed point is reached in linear time
+        is_removed = np.zeros(self.size, dtype=bool)
+        rare_chars = [char for char, freq in char_freqs.items() if freq < threshold]
+        while rare_chars:
+            for idx in char2idxs.pop(rare_chars.pop(), []):
+                if is_removed[idx]: continue
+                is_removed[idx] = True
+                for char, count in Counter(self.labels[idx]).items():
+                    char_freqs[char] -= count
+                    if char_freqs[char] < threshold <= char_freqs[char] + count: rare_chars.append(char)
 
         # Remove sentences containing rare characters and recalculate the vocab frequencies
-        idxs_to_remove = np.array(idxs_to_remove)
-        self.img_paths = np.delete(self.img_paths, idxs_to_remove)
-        self.labels = np.delete(self.labels, idxs_to_remove)
+        self.img_paths = self.img_paths[~is_removed]
+        self.labels = self.labels[~is_removed]
 
         assert len(self.img_paths) == len(self.labels), 'img_paths and labels must have same size'
         self.vocabs = dict(Counter(''.join(self.labels)).most_common())
         self.size = len(self.labels)
-
-        # Check if there are still rare characters after removing sentences
-        smallest_freq = threshold + 1 # If vocabs is empty, the smallest frequency always > threshold
-        if len(self.vocabs) >= 1: smallest_freq = list(self.vocabs.values())[-1] 
-        return self.remove_rare_chars(threshold) if smallest_freq < threshold else self
+        return self
 
 
     def is_clean_text(self, text):
-        not_nom_chars = r'\sáàảãạăắằẳẵặâấầẩẫậéèẻẽẹêếềểễệóòỏõọôốồổỗộơớờởỡợíìỉĩịúùủũụưứừửữựýỳỷỹỵđ'
-        pattern = re.compile(f'[{not_nom_chars}{re.escape(printable)}]')
-        return not bool(re.search(pattern, text.lower()))
+        return not bool(NOT_NOM_PATTERN.search(text.lower()))
 
 
     def __str__(self):
@@ -74,12 +126,21 @@ class DataImporter:
 
 
 class DataHandler:
-    def __init__(self, dataset: DataImporter, img_size: tuple, padding_char, start_char='', end_char=''):
+    def __init__(
+        self, 
+        dataset: DataImporter, 
+        img_size: tuple, 
+        padding_char, 
+        start_char = '', 
+        end_char = '', 
+        keep_uint8 = False # Keep images as uint8 => Input(dtype='uint8'), normalized in custom_cnn / get_imagenet_model
+    ):
         self.img_paths = dataset.img_paths
         self.labels = dataset.labels
         self.vocabs = dataset.vocabs
 
         self.img_size = img_size
+        self.keep_uint8 = keep_uint8
         self.padding_char = padding_char
         self.start_char = start_char
         self.end_char = end_char
@@ -114,6 +175,12 @@ class DataHandler:
         token_mask[np.array(mask_idxs)] = True
         self.token_mask = token_mask
 
+        # Lookup table from tokens to texts for a whole batch in tokens2texts. [PAD], [START], [END]
+        # and blank label (-1 => the extra last item) are mapped to empty strings to be stripped
+        strip_idxs = [0] if self.start_token is None else [0, int(self.start_token), int(self.end_token)]
+        self.num2text = np.array(self.char2num.get_vocabulary() + [''], dtype=object)
+        self.num2text[strip_idxs] = ''
+
 
     def distortion_free_resize(self, image, align_top=True):
         h, w = self.img_size
@@ -145,6 +212,7 @@ class DataHandler:
 
 
     def process_image(self, img_path, img_align_top=True):
+        if self.keep_uint8: return self.read_resized_image(img_path, img_align_top)
         image = tf.io.read_file(img_path)
         image = tf.image.decode_jpeg(image, 3)
         image = self.distortion_free_resize(image, img_align_top)
@@ -152,9 +220,18 @@ class DataHandler:
         return image
 
 
-    def process_label(self, label):
+    def read_resized_image(self, img_path, img_align_top=True):
+        # Same as process_image but rounded back to uint8 pixels, which is 4x smaller to store
+        image = tf.io.read_file(img_path)
+        image = tf.image.decode_jpeg(image, 3)
+        image = self.distortion_free_resize(image, img_align_top)
+        return tf.saturate_cast(tf.round(image), tf.uint8)
+
+
+    def process_label(self, label, pad=True):
         label = self.char2num(tf.strings.unicode_split(label, input_encoding='UTF-8'))
         label = tf.concat([self.start_concat, label, self.end_concat], 0)
+        if not pad: return label # Padded later by the batch when bucketing
         label_length = tf.shape(label, tf.int64)[0]
         label = tf.pad(
             label, 
@@ -164,36 +241,146 @@ class DataHandler:
         return label
 
 
-    def prepare_tf_dataset(self, idxs, batch_size, drop_remainder=False, img_align_top=True, use_cache=True):
+    def prepare_tf_dataset(
+        self, 
+        idxs, 
+        batch_size, 
+        drop_remainder = False, 
+        img_align_top = True, 
+        use_cache = True, 
+        cache_dir = None,
+        bucket_boundaries = None # Label lengths (with [START] and [END]) to pad the batches to, e.g. [6, 10, 14]
+    ):
         self.batch_size = batch_size
+        if cache_dir: # Stream from the preprocessed samples on disk, built once for all runs and folds
+            images, tokens = self.load_disk_cache(cache_dir, self.img_paths, self.labels, img_align_top)
+            return self.disk_cache_dataset(images, tokens, idxs, batch_size, drop_remainder, bucket_boundaries)
+
         dataset = tf.data.Dataset.from_tensor_slices((self.img_paths[idxs], self.labels[idxs])).map(
             lambda img_path, label: (
                 self.process_image(img_path, img_align_top), 
-                self.process_label(label)
+                self.process_label(label, pad=not bucket_boundaries)
             ), num_parallel_calls = tf.data.AUTOTUNE
-        ).batch(batch_size, drop_remainder=drop_remainder)
+        )
+
+        if bucket_boundaries: 
+            dataset = self.bucket_by_label_length(
+                dataset, lambda image, label: tf.shape(label)[0], ([*self.img_size, 3], [None]),
+                bucket_boundaries, batch_size, drop_remainder
+            )
+        else: dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
 
         # When use .cache(), everything before is saved in the memory. It gives a 
         # significant boost in speed but only if you can get your hands on a larger RAM
+        # (4 times smaller with keep_uint8 = True as the images are not converted to float32)
         if use_cache: dataset = dataset.cache()
         return dataset.prefetch(tf.data.AUTOTUNE)  
 
 
-    def tokens2texts(self, batch_tokens, use_ctc_decode=False):
-        batch_texts = []
+    def load_disk_cache(self, cache_dir, img_paths, labels, img_align_top=True):
+        ''' Memory-mapped uint8 images (resized & padded) and encoded labels of the given samples.
+        They are saved in a sub-folder of cache_dir named by the hash of everything they depend on 
+        (samples, img_size, alignment, vocabulary), so it is only built once for each configuration.
+        '''
+        cache_key = hashlib.sha1(json.dumps({
+            'img_paths': list(map(str, img_paths)),
+            'labels': list(map(str, labels)),
+            'img_size': list(self.img_size),
+            'img_align_top': img_align_top,
+            'vocabulary': self.char2num.get_vocabulary(),
+            'max_length': self.max_length,
+        }, ensure_ascii=False).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, cache_key)
+        images_path = os.path.join(cache_path, 'images.npy')
+        tokens_path = os.path.join(cache_path, 'tokens.npy')
+
+        if not os.path.exists(os.path.join(cache_path, 'meta.json')): # meta.json is written last
+            os.makedirs(cache_path, exist_ok=True)
+            images = np.lib.format.open_memmap(
+                images_path, mode='w+', dtype=np.uint8, 
+                shape = (len(img_paths), *self.img_size, 3)
+            )
+            tokens = np.lib.format.open_memmap(
+                tokens_path, mode='w+', dtype=np.int64, 
+                shape = (len(labels), self.max_length)
+            )
+
+            dataset = tf.data.Dataset.from_tensor_slices((img_paths, labels)).map(
+                lambda img_path, label: (
+                    self.read_resized_image(img_path, img_align_top), 
+                    self.process_label(label)
+                ), num_parallel_calls = tf.data.AUTOTUNE
+            ).batch(256).prefetch(tf.data.AUTOTUNE)
+
+            start = 0
+            for batch_images, batch_tokens in dataset:
+                end = start + len(batch_images)
+                images[start:end], tokens[start:end] = batch_images.numpy(), batch_tokens.numpy()
+                start = end
+
+            images.flush()
+            tokens.flush()
+            del images, tokens
+            with open(os.path.join(cache_path, 'meta.json'), 'w', encoding='utf-8') as file:
+                json.dump({'size': len(labels), 'img_size': list(self.img_size), 'img_align_top': img_align_top}, file)
+        return np.load(images_path, mmap_mode='r'), np.load(tokens_path, mmap_mode='r')
+
+
+    def disk_cache_dataset(self, images, tokens, idxs, batch_size, drop_remainder=False, bucket_boundaries=None):
+        # Each batch is gathered from the memory-mapped arrays, so there is no more decoding or resizing
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if bucket_boundaries: # Bucket the indexes, then cut the tokens of each batch to its bucket length
+            pad_lengths = np.array(self.get_bucket_lengths(bucket_boundaries))
+            dataset = tf.data.Dataset.from_tensor_slices((idxs, np.count_nonzero(tokens[idxs], axis=1)))
+            dataset = self.bucket_by_label_length(
+                dataset, lambda idx, length: tf.cast(length, tf.int32), ([], []),
+                bucket_boundaries, batch_size, drop_remainder
+            )
+        else: 
+            dataset = tf.data.Dataset.from_tensor_slices((idxs, np.zeros_like(idxs)))
+            dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+
+        def gather_batch(batch_idxs, batch_lengths):
+            if not bucket_boundaries: return images[batch_idxs], tokens[batch_idxs]
+            pad_length = pad_lengths[np.searchsorted(pad_lengths, batch_lengths.max())]
+            return images[batch_idxs], tokens[batch_idxs, :pad_length]
+
+        def load_batch(batch_idxs, batch_lengths):
+            batch_images, batch_tokens = tf.numpy_function(
+                gather_batch, [batch_idxs, batch_lengths], [tf.uint8, tf.int64]
+            )
+            batch_images.set_shape([batch_size if drop_remainder else None, *images.shape[1:]])
+            batch_tokens.set_shape([batch_size if drop_remainder else None, None if bucket_boundaries else tokens.shape[1]])
+            if self.keep_uint8: return batch_images, batch_tokens
+            return tf.cast(batch_images, tf.float32) / 255.0, batch_tokens
+        return dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+    def get_bucket_lengths(self, bucket_boundaries):
+        # Lengths the batches are padded to, the last bucket contains the labels longer than all boundaries
+        return sorted(length for length in set(bucket_boundaries) if length < self.max_length) + [self.max_length]
+
+
+    def bucket_by_label_length(
+        self, dataset, length_func, padded_shapes, bucket_boundaries, batch_size, drop_remainder=False
+    ):
+        # Group the samples by label length and pad each batch only to the length of its bucket, so 
+        # the decoder loops can skip the steps after it (the models use the width of batch_tokens)
+        bucket_lengths = self.get_bucket_lengths(bucket_boundaries)
+        return dataset.bucket_by_sequence_length(
+            element_length_func = length_func,
+            bucket_boundaries = [length + 1 for length in bucket_lengths], # Padded to boundary - 1
+            padded_shapes = padded_shapes, # The None dimensions are padded to the bucket length
+            bucket_batch_sizes = [batch_size] * (len(bucket_lengths) + 1),
+            pad_to_bucket_boundary = True,
+            drop_remainder = drop_remainder,
+        )
+
+
+    def tokens2texts(self, batch_tokens, use_ctc_decode=False, ctc_beam_width=1):
         if use_ctc_decode: 
-            batch_tokens = ctc_decode(batch_tokens, self.max_length)
-
-        # Iterate over the results and get back the text
-        for tokens in batch_tokens:
-            indices = tf.gather(tokens, tf.where(tf.logical_and(
-                tokens != 0, # For [PAD] token
-                tokens != -1 # For blank label if use_ctc_decode 
-            )))
-
-            # Convert to string
-            text = tf.strings.reduce_join(self.num2char(indices)) 
-            text = text.numpy().decode('utf-8')
-            text = text.replace(self.start_char, '').replace(self.end_char, '')
-            batch_texts.append(text)
-        return batch_texts 
+            batch_tokens = ctc_decode(batch_tokens, self.max_length, ctc_beam_width)
+
+        # Map the whole (batch_size, max_length) tokens matrix at once, then join the characters of each row
+        batch_chars = self.num2text[np.asarray(batch_tokens, dtype=np.int64)]
+        return [''.join(chars) for chars in batch_chars]
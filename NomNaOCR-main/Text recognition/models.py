@@ -3,13 +3,17 @@
 import tensorflow as tf
 from tensorflow.keras.models import clone_model
 from abc import abstractmethod, ABCMeta # For define pure virtual functions
+from layers import image_normalization
 from utils import update_tensor_column
 
 
-def get_imagenet_model(model_name, input_shape):
-    # Pick a model from https://keras.io/api/applications
+def get_imagenet_model(model_name, input_shape, input_dtype='float32'):
+    # Pick a model from https://keras.io/api/applications. With input_dtype='uint8' (DataHandler(keep_uint8=True)),
+    # its input takes the uint8 images and normalizes them with layers.image_normalization
     base_model = eval('tf.keras.applications.' + model_name)
-    return base_model(input_shape=input_shape, weights=None, include_top=False)
+    if input_dtype != 'uint8': return base_model(input_shape=input_shape, weights=None, include_top=False)
+    image_input = tf.keras.Input(shape=input_shape, dtype=input_dtype)
+    return base_model(input_tensor=image_normalization(image_input), weights=None, include_top=False)
 
 
 class CustomTrainingModel(tf.keras.Model, metaclass=ABCMeta):
@@ -57,11 +61,24 @@ class CustomTrainingModel(tf.keras.Model, metaclass=ABCMeta):
     @tf.function
     def _update_metrics(self, batch):
         batch_images, batch_tokens = batch
-        predictions = self.predict(batch_images) 
+        predictions = self.predict(batch_images, max_length=self._get_seq_length(batch_tokens)) 
         self.compiled_metrics.update_state(batch_tokens, predictions)
         return {m.name: m.result() for m in self.metrics}
 
 
+    @staticmethod
+    def _get_batch_size(batch_images):
+        # Bucketed batches (DataHandler.bucket_by_label_length) do not have a static batch size
+        return batch_images.shape[0] or tf.shape(batch_images)[0]
+
+
+    @staticmethod
+    def _get_seq_length(batch_tokens):
+        # Static if the batch is padded to max_length, dynamic if bucketed (DataHandler.bucket_by_label_length). 
+        # The decoder loops keep running to max_length but the steps after seq_length are skipped (tf.cond)
+        return batch_tokens.shape[1] or tf.shape(batch_tokens)[1]
+
+
     @tf.function
     def _init_seq_tokens(self, batch_size, return_new_tokens=True):
         seq_tokens = tf.fill([batch_size, self.data_handler.max_length], self.data_handler.start_token)
@@ -75,6 +92,80 @@ class CustomTrainingModel(tf.keras.Model, metaclass=ABCMeta):
         return seq_tokens, new_tokens, done
 
 
+    @abstractmethod
+    def _init_decoder_state(self, batch_images):
+        # Return everything the decoder needs to run one step, as a nested structure of tensors whose
+        # first dimension is the batch (so beam_search can repeat and reorder it by hypotheses)
+        pass # Pure virtual functions => Must be overridden in the derived classes
+
+
+    @abstractmethod
+    def _decoder_step(self, seq_tokens, state, pos_idx):
+        # Return the logits (batch_size, vocab_size) for position `pos_idx` and the updated state
+        pass # Pure virtual functions => Must be overridden in the derived classes
+
+
+    @staticmethod
+    def _normalize_scores(log_probs, lengths, length_penalty):
+        # GNMT length normalization: https://arxiv.org/abs/1609.08144 (no normalization if length_penalty == 0)
+        if length_penalty == 0: return log_probs
+        return log_probs / tf.pow((5.0 + lengths) / 6.0, length_penalty)
+
+
+    @tf.function
+    def beam_search(self, batch_images, beam_width=3, length_penalty=0.0, return_scores=False):
+        ''' Decode batch_size * beam_width hypotheses at once as tensors, beam_width = 1 is greedy decoding.
+        A hypothesis stops growing after the `END_TOKEN` and only produces padding token like in predict()
+        '''
+        batch_size = self._get_batch_size(batch_images)
+        num_hyps = batch_size * beam_width
+        vocab_size = self.data_handler.token_mask.shape[0]
+        seq_tokens, done = self._init_seq_tokens(num_hyps, return_new_tokens=False)
+        state = tf.nest.map_structure( # Repeat the state of each image for all of its beams
+            lambda tensor: tf.repeat(tensor, beam_width, axis=0), 
+            self._init_decoder_state(batch_images)
+        )
+
+        # Only the first beam is alive at the start, otherwise all beams would pick the same tokens
+        log_probs = tf.tile([[0.0] + [float('-inf')] * (beam_width - 1)], [batch_size, 1]) # (batch_size, beam_width)
+        lengths = tf.zeros([batch_size, beam_width], dtype=tf.float32)
+        pad_log_probs = tf.where(tf.range(vocab_size) == 0, 0.0, float('-inf')) # Finished hypotheses only produce padding
+        beam_offsets = tf.range(batch_size)[:, tf.newaxis] * beam_width
+
+        for i in range(1, self.data_handler.max_length):
+            y_pred, state = self._decoder_step(seq_tokens, state, i)
+            y_pred = tf.where(self.data_handler.token_mask, float('-inf'), y_pred)
+            step_log_probs = tf.where(done, pad_log_probs, tf.nn.log_softmax(y_pred, axis=-1))
+            step_log_probs = tf.reshape(step_log_probs, [batch_size, beam_width, vocab_size])
+
+            # Rank the candidates of all beams of an image together => (batch_size, beam_width * vocab_size)
+            candidate_log_probs = log_probs[:, :, tf.newaxis] + step_log_probs
+            alive = 1.0 - tf.cast(tf.reshape(done, [batch_size, beam_width, 1]), tf.float32)
+            candidate_lengths = tf.broadcast_to(lengths[:, :, tf.newaxis] + alive, tf.shape(candidate_log_probs))
+            candidate_log_probs = tf.reshape(candidate_log_probs, [batch_size, -1])
+            candidate_lengths = tf.reshape(candidate_lengths, [batch_size, -1])
+            candidate_scores = self._normalize_scores(candidate_log_probs, candidate_lengths, length_penalty)
+
+            _, top_idxs = tf.math.top_k(candidate_scores, k=beam_width)
+            log_probs = tf.gather(candidate_log_probs, top_idxs, batch_dims=1)
+            lengths = tf.gather(candidate_lengths, top_idxs, batch_dims=1)
+            new_tokens = tf.reshape(tf.cast(top_idxs % vocab_size, tf.int64), [num_hyps, 1])
+
+            # Reorder the hypotheses to follow the beams they were expanded from
+            hyp_idxs = tf.reshape(top_idxs // vocab_size + beam_offsets, [-1])
+            seq_tokens = update_tensor_column(tf.gather(seq_tokens, hyp_idxs), new_tokens, i)
+            done = tf.gather(done, hyp_idxs) | (new_tokens == self.data_handler.end_token)
+            state = tf.nest.map_structure(lambda tensor: tf.gather(tensor, hyp_idxs), state)
+            if tf.executing_eagerly() and tf.reduce_all(done): break
+
+        # Pick the best hypothesis of each image after length normalization
+        scores = self._normalize_scores(log_probs, lengths, length_penalty)
+        best_idxs = tf.argmax(scores, axis=-1, output_type=tf.int32)
+        seq_tokens = tf.gather(seq_tokens, best_idxs + beam_offsets[:, 0])
+        if not return_scores: return seq_tokens
+        return seq_tokens, tf.reduce_max(scores, axis=-1)
+
+
     @tf.function
     def _update_seq_tokens(self, y_pred, seq_tokens, done, pos_idx, return_new_tokens=True):
         # Set the logits for all masked tokens to -inf, so they are never chosen
@@ -122,30 +213,32 @@ class EncoderDecoderModel(CustomTrainingModel):
     @tf.function
     def _compute_loss_and_metrics(self, batch, is_training=False):
         batch_images, batch_tokens = batch
-        batch_size = batch_images.shape[0]
+        batch_size = self._get_batch_size(batch_images)
         loss = tf.constant(0.0)
         
-        dec_input = tf.expand_dims([self.data_handler.start_token] * batch_size, 1) 
+        dec_input = tf.fill([batch_size, 1], self.data_handler.start_token)
         if self.dec_rnn_name: # If there is no rnn in encoder, the hidden state will be initialized with 0
             enc_output = self.encoder(batch_images, training=is_training)
             dec_units = self.decoder.get_layer(self.dec_rnn_name).units
             hidden = tf.zeros((batch_size, dec_units), dtype=tf.float32)
         else: enc_output, hidden = self.encoder(batch_images, training=is_training)
             
+        seq_length = self._get_seq_length(batch_tokens)
         for i in range(1, self.data_handler.max_length):
-            # Passing the features through the decoder
-            y_pred, hidden, _ = self.decoder([dec_input, enc_output, hidden], training=is_training)
-            loss += self.loss(batch_tokens[:, i], y_pred) 
-            dec_input = tf.expand_dims(batch_tokens[:, i], 1) # Use teacher forcing
+            if i < seq_length: # Passing the features through the decoder
+                y_pred, hidden, _ = self.decoder([dec_input, enc_output, hidden], training=is_training)
+                loss += self.loss(batch_tokens[:, i], y_pred) 
+                dec_input = tf.expand_dims(batch_tokens[:, i], 1) # Use teacher forcing
         
         # Update training display result
         metrics = self._update_metrics(batch)
-        return loss, {'loss': loss / self.data_handler.max_length, **metrics}
+        return loss, {'loss': loss / tf.cast(seq_length, tf.float32), **metrics} # Per step of this (bucketed) batch
     
 
     @tf.function
-    def predict(self, batch_images, return_attention=False):
-        batch_size = batch_images.shape[0]
+    def predict(self, batch_images, return_attention=False, max_length=None):
+        batch_size = self._get_batch_size(batch_images)
+        if max_length is None: max_length = self.data_handler.max_length
         seq_tokens, new_tokens, done = self._init_seq_tokens(batch_size)
         attentions = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
 
@@ -156,15 +249,32 @@ class EncoderDecoderModel(CustomTrainingModel):
         else: enc_output, hidden = self.encoder(batch_images, training=False)
 
         for i in range(1, self.data_handler.max_length):
-            y_pred, hidden, attention_weights = self.decoder([new_tokens, enc_output, hidden], training=False)
-            attentions = attentions.write(i - 1, attention_weights)
-            seq_tokens, new_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i)
+            if i < max_length: # Skip the steps after the length of the (bucketed) batch
+                y_pred, hidden, attention_weights = self.decoder([new_tokens, enc_output, hidden], training=False)
+                attentions = attentions.write(i - 1, attention_weights)
+                seq_tokens, new_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i)
             if tf.executing_eagerly() and tf.reduce_all(done): break
 
+        seq_tokens = seq_tokens[:, :max_length]
         if not return_attention: return seq_tokens
         return seq_tokens, tf.transpose(tf.squeeze(attentions.stack()), [1, 0, 2])
 
 
+    def _init_decoder_state(self, batch_images):
+        if self.dec_rnn_name: 
+            enc_output = self.encoder(batch_images, training=False)
+            dec_units = self.decoder.get_layer(self.dec_rnn_name).units
+            hidden = tf.zeros((self._get_batch_size(batch_images), dec_units), dtype=tf.float32)
+        else: enc_output, hidden = self.encoder(batch_images, training=False)
+        return {'enc_output': enc_output, 'hidden': hidden}
+
+
+    def _decoder_step(self, seq_tokens, state, pos_idx):
+        new_tokens = seq_tokens[:, pos_idx - 1:pos_idx] # Only the last token is fed to the rnn decoder
+        y_pred, hidden, _ = self.decoder([new_tokens, state['enc_output'], state['hidden']], training=False)
+        return y_pred, {'enc_output': state['enc_output'], 'hidden': hidden}
+
+
 class EarlyBindingCaptioner(CustomTrainingModel):
     def __init__(
         self, 
@@ -188,20 +298,25 @@ class EarlyBindingCaptioner(CustomTrainingModel):
 
 
     @tf.function
-    def _loop(self, batch_images, batch_tokens=None, is_training=False):
-        batch_size = batch_images.shape[0]
+    def _loop(self, batch_images, batch_tokens=None, is_training=False, max_length=None):
+        batch_size = self._get_batch_size(batch_images)
         seq_tokens, done = self._init_seq_tokens(batch_size, return_new_tokens=False)
         features = self.cnn_block(batch_images, training=is_training)
         loss = tf.constant(0.0)
+
+        # The rnn_block always sees max_length - 1 tokens, only the steps after the (bucketed) length are skipped
+        if batch_tokens is not None: max_length = self._get_seq_length(batch_tokens)
+        elif max_length is None: max_length = self.data_handler.max_length
             
         for i in range(1, self.data_handler.max_length):
-            y_pred = self.rnn_block([seq_tokens[:, :-1], features], training=is_training)
-            seq_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i, return_new_tokens=False)
-            if batch_tokens is not None: loss += self.loss(batch_tokens[:, i], y_pred) # Is training
-            elif tf.executing_eagerly() and tf.reduce_all(done): break # Is predicting
+            if i < max_length:
+                y_pred = self.rnn_block([seq_tokens[:, :-1], features], training=is_training)
+                seq_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i, return_new_tokens=False)
+                if batch_tokens is not None: loss += self.loss(batch_tokens[:, i], y_pred) # Is training
+            if batch_tokens is None and tf.executing_eagerly() and tf.reduce_all(done): break # Is predicting
 
-        if batch_tokens is None: return seq_tokens
-        return loss / self.data_handler.max_length
+        if batch_tokens is None: return seq_tokens[:, :max_length]
+        return loss / tf.cast(max_length, tf.float32) # Per step of this (bucketed) batch
 
 
     @tf.function
@@ -213,5 +328,13 @@ class EarlyBindingCaptioner(CustomTrainingModel):
 
     
     @tf.function
-    def predict(self, batch_images):
-        return self._loop(batch_images)
+    def predict(self, batch_images, max_length=None):
+        return self._loop(batch_images, max_length=max_length)
+
+
+    def _init_decoder_state(self, batch_images):
+        return {'features': self.cnn_block(batch_images, training=False)}
+
+
+    def _decoder_step(self, seq_tokens, state, pos_idx):
+        return self.rnn_block([seq_tokens[:, :-1], state['features']], training=False), state
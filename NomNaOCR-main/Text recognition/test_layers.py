@@ -0,0 +1,30 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Input
+from layers import custom_cnn
+from models import get_imagenet_model
+
+CONV_BLOCKS_CONFIG = {'block1': {'num_conv': 1, 'filters': 4, 'pool_size': 2}}
+
+
+def test_uint8_input_normalized_in_the_model():
+    # DataHandler(keep_uint8=True) images give the same features as the float32 images scaled on the host
+    images = np.random.default_rng(0).integers(0, 256, (2, 8, 16, 3), dtype=np.uint8)
+    tf.keras.utils.set_random_seed(0)
+    uint8_input = Input(shape=(8, 16, 3), dtype='uint8')
+    uint8_model = tf.keras.Model(uint8_input, custom_cnn(CONV_BLOCKS_CONFIG, uint8_input))
+    float_input = Input(shape=(8, 16, 3), dtype='float32')
+    float_model = tf.keras.Model(float_input, custom_cnn(CONV_BLOCKS_CONFIG, float_input))
+    float_model.set_weights(uint8_model.get_weights())
+
+    np.testing.assert_allclose(
+        uint8_model(images, training=False).numpy(),
+        float_model(images.astype(np.float32) / 255.0, training=False).numpy(),
+        rtol=1e-5, atol=1e-6,
+    )
+
+
+def test_imagenet_model_takes_uint8_images():
+    model = get_imagenet_model('MobileNetV2', (32, 32, 3), input_dtype='uint8')
+    assert model.input.dtype == tf.uint8
+    assert model(np.zeros((1, 32, 32, 3), dtype=np.uint8)).shape[0] == 1
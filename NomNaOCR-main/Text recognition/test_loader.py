@@ -0,0 +1,162 @@
+import os
+from types import SimpleNamespace
+from collections import Counter
+import numpy as np
+import pytest
+import tensorflow as tf
+from loader import DataImporter, DataHandler
+
+NOM_CHARS = [chr(0x4E00 + i) for i in range(30)]
+
+
+def write_dataset(tmp_path, labels, empty_images=()):
+    # A labels file and an image per label, the images listed in empty_images are empty files
+    dataset_dir = tmp_path / 'patches'
+    dataset_dir.mkdir(exist_ok=True)
+    with open(tmp_path / 'labels.txt', 'w', encoding='utf-8') as file:
+        for i, label in enumerate(labels):
+            (dataset_dir / f'{i}.jpg').write_bytes(b'' if i in empty_images else b'\xff\xd8image')
+            file.write(f'{i}.jpg\t{label}\n')
+    return str(dataset_dir), str(tmp_path / 'labels.txt')
+
+
+def random_labels(seed, size=300):
+    rng = np.random.default_rng(seed)
+    probs = 1 / np.arange(1, len(NOM_CHARS) + 1) # Zipf-distributed => many rare characters
+    return [''.join(rng.choice(NOM_CHARS, size=rng.integers(4, 10), p=probs / probs.sum())) for _ in range(size)]
+
+
+def recursive_remove_rare_chars(dataset, threshold):
+    # The version before the inverted index, as the reference
+    if threshold < 2: return dataset
+    rare_chars = [char for char, freq in reversed(dataset.vocabs.items()) if freq < threshold]
+    idxs_to_remove = [idx for idx, label in enumerate(dataset.labels) if any(char in label for char in rare_chars)]
+    dataset.img_paths = np.delete(dataset.img_paths, np.array(idxs_to_remove, dtype=int))
+    dataset.labels = np.delete(dataset.labels, np.array(idxs_to_remove, dtype=int))
+    dataset.vocabs = dict(Counter(''.join(dataset.labels)).most_common())
+    dataset.size = len(dataset.labels)
+    smallest_freq = list(dataset.vocabs.values())[-1] if dataset.vocabs else threshold + 1
+    return recursive_remove_rare_chars(dataset, threshold) if smallest_freq < threshold else dataset
+
+
+@pytest.mark.parametrize('seed, threshold', [(0, 5), (1, 20), (2, 60), (3, 1000)])
+def test_remove_rare_chars_matches_the_recursive_version(tmp_path, seed, threshold):
+    dataset_dir, labels_path = write_dataset(tmp_path, random_labels(seed))
+    expected = recursive_remove_rare_chars(DataImporter(dataset_dir, labels_path), threshold)
+    dataset = DataImporter(dataset_dir, labels_path).remove_rare_chars(threshold)
+    np.testing.assert_array_equal(dataset.img_paths, expected.img_paths)
+    np.testing.assert_array_equal(dataset.labels, expected.labels)
+    assert dataset.vocabs == expected.vocabs and dataset.size == expected.size
+    assert all(freq >= threshold for freq in dataset.vocabs.values())
+
+
+def test_samples_filtered_when_parsing(tmp_path):
+    labels = ['門公以衛', '門公', 'abcd門公', '公以衛公', '衛公以門']
+    dataset_dir, labels_path = write_dataset(tmp_path, labels, empty_images={3})
+    dataset = DataImporter(dataset_dir, labels_path) # Too short, not Nom & empty image are dropped
+    assert [os.path.basename(path) for path in dataset.img_paths] == ['0.jpg', '4.jpg']
+    assert list(dataset.labels) == ['門公以衛', '衛公以門']
+    assert dataset.remove_rare_chars(2).size == 2 and dataset.remove_rare_chars(3).size == 0 # Each character twice
+
+
+def test_importer_cache(tmp_path, monkeypatch):
+    labels = random_labels(4, size=20)
+    dataset_dir, labels_path = write_dataset(tmp_path, labels)
+    cache_dir = str(tmp_path / 'cache')
+    dataset = DataImporter(dataset_dir, labels_path, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    def parse_labels(*args): raise AssertionError('parsed again')
+    with monkeypatch.context() as context:
+        context.setattr(DataImporter, '_parse_labels', parse_labels)
+        cached = DataImporter(dataset_dir, labels_path, cache_dir=cache_dir)
+    np.testing.assert_array_equal(cached.img_paths, dataset.img_paths)
+    np.testing.assert_array_equal(cached.labels, dataset.labels)
+    assert cached.vocabs == dataset.vocabs
+
+    # An image emptied in place leaves the folder mtime unchanged, but not its own size & mtime
+    dataset_stat = os.stat(dataset_dir)
+    open(os.path.join(dataset_dir, '0.jpg'), 'wb').close()
+    os.utime(dataset_dir, ns=(dataset_stat.st_atime_ns, dataset_stat.st_mtime_ns))
+    assert DataImporter(dataset_dir, labels_path, cache_dir=cache_dir).size == dataset.size - 1
+    assert DataImporter(dataset_dir, labels_path, min_length=6, cache_dir=cache_dir).size < dataset.size - 1
+    assert len(os.listdir(cache_dir)) == 3
+
+
+def data_handler(labels, use_start_end=True, **kwargs):
+    dataset = SimpleNamespace(
+        img_paths = np.array([f'{i}.jpg' for i in range(len(labels))]), 
+        labels = np.array(labels), 
+        vocabs = dict(Counter(''.join(labels)).most_common()),
+    )
+    start_end = ('[START]', '[END]') if use_start_end else ('', '')
+    return DataHandler(dataset, (8, 32), '[PAD]', *start_end, **kwargs)
+
+
+def tf_tokens2texts(handler, batch_tokens):
+    # The version before the lookup table, as the reference
+    batch_texts = []
+    for tokens in batch_tokens:
+        indices = tf.gather(tokens, tf.where(tf.logical_and(tokens != 0, tokens != -1)))
+        text = tf.strings.reduce_join(handler.num2char(indices)).numpy().decode('utf-8')
+        batch_texts.append(text.replace(handler.start_char, '').replace(handler.end_char, ''))
+    return batch_texts
+
+
+@pytest.mark.parametrize('use_start_end', [True, False])
+def test_tokens2texts_matches_the_tf_version(use_start_end):
+    handler = data_handler(random_labels(5, size=50), use_start_end)
+    vocab_size = handler.char2num.vocab_size() # With [PAD], [UNK] and [START], [END] if used
+    batch_tokens = np.random.default_rng(6).integers(-1, vocab_size, (64, handler.max_length)) # -1: CTC blank label
+    texts = handler.tokens2texts(tf.constant(batch_tokens))
+    assert texts == tf_tokens2texts(handler, tf.constant(batch_tokens))
+    assert handler.tokens2texts(batch_tokens) == texts # Also from NumPy arrays
+    assert any('[UNK]' in text for text in texts) and not any('[START]' in text or '[END]' in text for text in texts)
+
+
+def jpeg_dataset(tmp_path, labels):
+    # Patches of different sizes, so that they are resized & padded differently
+    dataset_dir, labels_path = write_dataset(tmp_path, labels)
+    rng = np.random.default_rng(7)
+    for i in range(len(labels)):
+        image = rng.integers(0, 256, (rng.integers(10, 40), rng.integers(30, 120), 3), dtype=np.uint8)
+        tf.io.write_file(os.path.join(dataset_dir, f'{i}.jpg'), tf.io.encode_jpeg(image))
+    return DataImporter(dataset_dir, labels_path)
+
+
+def collect(dataset):
+    batches = list(dataset.as_numpy_iterator())
+    return np.concatenate([images for images, _ in batches]), np.concatenate([tokens for _, tokens in batches])
+
+
+@pytest.mark.parametrize('keep_uint8', [False, True])
+def test_disk_cache_matches_the_image_pipeline(tmp_path, keep_uint8):
+    dataset = jpeg_dataset(tmp_path, random_labels(8, size=10))
+    handler = DataHandler(dataset, (16, 64), '[PAD]', '[START]', '[END]', keep_uint8=keep_uint8)
+    idxs = [7, 2, 9, 0, 4]
+    images, tokens = collect(handler.prepare_tf_dataset(idxs, 2, use_cache=False))
+    cached_images, cached_tokens = collect(handler.prepare_tf_dataset(idxs, 2, cache_dir=str(tmp_path / 'cache')))
+
+    np.testing.assert_array_equal(cached_tokens, tokens)
+    assert images.dtype == cached_images.dtype == (np.uint8 if keep_uint8 else np.float32)
+    if keep_uint8: np.testing.assert_array_equal(cached_images, images)
+    else: assert np.abs(cached_images - images).max() <= 0.5 / 255 + 1e-6 # Rounded to uint8 pixels on disk
+
+
+def test_load_disk_cache_built_once(tmp_path, monkeypatch):
+    dataset = jpeg_dataset(tmp_path, random_labels(9, size=6))
+    handler = DataHandler(dataset, (16, 64), '[PAD]', '[START]', '[END]')
+    cache_dir = str(tmp_path / 'cache')
+    images, tokens = handler.load_disk_cache(cache_dir, handler.img_paths, handler.labels)
+    assert images.shape == (6, 16, 64, 3) and images.dtype == np.uint8 and isinstance(images, np.memmap)
+    assert tokens.shape == (6, handler.max_length)
+
+    with monkeypatch.context() as context:
+        context.setattr(handler, 'read_resized_image', lambda *args: pytest.fail('built again'))
+        cached_images, cached_tokens = handler.load_disk_cache(cache_dir, handler.img_paths, handler.labels)
+        np.testing.assert_array_equal(cached_images, images)
+        np.testing.assert_array_equal(cached_tokens, tokens)
+
+    # Everything the arrays depend on is in the key, e.g. the alignment of the images
+    handler.load_disk_cache(cache_dir, handler.img_paths, handler.labels, img_align_top=False)
+    assert len(os.listdir(cache_dir)) == 2
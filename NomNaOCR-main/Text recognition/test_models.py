@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras.layers import Input, Reshape, Dense, Embedding, GRU, GlobalAveragePooling1D, Concatenate
+from models import CustomTrainingModel, EncoderDecoderModel
+from transformer import TransformerOCR, TransformerEncoderBlock, TransformerDecoderBlock
+from losses import MaskedLoss
+from metrics import SequenceAccuracy, CharacterAccuracy
+
+IMG_SHAPE = (8, 16, 1)
+RECEPTIVE_SIZE, EMBEDDING_DIM, VOCAB_SIZE, MAX_LENGTH = 4, 8, 12, 7
+
+
+@pytest.fixture
+def data_handler():
+    # What the models use of DataHandler: [PAD] = 0, [UNK] = 1, [START] = 10, [END] = 11
+    token_mask = np.zeros(VOCAB_SIZE, dtype=bool)
+    token_mask[[0, 1, 10]] = True
+    return SimpleNamespace(
+        max_length = MAX_LENGTH,
+        start_token = tf.constant(10, dtype=tf.int64),
+        end_token = tf.constant(11, dtype=tf.int64),
+        token_mask = token_mask,
+    )
+
+
+@pytest.fixture
+def batch_images():
+    return tf.random.stateless_uniform((3, *IMG_SHAPE), seed=(1, 2))
+
+
+def features_model():
+    images = Input(shape=IMG_SHAPE)
+    x = Reshape((RECEPTIVE_SIZE, -1))(images)
+    return tf.keras.Model(images, Dense(EMBEDDING_DIM)(x))
+
+
+def transformer_ocr(data_handler):
+    tf.keras.utils.set_random_seed(0)
+    return TransformerOCR(
+        features_model(),
+        TransformerEncoderBlock(RECEPTIVE_SIZE, 1, 2, EMBEDDING_DIM, 16, 0),
+        TransformerDecoderBlock((RECEPTIVE_SIZE, EMBEDDING_DIM), MAX_LENGTH - 1, VOCAB_SIZE, 2, 2, EMBEDDING_DIM, 16, 0),
+        data_handler,
+    )
+
+
+def rnn_encoder_decoder(data_handler, dec_units=16):
+    tf.keras.utils.set_random_seed(0)
+    new_tokens = Input(shape=(1,), dtype='int64')
+    enc_output = Input(shape=(RECEPTIVE_SIZE, EMBEDDING_DIM))
+    hidden = Input(shape=(dec_units,))
+    x = Concatenate()([Embedding(VOCAB_SIZE, EMBEDDING_DIM)(tf.reshape(new_tokens, [-1])), GlobalAveragePooling1D()(enc_output)])
+    x, new_hidden = GRU(dec_units, return_state=True, name='decoder_rnn')(x[:, tf.newaxis], initial_state=hidden)
+    decoder = tf.keras.Model([new_tokens, enc_output, hidden], [Dense(VOCAB_SIZE)(x), new_hidden, enc_output[:, :, 0]])
+    return EncoderDecoderModel(features_model(), decoder, data_handler, dec_rnn_name='decoder_rnn')
+
+
+def test_kv_cached_predict_matches_full_decoding(data_handler, batch_images):
+    model = transformer_ocr(data_handler)
+    cached = model.predict(batch_images, use_cache=True)
+    full = model.predict(batch_images, use_cache=False)
+    np.testing.assert_array_equal(cached.numpy(), full.numpy())
+
+
+@pytest.mark.parametrize('build_model', [transformer_ocr, rnn_encoder_decoder])
+def test_beam_width_1_matches_greedy(build_model, data_handler, batch_images):
+    model = build_model(data_handler)
+    greedy = model.predict(batch_images)
+    beam = model.beam_search(batch_images, beam_width=1)
+    np.testing.assert_array_equal(beam.numpy(), greedy.numpy())
+
+
+def test_beam_search_scores_at_least_greedy(data_handler, batch_images):
+    model = transformer_ocr(data_handler)
+    _, greedy_scores = model.beam_search(batch_images, beam_width=1, return_scores=True)
+    _, beam_scores = model.beam_search(batch_images, beam_width=4, return_scores=True)
+    assert np.all(beam_scores.numpy() >= greedy_scores.numpy() - 1e-5)
+
+
+def test_beam_search_traces_without_static_batch_size(data_handler, batch_images):
+    # Bucketed / disk-cached datasets and exported graphs only know the batch size at run time
+    model = rnn_encoder_decoder(data_handler)
+    concrete = model.beam_search.get_concrete_function(
+        tf.TensorSpec((None, *IMG_SHAPE), tf.float32), beam_width=2
+    )
+    assert concrete(batch_images).shape == (3, MAX_LENGTH)
+
+
+def labeled_dataset(batch_images, pad_length=None):
+    # [START] 2 3 [END]: shorter than MAX_LENGTH, batches padded to their own length like the bucketed ones
+    tokens = tf.constant([[10, 2, 3, 11], [10, 4, 11, 0], [10, 5, 6, 11]], dtype=tf.int64)
+    return tf.data.Dataset.from_tensor_slices((batch_images, tokens)).padded_batch(
+        3, padded_shapes=(IMG_SHAPE, [pad_length])
+    )
+
+
+@pytest.mark.parametrize('build_model', [transformer_ocr, rnn_encoder_decoder])
+def test_fit_evaluate_predict_on_bucketed_batches(build_model, data_handler, batch_images):
+    model = build_model(data_handler)
+    model.compile(optimizer='adam', loss=MaskedLoss(), metrics=[SequenceAccuracy(), CharacterAccuracy()])
+    bucketed = labeled_dataset(batch_images)
+    assert bucketed.element_spec[1].shape.as_list() == [None, None] # => The decoder steps are skipped with tf.cond
+
+    history = model.fit(bucketed, epochs=2, verbose=0)
+    assert np.all(np.isfinite(history.history['loss']))
+    bucketed_loss = model.evaluate(bucketed, verbose=0, return_dict=True)['loss']
+    padded_loss = model.evaluate(labeled_dataset(batch_images, MAX_LENGTH), verbose=0, return_dict=True)['loss']
+    if isinstance(model, EncoderDecoderModel): # The padded steps add no loss, only the steps taken are averaged
+        np.testing.assert_allclose(bucketed_loss * 4, padded_loss * MAX_LENGTH, rtol=1e-5)
+    else: np.testing.assert_allclose(bucketed_loss, padded_loss, rtol=1e-5) # Already averaged over the tokens
+
+    full = model.predict(batch_images).numpy()
+    short = model.predict.get_concrete_function(
+        tf.TensorSpec((None, *IMG_SHAPE), tf.float32), max_length=tf.TensorSpec([], tf.int32)
+    )(batch_images, tf.constant(4))
+    np.testing.assert_array_equal(short.numpy(), full[:, :4])
+
+
+def test_decoder_steps_must_be_overridden(data_handler):
+    class NoDecoderSteps(CustomTrainingModel):
+        def _compute_loss_and_metrics(self, batch, is_training=False): pass
+        def predict(self, batch_images): pass
+
+    with pytest.raises(TypeError, match='_decoder_step'):
+        NoDecoderSteps(data_handler)
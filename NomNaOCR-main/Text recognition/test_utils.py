@@ -0,0 +1,75 @@
+import csv
+import os
+import pytest
+import tensorflow as tf
+from utils import rec2csv
+
+
+class FakeDataHandler:
+    # The image of a patch is its path length, the predicted text is that length
+    def process_image(self, img_path):
+        return tf.strings.length(img_path)
+
+    def tokens2texts(self, batch_tokens, use_ctc_decode=False):
+        return [str(int(token)) for token in batch_tokens]
+
+
+class FakeModel:
+    name = 'FakeModel'
+
+    def __init__(self, fail_after_batches=None):
+        self.num_batches, self.fail_after_batches = 0, fail_after_batches
+
+    def predict(self, batch_images):
+        if self.num_batches == self.fail_after_batches: raise KeyboardInterrupt
+        self.num_batches += 1
+        return batch_images
+
+
+PATCHES = [f'patch_{"x" * i}.jpg' for i in range(10)]
+
+
+def read_rows(file_name):
+    with open(file_name, encoding='utf-8', newline='') as f: return list(csv.reader(f))
+
+
+def test_resume_after_interruption(tmp_path):
+    file_name = str(tmp_path / 'pred.csv')
+    with pytest.raises(KeyboardInterrupt):
+        rec2csv(file_name, PATCHES, FakeDataHandler(), FakeModel(fail_after_batches=2), batch_size=3)
+    assert len(read_rows(file_name)) == 6 and os.path.exists(file_name + '.ckpt')
+
+    model = FakeModel()
+    rec2csv(file_name, PATCHES, FakeDataHandler(), model, batch_size=3)
+    assert model.num_batches == 2 # Only the 4 remaining patches
+    assert read_rows(file_name) == [[path, str(len(path))] for path in PATCHES]
+    assert not os.path.exists(file_name + '.ckpt')
+
+
+def test_refuse_checkpoint_of_another_job(tmp_path):
+    file_name = str(tmp_path / 'pred.csv')
+    with pytest.raises(KeyboardInterrupt):
+        rec2csv(file_name, PATCHES, FakeDataHandler(), FakeModel(fail_after_batches=1), batch_size=3)
+
+    with pytest.raises(ValueError, match='another job'):
+        rec2csv(file_name, PATCHES[::-1], FakeDataHandler(), FakeModel(), batch_size=3)
+
+    rec2csv(file_name, PATCHES[::-1], FakeDataHandler(), FakeModel(), batch_size=3, resume=False)
+    assert [row[0] for row in read_rows(file_name)] == PATCHES[::-1]
+    assert not os.path.exists(file_name + '.ckpt')
+
+
+def test_checkpoint_removed_when_nothing_remains(tmp_path, monkeypatch):
+    # Stopped after the last batch, before removing the checkpoint => the next run only removes it
+    file_name = str(tmp_path / 'pred.csv')
+    def interrupt(path): raise KeyboardInterrupt
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'remove', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            rec2csv(file_name, PATCHES, FakeDataHandler(), FakeModel(), batch_size=3)
+    assert os.path.exists(file_name + '.ckpt')
+
+    model = FakeModel()
+    rec2csv(file_name, PATCHES, FakeDataHandler(), model, batch_size=3)
+    assert model.num_batches == 0 and len(read_rows(file_name)) == len(PATCHES)
+    assert not os.path.exists(file_name + '.ckpt')
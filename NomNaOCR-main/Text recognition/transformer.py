@@ -41,16 +41,28 @@ class TransformerEmbedding(tf.keras.layers.Layer):
 
 
     def call(self, inputs):
+        seq_length = tf.shape(inputs)[1] # Can be shorter than self.seq_length when the batch is bucketed by length
         if self.positions_embedding: 
-            positions = tf.range(start=0, limit=self.seq_length, delta=1)
+            positions = tf.range(start=0, limit=seq_length, delta=1)
             positions_info = self.positions_embedding(positions)
-        else: positions_info = self.positional_encoding()
+        else: positions_info = self.positional_encoding()[:, :seq_length, :]
 
         if self.tokens_embedding: inputs = self.tokens_embedding(inputs)
         if self.embed_scale is not None: inputs *= self.embed_scale
         return inputs + positions_info
 
 
+    def call_step(self, inputs, position):
+        # Same as call() but only for the newest token at `position`, used for incremental decoding
+        if self.positions_embedding: 
+            positions_info = self.positions_embedding(tf.reshape(position, (1, 1)))
+        else: positions_info = self.positional_encoding()[:, position:position + 1, :]
+
+        if self.tokens_embedding: inputs = self.tokens_embedding(inputs)
+        if self.embed_scale is not None: inputs *= self.embed_scale
+        return inputs + positions_info # (batch_size, 1, embedding_dim)
+
+
     def positional_encoding(self):
         pos = np.arange(self.seq_length)[:, np.newaxis]
         i = np.arange(self.embedding_dim)[np.newaxis, :]
@@ -129,6 +141,53 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         return out3, attn_weights_block1, attn_weights_block2
 
 
+    def init_cache(self, batch_size):
+        # Self-attention keys/values of the tokens decoded so far => (batch_size, 0, num_heads, key_dim) at the start
+        empty_shape = [batch_size, 0, self.mha1._num_heads, self.mha1._key_dim]
+        return {
+            'key': tf.zeros(empty_shape, dtype=tf.float32),
+            'value': tf.zeros(empty_shape, dtype=tf.float32),
+            'mask': tf.zeros([batch_size, 1, 0], dtype=tf.int32), # Padding mask of the cached tokens
+        }
+
+
+    def compute_enc_cache(self, enc_output):
+        # The encoder output does not change while decoding => Project its keys/values only once per batch
+        return {'key': self.mha2._key_dense(enc_output), 'value': self.mha2._value_dense(enc_output)}
+
+
+    def call_step(self, inputs, cache, enc_cache, mask):
+        ''' Incremental version of call() for inference:
+        - inputs: embedding of the newest token only => (batch_size, 1, embedding_dim)
+        - cache: keys/values of the previous tokens from init_cache() or the last call_step()
+        - enc_cache: projected encoder output from compute_enc_cache()
+        - mask: (batch_size, 1) padding mask of the newest token
+        The causal mask is not needed here as the query can only see the cached (previous) tokens
+        '''
+        query_mask = tf.cast(mask[:, :, tf.newaxis], dtype=tf.int32) # (batch_size, 1, 1)
+        cache = {
+            'key': tf.concat([cache['key'], self.mha1._key_dense(inputs)], axis=1),
+            'value': tf.concat([cache['value'], self.mha1._value_dense(inputs)], axis=1),
+            'mask': tf.concat([cache['mask'], query_mask], axis=2),
+        }
+
+        attn1, attn_weights_block1 = self.mha1._compute_attention(
+            self.mha1._query_dense(inputs), cache['key'], cache['value'], 
+            attention_mask=tf.minimum(cache['mask'], query_mask), training=False
+        )
+        out1 = self.layernorm1(self.mha1._output_dense(attn1) + inputs) # (batch_size, 1, embedding_dim)
+
+        attn2, attn_weights_block2 = self.mha2._compute_attention(
+            self.mha2._query_dense(out1), enc_cache['key'], enc_cache['value'], 
+            attention_mask=query_mask, training=False
+        )
+        out2 = self.layernorm2(self.mha2._output_dense(attn2) + out1) # (batch_size, 1, embedding_dim)
+
+        ffn_output = self.ffn(out2) 
+        out3 = self.layernorm3(ffn_output + out2) # (batch_size, 1, embedding_dim)
+        return out3, cache, attn_weights_block1, attn_weights_block2
+
+
     def get_causal_attention_mask(self, inputs):
         input_shape = tf.shape(inputs)
         batch_size, seq_length = input_shape[0], input_shape[1]
@@ -237,19 +296,63 @@ class TransformerOCR(CustomTrainingModel):
 
 
     @tf.function
-    def predict(self, batch_images, return_attention=False):
-        batch_size = batch_images.shape[0]
+    def predict(self, batch_images, return_attention=False, use_cache=True, max_length=None):
+        batch_size = self._get_batch_size(batch_images)
+        if max_length is None: max_length = self.data_handler.max_length
         seq_tokens, done = self._init_seq_tokens(batch_size, return_new_tokens=False)
+
+        # The attention maps over the whole prefix are only available when rerunning the full decoder
+        if use_cache and not return_attention: 
+            state = self._init_decoder_state(batch_images)
+            for i in range(1, self.data_handler.max_length):
+                if i < max_length: # Skip the steps after the length of the (bucketed) batch
+                    y_pred, state = self._decoder_step(seq_tokens, state, i)
+                    seq_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i, return_new_tokens=False)
+                if tf.executing_eagerly() and tf.reduce_all(done): break
+            return seq_tokens[:, :max_length]
+
         features = self.cnn_model(batch_images, training=False) # (batch_size, receptive_size, embedding_dim)
         enc_output = self.encoder(features, training=False) if self.encoder else features
         attentions = []
         
         for i in range(1, self.data_handler.max_length):
-            y_pred, attention_weights = self.decoder([seq_tokens[:, :-1], enc_output], training=False)
-            attentions.append(attention_weights)
-            y_pred = y_pred[:, i - 1, :] # Select last token from seq_length (max_length - 1) dimension (batch_size, 1, vocab_size)
-            seq_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i, return_new_tokens=False)
+            if i < max_length: # Skip the steps after the length of the (bucketed) batch
+                y_pred, attention_weights = self.decoder([seq_tokens[:, :-1], enc_output], training=False)
+                attentions.append(attention_weights)
+                y_pred = y_pred[:, i - 1, :] # Select last token from seq_length (max_length - 1) dimension (batch_size, 1, vocab_size)
+                seq_tokens, done = self._update_seq_tokens(y_pred, seq_tokens, done, i, return_new_tokens=False)
             if tf.executing_eagerly() and tf.reduce_all(done): break
 
+        seq_tokens = seq_tokens[:, :max_length]
         if not return_attention: return seq_tokens
         return seq_tokens, attentions
+
+
+    def _get_decoder_layers(self):
+        # The layers of TransformerDecoderBlock, called one by one when decoding incrementally
+        embedding = [layer for layer in self.decoder.layers if isinstance(layer, TransformerEmbedding)][0]
+        dec_layers = [layer for layer in self.decoder.layers if isinstance(layer, TransformerDecoderLayer)]
+        return embedding, dec_layers, self.decoder.layers[-1] # The last layer is the prediction Dense
+
+
+    def _init_decoder_state(self, batch_images):
+        features = self.cnn_model(batch_images, training=False) # (batch_size, receptive_size, embedding_dim)
+        enc_output = self.encoder(features, training=False) if self.encoder else features
+        _, dec_layers, _ = self._get_decoder_layers()
+        return {
+            'caches': [layer.init_cache(tf.shape(enc_output)[0]) for layer in dec_layers],
+            'enc_caches': [layer.compute_enc_cache(enc_output) for layer in dec_layers],
+        }
+
+
+    def _decoder_step(self, seq_tokens, state, pos_idx):
+        # Only the newest token goes through the decoder, the previous keys/values are cached in the state
+        embedding, dec_layers, prediction = self._get_decoder_layers()
+        new_tokens = seq_tokens[:, pos_idx - 1:pos_idx] # (batch_size, 1)
+        x = embedding.call_step(new_tokens, pos_idx - 1)
+        caches = []
+
+        for layer, cache, enc_cache in zip(dec_layers, state['caches'], state['enc_caches']):
+            x, cache, _, _ = layer.call_step(x, cache, enc_cache, new_tokens != 0)
+            caches.append(cache)
+        return prediction(x)[:, 0, :], {'caches': caches, 'enc_caches': state['enc_caches']} # (batch_size, vocab_size)
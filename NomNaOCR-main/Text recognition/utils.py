@@ -1,14 +1,20 @@
+import os
 import csv
+import json
+import hashlib
 import tensorflow as tf
 from tqdm import tqdm
 
 
-def ctc_decode(predictions, max_length):
+def ctc_decode(predictions, max_length, beam_width=1):
+    # beam_width > 1 => CTC prefix beam search (tf.nn.ctc_beam_search_decoder), keeping only the best path
     input_length = tf.ones(len(predictions)) * predictions.shape[1]
     preds_decoded = tf.keras.backend.ctc_decode(
         predictions,
         input_length = input_length,
-        greedy = True,
+        greedy = beam_width == 1,
+        beam_width = beam_width,
+        top_paths = 1,
     )[0][0][:, :max_length]
     
     return tf.where(
@@ -45,11 +51,56 @@ def sparse2dense(tensor, shape):
     return tensor
 
 
-def rec2csv(file_name, patch_list, data_handler, model, use_ctc_decode=False):
-    with open(file_name, 'w', encoding='utf-8', newline='') as f:
+def _rec2csv_fingerprint(file_name, patch_list, model, use_ctc_decode):
+    # What a checkpoint belongs to: the same patches, output file & model are required to resume
+    fingerprint = hashlib.sha1(json.dumps(
+        [os.path.abspath(file_name), model.name, use_ctc_decode, patch_list], ensure_ascii=False
+    ).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def rec2csv(file_name, patch_list, data_handler, model, use_ctc_decode=False, batch_size=32, resume=True):
+    # Images are decoded and resized in parallel and prefetched while the model predicts the previous batch.
+    # Rows are written after each batch and `{file_name}.ckpt` keeps the progress (number of patches done
+    # and CSV offset), so an interrupted job restarts where it stopped if resume=True. A checkpoint of
+    # another job (other patches, output file or model) is refused instead of skipping the wrong rows
+    ckpt_path = f'{file_name}.ckpt'
+    patch_list = [str(path) for path in patch_list]
+    fingerprint = _rec2csv_fingerprint(file_name, patch_list, model, use_ctc_decode)
+    num_done, csv_offset = 0, 0
+    if resume and os.path.exists(ckpt_path):
+        with open(ckpt_path, 'r') as ckpt_file: ckpt = json.load(ckpt_file)
+        if ckpt.get('fingerprint') != fingerprint:
+            raise ValueError(
+                f'{ckpt_path} belongs to another job (patches, output file or model), '
+                'delete it or use resume=False to start over'
+            )
+        num_done, csv_offset = ckpt['num_done'], ckpt['csv_offset']
+
+    remaining_paths = patch_list[num_done:]
+    if len(remaining_paths) == 0:
+        if os.path.exists(ckpt_path): os.remove(ckpt_path) # Finished before, the checkpoint is not needed anymore
+        return
+    dataset = tf.data.Dataset.from_tensor_slices(remaining_paths).map(
+        data_handler.process_image, 
+        num_parallel_calls = tf.data.AUTOTUNE
+    ).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    with open(file_name, 'r+' if num_done else 'w', encoding='utf-8', newline='') as f, \
+         tqdm(total=len(patch_list), initial=num_done) as progress_bar:
+        f.seek(csv_offset)
+        f.truncate() # Drop the rows written after the last checkpoint
         writer = csv.writer(f)
-        for img_path in tqdm(patch_list):
-            image = data_handler.process_image(img_path)
-            pred_tokens = model.predict(tf.expand_dims(image, axis=0))
+
+        for batch_images in dataset:
+            pred_tokens = model.predict(batch_images)
             pred_labels = data_handler.tokens2texts(pred_tokens, use_ctc_decode)
-            writer.writerow([img_path, pred_labels[0]])
+            writer.writerows(zip(patch_list[num_done:num_done + len(pred_labels)], pred_labels))
+            f.flush()
+
+            num_done += len(pred_labels)
+            with open(f'{ckpt_path}.tmp', 'w') as ckpt_file: 
+                json.dump({'fingerprint': fingerprint, 'num_done': num_done, 'csv_offset': f.tell()}, ckpt_file)
+            os.replace(f'{ckpt_path}.tmp', ckpt_path)
+            progress_bar.update(len(pred_labels))
+    os.remove(ckpt_path) # The job is finished
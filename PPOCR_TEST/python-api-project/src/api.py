@@ -1,64 +1,352 @@
-from test import process_image, export_result
-from flask import Flask, request, jsonify, send_file
-from PIL import Image
+from test import load_ocr, ocr_upload, detect_upload, render_upload, DET_MODEL_DIR, REC_MODEL_DIR
+from test import recognize_lines, filter_lines, sort_boxes, format_detection, format_label
+from ocr_pool import OCRWorkerPool, PoolBusyError, PoolClosedError, PoolTimeoutError
+from micro_batcher import MicroBatcher
+from result_cache import ResultCache, CacheKeysServer, model_version
+from label_io import format_line
+from flask import Flask, Response, request, jsonify, stream_with_context, url_for
+from argparse import ArgumentParser
+import concurrent.futures
+import _thread
+import itertools
+import threading
+import hashlib
 import base64
-from io import BytesIO
-import io
+import signal
+import json
+import time
+import uuid
+import os
 
 
 app = Flask(__name__)
+pool = None # The OCR worker processes, started by start_pool (or create_app)
+batcher = None # Recognition batched across the requests, if rec_batch_size > 1
+cache = None # OCR results by hash of the decoded pixels & model version (ResultCache)
+cache_keys = None # Lets the workers check the cache before recognizing a page (CacheKeysServer)
+in_flight = {} # Upload key => Future of its (key, result), while a request computes them
+in_flight_lock = threading.Lock()
+model_tag = None
+
+
+def start_pool(
+    workers=None, max_queue=None, timeout=60, det_model_dir=DET_MODEL_DIR, rec_model_dir=REC_MODEL_DIR,
+    rec_batch_size=0, rec_max_wait=0.01, stand_in=False, cache_mb=256, cache_db=None
+):
+    global pool, batcher, cache, cache_keys, model_tag
+    model_tag = 'stand-in' if stand_in else model_version(det_model_dir, rec_model_dir)
+    cache = ResultCache(max_bytes=int(cache_mb * (1 << 20)), disk_path=cache_db)
+    cache_keys = CacheKeysServer(cache)
+    model_kwargs = {'det_model_dir': det_model_dir, 'rec_model_dir': rec_model_dir, 'stand_in': stand_in}
+    if rec_batch_size > 1: model_kwargs['rec_batch_num'] = rec_batch_size # A micro-batch is one inference batch
+    pool = OCRWorkerPool(load_ocr, model_kwargs, workers, max_queue, timeout)
+    if rec_batch_size > 1:
+        batcher = MicroBatcher(
+            lambda crops: pool.run(recognize_lines, crops, admit=False),
+            max_batch_size = rec_batch_size,
+            max_wait = rec_max_wait,
+            max_concurrent = pool.workers,
+        )
+    return pool
+
+
+def ocr_batched(data, pool_request, cached_keys=()):
+    # Detection of the uploaded image by a worker, then recognition of its lines with those of the other requests
+    fingerprint, boxes, crops = pool_request.run(detect_upload, data, cached_keys, f'ocr:{model_tag}:')
+    if boxes is None: return fingerprint, None # Same pixels already cached
+    try: recognitions = batcher.map(crops, timeout=pool_request.remaining())
+    except concurrent.futures.TimeoutError: raise PoolTimeoutError(f'No result after {pool_request.timeout} seconds')
+    return fingerprint, filter_lines(boxes, recognitions)
+
+
+def run_ocr(data, pool_request, with_image, cached_keys=()):
+    # => fingerprint of the pixels, (boxes, texts, scores) or None if its key is in `cached_keys`, and the JPEG with
+    # the boxes drawn (if asked, and if drawn by the OCR task)
+    if batcher is None: return pool_request.run(ocr_upload, data, with_image, cached_keys, f'ocr:{model_tag}:')
+    return (*ocr_batched(data, pool_request, cached_keys), None)
+
+
+def ocr_result(data, pool_request, with_image=False):
+    # One OCR pass per image content & model version, shared by all the endpoints & formats: boxes, texts &
+    # scores in the order of the OCR, and the reading order of the lines. The tasks run within `pool_request`
+    upload_key = f'upload:{model_tag}:{hashlib.sha256(data).hexdigest()}' # Same file => known key, without decoding
+    key = cache.get(upload_key)
+    result = cache.get(key) if key is not None else None
+    if result is not None: return key, result, True
+
+    with in_flight_lock: # Single flight: the same file sent again meanwhile waits for this OCR pass
+        future = in_flight.get(upload_key)
+        is_running = future is not None
+        if not is_running: future = in_flight[upload_key] = concurrent.futures.Future()
+    if is_running:
+        try: key, result = future.result(pool_request.remaining())
+        except concurrent.futures.TimeoutError: raise PoolTimeoutError(f'No result after {pool_request.timeout} seconds')
+        return key, result, True
+
+    try:
+        # The pixels are decoded & hashed by the OCR task itself (one decoding per upload), which checks the cache
+        # before the detection: the same page in another file is not recognized again
+        fingerprint, lines, jpeg = run_ocr(data, pool_request, with_image, cache_keys.keys)
+        key = f'ocr:{model_tag}:{fingerprint}'
+        result = cache.get(key) if lines is None else None
+        if lines is None and result is None: # Evicted since the check
+            _, lines, jpeg = run_ocr(data, pool_request, with_image)
+        is_cached = result is not None
+        if not is_cached:
+            boxes, texts, scores = lines
+            result = {'boxes': boxes, 'texts': texts, 'scores': scores, 'order': sort_boxes(boxes)}
+            cache.put(key, result)
+        if jpeg is not None: cache.put(key + ':overlay', jpeg)
+        cache.put(upload_key, key)
+        future.set_result((key, result))
+    except BaseException as error:
+        future.set_exception(error)
+        raise
+    finally:
+        with in_flight_lock: del in_flight[upload_key]
+    return key, result, is_cached
+
+
+def overlay_jpeg(key, result, data, pool_request):
+    # The boxes drawn on the image, rendered by a worker the first time it is asked (within the slot & time
+    # budget of the request that computed the OCR, if not cached)
+    jpeg = cache.get(key + ':overlay')
+    if jpeg is None:
+        jpeg = pool_request.run(render_upload, data, result['boxes'])
+        cache.put(key + ':overlay', jpeg)
+    return jpeg
+
+
+def create_app():
+    # Entry point of other WSGI servers, e.g. `waitress-serve --port 8000 --call api:create_app`, configured by the
+    # OCR_* variables (OCR_WORKERS, OCR_MAX_QUEUE, OCR_TIMEOUT, OCR_REC_BATCH_SIZE, ...). Unlike `python api.py`
+    # (serve), the requests in progress are not drained when the server stops
+    env_int = lambda name: int(os.environ[name]) if os.environ.get(name) else None
+    start_pool(
+        workers = env_int('OCR_WORKERS'),
+        max_queue = env_int('OCR_MAX_QUEUE'),
+        timeout = float(os.environ.get('OCR_TIMEOUT', 60)),
+        det_model_dir = os.environ.get('OCR_DET_MODEL_DIR', DET_MODEL_DIR),
+        rec_model_dir = os.environ.get('OCR_REC_MODEL_DIR', REC_MODEL_DIR),
+        rec_batch_size = env_int('OCR_REC_BATCH_SIZE') or 0,
+        rec_max_wait = float(os.environ.get('OCR_REC_MAX_WAIT', 0.01)),
+        cache_mb = float(os.environ.get('OCR_CACHE_MB', 256)),
+        cache_db = os.environ.get('OCR_CACHE_DB'),
+    )
+    return app
+
+
+@app.errorhandler(PoolBusyError)
+def pool_busy(error):
+    return jsonify({'error': str(error)}), 429, {'Retry-After': '1'}
+
+@app.errorhandler(PoolClosedError)
+def pool_closed(error):
+    return jsonify({'error': str(error)}), 503
+
+@app.errorhandler(PoolTimeoutError)
+def ocr_timeout(error):
+    return jsonify({'error': str(error)}), 504
+
+POOL_ERRORS = (PoolBusyError, PoolClosedError, PoolTimeoutError) # Handled above, with their own status codes
 
 
 @app.route('/upload', methods=['POST'])
 def upload_image():
     try:
-        # Ensure the temp directory exists
-        print("Hello, world!")
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image provided'}), 400
 
+        data = request.files['image'].read()
+        with pool.request() as pool_request:
+            key, result, _ = ocr_result(data, pool_request, with_image=True)
+            jpeg = overlay_jpeg(key, result, data, pool_request)
+
+        return jsonify({
+            'detected_text': format_detection(result['boxes'], result['texts'], result['scores']),
+            'image': base64.b64encode(jpeg).decode('utf-8')  # Image returned as Base64
+        })
+
+    except POOL_ERRORS: raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def multipart(parts):
+    # multipart/mixed body of (headers, bytes) parts, as a list of chunks: the parts are not copied into one buffer
+    boundary = uuid.uuid4().hex
+    chunks = []
+    for headers, body in parts:
+        head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        chunks += [f'--{boundary}\r\n{head}\r\n'.encode('utf-8'), body, b'\r\n']
+    chunks.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return chunks, f'multipart/mixed; boundary={boundary}'
+
+@app.route('/ocr', methods=['POST'])
+def ocr_image():
+    # Single OCR pass, returned as (by the format parameter or the Accept header):
+    # - application/json: the lines in reading order (+ "label" with ?include=label, and the image with its boxes
+    #   drawn with ?include=image (Base64) or ?include=image_url (URL of the JPEG, no Base64 in the response))
+    # - multipart/mixed: the JSON above, then the JPEG image as a binary part
+    # - text/plain: the PPOCRLabel line (Label.txt)
+    # - image/jpeg: the image with its boxes drawn
+    try:
         if 'image' not in request.files:
             return jsonify({'error': 'No image provided'}), 400
-        
+
         image_file = request.files['image']
-        image = Image.open(image_file).convert('RGB')
+        data = image_file.read()
+        formats = {'json': 'application/json', 'multipart': 'multipart/mixed', 'text': 'text/plain', 'image': 'image/jpeg'}
+        mimetype = formats.get(request.args.get('format')) or \
+            request.accept_mimetypes.best_match(list(formats.values()), default='application/json')
+        include = request.args.get('include', '').split(',')
+        with_image = mimetype in ('image/jpeg', 'multipart/mixed') or \
+            (mimetype == 'application/json' and ('image' in include or 'image_url' in include))
+        with pool.request() as pool_request:
+            key, result, is_cached = ocr_result(data, pool_request, with_image)
+            if with_image: jpeg = overlay_jpeg(key, result, data, pool_request) # Same slot & time budget
+        headers = {'X-OCR-Cache': 'hit' if is_cached else 'miss', 'Vary': 'Accept'}
 
-        result = process_image(image)
+        if mimetype == 'text/plain':
+            label = format_line(image_file.filename, format_label(result['boxes'], result['texts']))
+            return Response(label, mimetype='text/plain', headers=headers)
+        if mimetype == 'image/jpeg':
+            return Response(jpeg, mimetype='image/jpeg', headers=headers)
 
-        return jsonify(result)
+        response = {'lines': [
+            {'points': result['boxes'][i], 'text': result['texts'][i], 'confidence': result['scores'][i]}
+            for i in result['order']
+        ]}
+        if 'label' in include:
+            response['label'] = format_line(image_file.filename, format_label(result['boxes'], result['texts']))
+        if mimetype == 'multipart/mixed':
+            chunks, content_type = multipart([
+                ({'Content-Type': 'application/json'}, json.dumps(response, ensure_ascii=False).encode('utf-8')),
+                ({'Content-Type': 'image/jpeg', 'Content-Disposition': 'inline; filename="boxes.jpg"'}, jpeg),
+            ])
+            return Response(chunks, content_type=content_type, headers=headers)
+        if 'image' in include:
+            response['image'] = base64.b64encode(jpeg).decode('utf-8')
+        if 'image_url' in include: # Rendered above, then served from the cache
+            response['image_url'] = url_for('overlay_image', digest=key.rsplit(':', 1)[-1], _external=True)
+        return jsonify(response), 200, headers
 
+    except POOL_ERRORS: raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/ocr/<digest>.jpg', methods=['GET'])
+def overlay_image(digest):
+    # The image with its boxes drawn, as long as it is in the results cache
+    jpeg = cache.get(f'ocr:{model_tag}:{digest}:overlay')
+    if jpeg is None:
+        return jsonify({'error': 'Unknown or expired image'}), 404
+    return Response(jpeg, mimetype='image/jpeg', headers={'Cache-Control': 'max-age=86400'})
+
 @app.route('/', methods=['POST'])
 def EmptyAPI():
     return jsonify({
             'result': 'connect successfully',
         })
 
+@app.route('/health', methods=['GET'])
+def health():
+    stats = pool.stats()
+    if batcher is not None: stats['recognition_batches'] = batcher.stats()
+    stats['cache'] = cache.stats()
+    return jsonify(stats), 503 if stats['closed'] else 200
+
 @app.route('/download-txt', methods=['POST'])
 def download_txt():
+    # Label.txt of the uploaded images (several `image` fields allowed), streamed line by line as they are recognized.
+    # Once the response has started, an image that fails gets the line `<filename>\t{"error": <message>}`
     try:
-        if 'image' not in request.files:
+        image_files = request.files.getlist('image')
+        if not image_files:
             return jsonify({'error': 'No image provided'}), 400
-        
-        image_file = request.files['image']
-        image = Image.open(image_file).convert('RGB')
-        result = export_result(image)
-        
-        file_stream = io.StringIO()
-        file_stream.write(image_file.filename)
-        file_stream.write('\t')
-        file_stream.write(str(result))
-        file_stream.seek(0)
-
-        return send_file(
-            io.BytesIO(file_stream.getvalue().encode('utf-8')),  # Convert to bytes
-            as_attachment=True,  # Enable download
-            download_name="Label.txt",  # File name for download
-            mimetype="text/plain"  # File type
+
+        def labels():
+            # One pool slot for the whole download (still served while the server drains), one time budget per image
+            with pool.request() as pool_request:
+                for index, image_file in enumerate(image_files):
+                    pool_request.restart()
+                    try: _, result, _ = ocr_result(image_file.read(), pool_request)
+                    except Exception as e:
+                        if index == 0: raise
+                        error = json.dumps({'error': str(e)}, ensure_ascii=False)
+                        yield f'{image_file.filename}\t{error}\n'.encode('utf-8')
+                        continue
+                    yield format_line(image_file.filename, format_label(result['boxes'], result['texts'])).encode('utf-8')
+
+        lines = stream_with_context(labels())
+        first_line = next(lines) # The errors of the first image still get their status code
+        return Response(
+            itertools.chain([first_line], lines),
+            mimetype = 'text/plain',
+            headers = {'Content-Disposition': 'attachment; filename=Label.txt'}  # Download as Label.txt
         )
 
+    except POOL_ERRORS: raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def serve(host='0.0.0.0', port=8000, threads=16, drain_timeout=30):
+    # Serves the app (started by start_pool) with waitress until SIGINT / SIGTERM, then shuts down gracefully: the
+    # new requests get 503, the accepted ones finish & their responses are sent (up to drain_timeout seconds), then
+    # the server & the pool stop. A second signal stops at once
+    from waitress import create_server
+    server = create_server(app, host=host, port=port, threads=threads)
+
+    def busy():
+        # Requests of the connections being processed, or whose response is not sent yet
+        return any(
+            getattr(channel, 'requests', None) or getattr(channel, 'total_outbufs_len', 0)
+            for channel in list(server._map.values())
+        )
+
+    def drain():
+        deadline = time.monotonic() + drain_timeout
+        pool.wait(drain_timeout)
+        while busy() and time.monotonic() < deadline: time.sleep(0.05)
+        _thread.interrupt_main() # => stop(), the pool being closed
+
+    def stop(signum, frame):
+        if pool.closed: raise KeyboardInterrupt # Stops the waitress loop
+        pool.close()
+        threading.Thread(target=drain, daemon=True).start()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f'Serving on http://{host}:{port} with {pool.workers} OCR workers', flush=True)
+    try: server.run()
+    finally:
+        server.close()
+        if batcher is not None: batcher.close()
+        pool.shutdown(drain_timeout)
+        cache_keys.close()
+        cache.close()
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    ap = ArgumentParser()
+    ap.add_argument('--host', default='0.0.0.0')
+    ap.add_argument('--port', type=int, default=8000)
+    ap.add_argument('--threads', type=int, default=16, help='HTTP threads of the server (requests handled at once)')
+    ap.add_argument('--workers', type=int, default=None, help='Number of OCR processes (default: number of CPUs)')
+    ap.add_argument('--max_queue', type=int, default=None, help='Requests waiting for a worker before answering 429 (default: 2 per worker)')
+    ap.add_argument('--timeout', type=float, default=60, help='Seconds a request may wait for all its OCR tasks before answering 504')
+    ap.add_argument('--drain_timeout', type=float, default=30, help='Seconds to let the accepted requests finish when stopping')
+    ap.add_argument('--det_model_dir', default=DET_MODEL_DIR)
+    ap.add_argument('--rec_model_dir', default=REC_MODEL_DIR)
+    ap.add_argument('--rec_batch_size', type=int, default=0, help='Maximum number of lines recognized together across the requests (<= 1: no micro-batching)')
+    ap.add_argument('--rec_max_wait', type=float, default=0.01, help='Seconds a micro-batch waits for more lines')
+    ap.add_argument('--stand_in', action='store_true', help='Use a stand-in model instead of PaddleOCR (for testing)')
+    ap.add_argument('--cache_mb', type=float, default=256, help='Size of the in-memory results cache (MB)')
+    ap.add_argument('--cache_db', default=None, help='SQLite file of the on-disk results cache, kept across restarts (default: none)')
+    args = vars(ap.parse_args())
+
+    # Production server (waitress), no debug mode / reloader: it would load the models twice
+    start_pool(
+        args['workers'], args['max_queue'], args['timeout'], args['det_model_dir'], args['rec_model_dir'],
+        args['rec_batch_size'], args['rec_max_wait'], args['stand_in'], args['cache_mb'], args['cache_db']
+    )
+    serve(args['host'], args['port'], args['threads'], args['drain_timeout'])
@@ -0,0 +1,91 @@
+'''
+Dynamic micro-batching of the items submitted by many concurrent requests (the line crops to recognize):
+- A batch is dispatched as soon as it has `max_batch_size` items, or `max_wait` seconds after its first one
+- At most `max_concurrent` batches run at once; while they run, the next items accumulate, so the batches grow
+with the traffic instead of the latency
+- The results of a batch are scattered back to the futures of its items
+'''
+from concurrent.futures import Future, ThreadPoolExecutor
+import concurrent.futures
+import threading
+import queue
+import time
+
+
+class MicroBatcher:
+    def __init__(self, run_batch, max_batch_size=32, max_wait=0.01, max_concurrent=1):
+        # run_batch(list of items) => list of results, in the same order
+        self.run_batch, self.max_batch_size, self.max_wait = run_batch, max_batch_size, max_wait
+        self.items = queue.Queue() # (item, future), None to stop
+        self.slots = threading.Semaphore(max_concurrent)
+        self.executor = ThreadPoolExecutor(max_concurrent)
+        self.num_batches, self.num_items = 0, 0
+        self.thread = threading.Thread(target=self._collect, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, item):
+        future = Future()
+        self.items.put((item, future))
+        return future
+
+
+    def map(self, items, timeout=None):
+        # Submit all the items of a request, then wait for their results (at most `timeout` seconds)
+        futures = [self.submit(item) for item in items]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            return [
+                future.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+                for future in futures
+            ]
+        except concurrent.futures.TimeoutError:
+            for future in futures: future.cancel() # The items not batched yet are dropped
+            raise
+
+
+    def _collect(self):
+        while True:
+            self.slots.acquire() # Wait for a free slot first, the items queued meanwhile join the next batch
+            entry = self.items.get()
+            if entry is None: return
+            batch, deadline = [entry], time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try: entry = self.items.get_nowait() # Already queued => no wait
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: break
+                    try: entry = self.items.get(timeout=remaining)
+                    except queue.Empty: break
+                if entry is None: # Stop after this batch
+                    self.items.put(None)
+                    break
+                batch.append(entry)
+
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            self.num_batches, self.num_items = self.num_batches + 1, self.num_items + len(batch)
+            self.executor.submit(self._run, batch)
+
+
+    def _run(self, batch):
+        try:
+            results = self.run_batch([item for item, _ in batch]) if batch else []
+            if len(results) != len(batch): raise ValueError(f'{len(results)} results for a batch of {len(batch)} items')
+            for (_, future), result in zip(batch, results): future.set_result(result)
+        except Exception as error:
+            for _, future in batch: future.set_exception(error)
+        finally: self.slots.release()
+
+
+    def stats(self):
+        return {
+            'batches': self.num_batches, 'items': self.num_items,
+            'mean_batch_size': self.num_items / max(self.num_batches, 1),
+        }
+
+
+    def close(self):
+        # The items already submitted are still processed
+        self.items.put(None)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
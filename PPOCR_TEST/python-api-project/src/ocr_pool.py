@@ -0,0 +1,150 @@
+'''
+Fixed pool of OCR worker processes, each one holding its own preloaded model:
+- At most `workers + max_queue` requests are accepted at once, the next ones are rejected right away
+(PoolBusyError => HTTP 429) instead of piling up behind the models
+- Each request waits for its results at most `timeout` seconds in all (PoolTimeoutError => HTTP 504)
+- close() stops accepting requests (PoolClosedError => HTTP 503), shutdown() lets the accepted ones finish
+before stopping the workers
+'''
+from concurrent.futures import ProcessPoolExecutor
+import concurrent.futures
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import time
+import os
+
+
+class PoolBusyError(Exception): pass
+class PoolClosedError(Exception): pass
+
+# Also a builtin TimeoutError: concurrent.futures.TimeoutError is another class before Python 3.11
+class PoolTimeoutError(TimeoutError): pass
+
+
+_num_ready = None # Number of workers whose model is loaded, shared by all of them
+
+
+def _load_model(load_model, model_kwargs, num_ready):
+    global _num_ready
+    load_model(**model_kwargs)
+    with num_ready.get_lock(): num_ready.value += 1
+    _num_ready = num_ready
+
+
+def _wait_ready(num_workers):
+    # Keep this worker busy until all of them loaded their model, so each warm up task starts a new one
+    while _num_ready.value < num_workers: time.sleep(0.01)
+    return os.getpid()
+
+
+class OCRWorkerPool:
+    def __init__(self, load_model, model_kwargs=None, workers=None, max_queue=None, timeout=60):
+        # load_model(**model_kwargs) is called once in each worker, the tasks then use the model it loaded
+        self.workers = workers or os.cpu_count()
+        self.max_pending = self.workers + (2 * self.workers if max_queue is None else max_queue)
+        self.timeout = timeout
+        self.num_pending, self.closed = 0, False
+        self.condition = threading.Condition()
+
+        # Spawned (not forked) workers: the server threads & the model runtime are not fork-safe
+        context = multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context = context,
+            initializer = _load_model,
+            initargs = (load_model, model_kwargs or {}, context.Value('i', 0)),
+        )
+        # Start all the workers now & wait for their models, instead of loading them during the first requests
+        self.pids = sorted(set(self.executor.map(_wait_ready, [self.workers] * self.workers)))
+
+
+    def _admit(self):
+        with self.condition:
+            if self.closed: raise PoolClosedError('The OCR server is shutting down')
+            if self.num_pending >= self.max_pending:
+                raise PoolBusyError(f'Too many requests: {self.num_pending} are already being processed or queued')
+            self.num_pending += 1
+
+
+    def submit(self, func, *args, admit=True):
+        if admit: self._admit()
+        try: future = self.executor.submit(func, *args)
+        except Exception:
+            if admit: self._release()
+            raise
+        if admit: future.add_done_callback(self._release)
+        return future
+
+
+    def run(self, func, *args, timeout=None, admit=True):
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(func, *args, admit=admit)
+        try: return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # A queued task is dropped, a running one keeps its worker (and its slot) until it finishes
+            future.cancel()
+            raise PoolTimeoutError(f'No result after {timeout} seconds')
+
+
+    @contextmanager
+    def request(self, timeout=None):
+        # One request made of several tasks (PoolRequest.run), which share a slot & a time budget
+        pool_request = PoolRequest(self, self.timeout if timeout is None else timeout)
+        try: yield pool_request
+        finally:
+            if pool_request.admitted: self._release()
+
+
+    def _release(self, future=None):
+        with self.condition:
+            self.num_pending -= 1
+            self.condition.notify_all()
+
+
+    def stats(self):
+        with self.condition:
+            return {
+                'workers': self.workers, 'pending': self.num_pending,
+                'max_pending': self.max_pending, 'closed': self.closed,
+            }
+
+
+    def close(self):
+        with self.condition: self.closed = True
+
+
+    def wait(self, timeout=None):
+        # Wait for the accepted requests to finish => False if some are still pending after `timeout`
+        with self.condition: return self.condition.wait_for(lambda: self.num_pending == 0, timeout)
+
+
+    def shutdown(self, drain_timeout=None):
+        self.close()
+        self.wait(drain_timeout)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class PoolRequest:
+    # The tasks of one request: admitted once, by its first task (never if all its results are cached), and
+    # given `timeout` seconds in all from the start of the request
+    def __init__(self, pool, timeout):
+        self.pool, self.timeout, self.admitted = pool, timeout, False
+        self.deadline = time.monotonic() + timeout
+
+
+    def restart(self):
+        # Same slot (if admitted), a new time budget: e.g. for the next image of a request with several images
+        self.deadline = time.monotonic() + self.timeout
+
+
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0)
+
+
+    def run(self, func, *args):
+        if not self.admitted:
+            self.pool._admit()
+            self.admitted = True
+        try: return self.pool.run(func, *args, timeout=self.remaining(), admit=False)
+        except PoolTimeoutError: raise PoolTimeoutError(f'No result after {self.timeout} seconds')
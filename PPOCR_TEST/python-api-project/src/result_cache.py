@@ -0,0 +1,164 @@
+'''
+Two tiers cache of the OCR results, by content hash:
+- In memory: LRU evicted by size (the serialized size of the values), so the repeated pages come back in milliseconds
+- On disk (optional): a SQLite file that survives the restarts, evicted by last access when over its size
+- The values are JSON objects or raw bytes (the rendered images); the hits & misses of each tier are counted
+- The worker processes check which keys are cached (RemoteCacheKeys) through a local connection to the server
+'''
+from multiprocessing.connection import Listener, Client
+from collections import OrderedDict
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+
+def model_version(*model_dirs):
+    # Fingerprint of the model files (names, sizes & modification times), so the results of other models are never reused
+    fingerprint = hashlib.sha1()
+    for model_dir in model_dirs:
+        fingerprint.update(model_dir.encode('utf-8'))
+        if not os.path.isdir(model_dir): continue
+        for name in sorted(os.listdir(model_dir)):
+            stat = os.stat(os.path.join(model_dir, name))
+            fingerprint.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return fingerprint.hexdigest()[:16]
+
+
+def _serialize(value):
+    if isinstance(value, bytes): return b'b' + value
+    return b'j' + json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def _deserialize(data):
+    return data[1:] if data[:1] == b'b' else json.loads(data[1:].decode('utf-8'))
+
+
+class ResultCache:
+    def __init__(self, max_bytes=256 << 20, disk_path=None, disk_max_bytes=4 << 30):
+        self.max_bytes, self.disk_max_bytes = max_bytes, disk_max_bytes
+        self.entries = OrderedDict() # key => (value, size), least recently used first
+        self.num_bytes = 0
+        self.counters = dict.fromkeys(['memory_hits', 'disk_hits', 'misses', 'evictions'], 0)
+        self.lock = threading.Lock()
+
+        self.db = None
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self.db = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            self.disk_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return entry[0]
+
+            row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone() if self.db else None
+            if row is None:
+                self.counters['misses'] += 1
+                return None
+            self.db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.counters['disk_hits'] += 1
+            value = _deserialize(row[0])
+            self._put_memory(key, value, len(row[0])) # Promoted to the memory tier
+            return value
+
+
+    def contains(self, key):
+        # Without counting a hit or a miss, nor refreshing the entry
+        with self.lock:
+            if key in self.entries: return True
+            return self.db is not None and \
+                self.db.execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+
+
+    def put(self, key, value):
+        data = _serialize(value)
+        with self.lock:
+            self._put_memory(key, value, len(data))
+            if self.db is None: return
+            previous = self.db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+            self.disk_bytes += len(data) - (previous[0] if previous else 0)
+            while self.disk_bytes > self.disk_max_bytes: # Least recently accessed first
+                rows = self.db.execute('SELECT key, size FROM results ORDER BY accessed LIMIT 64').fetchall()
+                if not rows: break
+                self.db.executemany('DELETE FROM results WHERE key = ?', [(row[0],) for row in rows])
+                self.disk_bytes -= sum(row[1] for row in rows)
+
+
+    def _put_memory(self, key, value, size):
+        if key in self.entries: self.num_bytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes: return # Larger than the whole memory tier
+        self.entries[key] = (value, size)
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted_size
+            self.counters['evictions'] += 1
+
+
+    def stats(self):
+        with self.lock:
+            hits = self.counters['memory_hits'] + self.counters['disk_hits']
+            return {
+                **self.counters, 'hit_rate': hits / max(hits + self.counters['misses'], 1),
+                'memory_entries': len(self.entries), 'memory_bytes': self.num_bytes, 'memory_max_bytes': self.max_bytes,
+                **({'disk_bytes': self.disk_bytes, 'disk_max_bytes': self.disk_max_bytes} if self.db else {}),
+            }
+
+
+    def close(self):
+        if self.db is not None: self.db.close()
+
+
+class CacheKeysServer:
+    # Answers `key in cache` to the worker processes (RemoteCacheKeys), one thread per connection
+    def __init__(self, cache):
+        self.cache, self.authkey = cache, os.urandom(16)
+        self.listener = Listener(authkey=self.authkey)
+        self.keys = RemoteCacheKeys(self.listener.address, self.authkey)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+
+    def _accept(self):
+        while True:
+            try: connection = self.listener.accept()
+            except OSError: return # Closed
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+
+    def _serve(self, connection):
+        with connection:
+            try:
+                while True: connection.send(self.cache.contains(connection.recv()))
+            except (EOFError, OSError): return
+
+
+    def close(self):
+        self.listener.close()
+
+
+_connections = {} # Connection of this (worker) process to each CacheKeysServer, by address
+
+
+class RemoteCacheKeys:
+    # Picklable `key in cache` for the tasks of the worker processes, connected on first use
+    def __init__(self, address, authkey):
+        self.address, self.authkey = address, authkey
+
+
+    def __contains__(self, key):
+        connection = _connections.get(self.address)
+        if connection is None: connection = _connections[self.address] = Client(self.address, authkey=self.authkey)
+        connection.send(key)
+        return connection.recv()
@@ -0,0 +1,39 @@
+'''
+Stand-in for PaddleOCR with the same interface (ocr, text_detector, text_recognizer) and a configurable cost,
+to test & benchmark the server without the models: every other band of `line_height` pixels is a text line,
+and a recognition call costs a fixed overhead plus a cost per crop (like a batched inference)
+'''
+import numpy as np
+import time
+
+
+class StandInOCR:
+    def __init__(self, line_height=40, det_cost=0.05, batch_overhead=0.05, crop_cost=0.002):
+        self.line_height, self.det_cost = line_height, det_cost
+        self.batch_overhead, self.crop_cost = batch_overhead, crop_cost
+
+
+    def text_detector(self, image):
+        start = time.perf_counter()
+        time.sleep(self.det_cost)
+        height, width = image.shape[:2]
+        boxes = [
+            [[10, top], [width - 10, top], [width - 10, top + self.line_height], [10, top + self.line_height]]
+            for top in range(0, height - self.line_height, 2 * self.line_height)
+        ]
+        return np.array(boxes, dtype=np.float32).reshape(-1, 4, 2), time.perf_counter() - start
+
+
+    def text_recognizer(self, crops):
+        start = time.perf_counter()
+        time.sleep(self.batch_overhead + self.crop_cost * len(crops))
+        results = [(f'{crop.shape[1]}x{crop.shape[0]}:{int(crop.mean())}', 0.99) for crop in crops]
+        return results, time.perf_counter() - start
+
+
+    def ocr(self, image, det=True, rec=True, cls=False):
+        # Full pipeline of one image, like PaddleOCR: [[[box, (text, score)], ...]]
+        from test import detect_lines, recognize_lines, filter_lines
+        boxes, crops = detect_lines(image)
+        boxes, texts, scores = filter_lines(boxes, recognize_lines(crops))
+        return [[[box, (text, score)] for box, text, score in zip(boxes, texts, scores)]]
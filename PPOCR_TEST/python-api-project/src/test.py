@@ -1,79 +1,156 @@
-from paddleocr import PaddleOCR, draw_ocr
 import os
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image
 from io import BytesIO
 import base64
+import hashlib
+from label_io import order_points_clockwise
 
-# Initialize PaddleOCR
-ocr = PaddleOCR(
-    # Initialize PaddleOCR
-    det_model_dir='..//..//det//ch_PP-OCRv3_det_infer',  # Model detection
-    rec_model_dir='..//../rec//ch_PP-OCRv3_rec_infer',  # Model recognition
-    use_gpu=False  # Set to True if using GPU
-)
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+DET_MODEL_DIR = os.path.join(MODELS_DIR, 'det', 'ch_PP-OCRv3_det_infer')  # Model detection
+REC_MODEL_DIR = os.path.join(MODELS_DIR, 'rec', 'ch_PP-OCRv3_rec_infer')  # Model recognition
+DROP_SCORE = 0.5  # Lines recognized with a lower score are dropped (like PaddleOCR)
+ocr = None
 
-def sort_box(points):
-    points = np.array(points)  # Convert to numpy array
-    sorted_indices = np.lexsort((points[:, 0], points[:, 1]))  # Sort by y first, then x
-    top_two = points[sorted_indices[:2]]  # Get top 2 points
-    bottom_two = points[sorted_indices[2:]]  # Get bottom 2 points
+def load_ocr(det_model_dir=DET_MODEL_DIR, rec_model_dir=REC_MODEL_DIR, use_gpu=False, rec_batch_num=6, stand_in=False):
+    # Initialize PaddleOCR once per process (the server preloads it in each of its workers)
+    global ocr
+    if ocr is None and stand_in:  # Local model with the same interface, to test the server without PaddleOCR
+        from stand_in import StandInOCR
+        ocr = StandInOCR()
+    elif ocr is None:
+        from paddleocr import PaddleOCR
+        ocr = PaddleOCR(
+            det_model_dir=det_model_dir,
+            rec_model_dir=rec_model_dir,
+            rec_batch_num=rec_batch_num,  # Crops recognized together
+            drop_score=DROP_SCORE,
+            use_gpu=use_gpu  # Set to True if using GPU
+        )
+    return ocr
 
-    # Determine top-left and top-right
-    top_two = top_two[np.argsort(top_two[:, 0])]  # Sort by x
-    top_left, top_right = top_two[0], top_two[1]
+def sort_boxes(boxes):
+    # Order the points of all boxes at once, then the boxes by their ordered points (top-left point first)
+    points = order_points_clockwise(boxes, dtype='float64').reshape(-1, 8)
+    return np.lexsort(points.T[::-1]).tolist()
 
-    # Determine bottom-left and bottom-right
-    bottom_two = bottom_two[np.argsort(bottom_two[:, 0])]  # Sort by x
-    bottom_left, bottom_right = bottom_two[0], bottom_two[1]
+def sorted_boxes(boxes):
+    # Reading order of PaddleOCR: top to bottom, then left to right for the boxes on the same line (10 px)
+    boxes = sorted(boxes, key=lambda box: (box[0][1], box[0][0]))
+    for i in range(len(boxes) - 1):
+        for j in range(i, -1, -1):
+            if abs(boxes[j + 1][0][1] - boxes[j][0][1]) < 10 and boxes[j + 1][0][0] < boxes[j][0][0]:
+                boxes[j], boxes[j + 1] = boxes[j + 1], boxes[j]
+            else: break
+    return boxes
 
-    # Combine according to the rule
-    return [top_left.tolist(), top_right.tolist(), bottom_right.tolist(), bottom_left.tolist()]
+def crop_box(image, box):
+    # Same crop as PaddleOCR (get_rotate_crop_image): the quadrangle warped to a rectangle, vertical lines rotated
+    points = np.array(box, dtype=np.float32)
+    width = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    height = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    target = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    crop = cv2.warpPerspective(
+        image, cv2.getPerspectiveTransform(points, target), (width, height),
+        borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC
+    )
+    return np.rot90(crop) if crop.shape[0] / crop.shape[1] >= 1.5 else crop
 
-def process_image(image):
-    # Perform OCR on the image
-    result = ocr.ocr(np.array(image), det=True, rec=True)
+def detect_lines(image):
+    # Detection only => the boxes in reading order & their crops, to be recognized in batches
+    image = np.asarray(image)
+    dt_boxes, _ = load_ocr().text_detector(image)
+    boxes = sorted_boxes(dt_boxes) if dt_boxes is not None else []
+    return [np.asarray(box).tolist() for box in boxes], [crop_box(image, box) for box in boxes]
+
+def recognize_lines(crops):
+    # Recognition only, of the crops of many requests at once => (text, score) of each crop
+    rec_res, _ = load_ocr().text_recognizer(crops)
+    return [(text, float(score)) for text, score in rec_res]
+
+def filter_lines(boxes, recognitions):
+    # => boxes, texts, scores of the lines kept, like the output of ocr.ocr
+    lines = [(box, text, score) for box, (text, score) in zip(boxes, recognitions) if score >= DROP_SCORE]
+    return [line[0] for line in lines], [line[1] for line in lines], [line[2] for line in lines]
 
-    # Extract coordinates, text, and confidence scores
-    boxes = [line[0] for line in result[0]]
-    texts = [line[1][0] for line in result[0]]
-    scores = [line[1][1] for line in result[0]]
+def ocr_lines(image):
+    # Perform OCR on the image => boxes, texts, scores
+    result = load_ocr().ocr(np.asarray(image), det=True, rec=True)[0] or []
+    return [line[0] for line in result], [line[1][0] for line in result], [line[1][1] for line in result]
 
+def format_detection(boxes, texts, scores):
     # Sort the boxes and reorder texts and scores accordingly
-    sorted_indices = sorted(range(len(boxes)), key=lambda i: sort_box(boxes[i]))
-    boxes = [boxes[i] for i in sorted_indices]
+    sorted_indices = sort_boxes(boxes)
     texts = [texts[i] for i in sorted_indices]
     scores = [scores[i] for i in sorted_indices]
+    return [{'text': text, 'confidence': score} for text, score in zip(texts[::-1], scores[::-1])]
 
-    # Draw bounding boxes on the image
-    draw = ImageDraw.Draw(image)
-    for box in boxes:
-        draw.polygon([tuple(point) for point in box], outline='red')
+def draw_overlay(image, boxes):
+    # Draw bounding boxes in red on a BGR array (in place) => JPEG bytes
+    if len(boxes):
+        points = np.round(np.asarray(boxes, dtype=np.float64)).astype(np.int32)
+        cv2.polylines(image, list(points), isClosed=True, color=(0, 0, 255))
+    _, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 75])
+    return jpeg.tobytes()
 
-    # Convert the result image to Base64
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    result_image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+def draw_jpeg(image, boxes):
+    # Same, on an RGB image (array or PIL) left untouched
+    return draw_overlay(cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR), boxes)
 
-    # Return the result as a dictionary
-    return {
-        'detected_text': [{'text': text, 'confidence': score} for text, score in zip(texts[::-1], scores[::-1])],
-        'image': result_image_base64  # Image returned as Base64
-    }
-
-def export_result(image):
-     # Perform OCR on the image
-    result = ocr.ocr(np.array(image), det=True, rec=True)
-
-    # Extract coordinates, text, and confidence scores
-    boxes = [line[0] for line in result[0]]
-    texts = [line[1][0] for line in result[0]]
-    scores = [line[1][1] for line in result[0]]
+def draw_result(image, boxes):
+    # Convert the result image to Base64
+    return base64.b64encode(draw_jpeg(image, boxes)).decode('utf-8')
 
+def format_label(boxes, texts):
     # Format the result as required
     formatted_result = []
     for box, text in zip(boxes, texts):
         points = [[int(point[0]), int(point[1])] for point in box]
         formatted_result.append({"transcription": text, "points": points})
     return formatted_result
+
+def process_image(image):
+    boxes, texts, scores = ocr_lines(image)
+    return {
+        'detected_text': format_detection(boxes, texts, scores),
+        'image': draw_result(image, boxes)  # Image returned as Base64
+    }
+
+def export_result(image):
+    boxes, texts, _ = ocr_lines(image)
+    return format_label(boxes, texts)
+
+def decode_image(data, rgb=True):
+    # Uploaded file => RGB (or BGR) array, decoded straight from the request buffer, without a PIL image in between
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:  # Formats unknown to OpenCV (e.g. GIF)
+        image = cv2.cvtColor(np.asarray(Image.open(BytesIO(data)).convert('RGB')), cv2.COLOR_RGB2BGR)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image) if rgb else image
+
+def fingerprint_image(image):
+    # Hash of the decoded pixels: the same page re-encoded in another file gets the same key
+    fingerprint = hashlib.blake2b(repr(image.shape).encode('utf-8'), digest_size=16)
+    fingerprint.update(image.data)
+    return fingerprint.hexdigest()
+
+def ocr_upload(data, render=False, cached_keys=(), key_prefix=''):
+    # Uploaded file => fingerprint, (boxes, texts, scores) & the JPEG with the boxes drawn if asked, all from one
+    # decoding in the worker process. A page already in `cached_keys` (same pixels) is not recognized again:
+    # => fingerprint, None, None
+    image = decode_image(data, rgb=False)
+    fingerprint = fingerprint_image(image)
+    if key_prefix + fingerprint in cached_keys: return fingerprint, None, None
+    boxes, texts, scores = ocr_lines(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return fingerprint, (boxes, texts, scores), draw_overlay(image, boxes) if render else None
+
+def detect_upload(data, cached_keys=(), key_prefix=''):
+    # Uploaded file => fingerprint, boxes & crops of its lines (recognized by micro-batches), or fingerprint, None,
+    # None if the page is already in `cached_keys`
+    image = decode_image(data, rgb=False)
+    fingerprint = fingerprint_image(image)
+    if key_prefix + fingerprint in cached_keys: return fingerprint, None, None
+    return (fingerprint, *detect_lines(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+
+def render_upload(data, boxes):
+    return draw_overlay(decode_image(data, rgb=False), boxes)
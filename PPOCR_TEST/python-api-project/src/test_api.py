@@ -0,0 +1,155 @@
+import io
+import os
+import sys
+import json
+import signal
+import socket
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import cv2
+import numpy as np
+import pytest
+import api
+from test import recognize_lines
+
+
+def encode_page(extension='.png', seed=0):
+    page = np.random.default_rng(seed).integers(0, 256, (300, 200, 3), dtype=np.uint8)
+    return cv2.imencode(extension, page)[1].tobytes()
+
+
+def post_ocr(client, data, query='', filename='page.png'):
+    return client.post('/ocr' + query, data={'image': (io.BytesIO(data), filename)})
+
+
+@pytest.fixture(scope='module')
+def client():
+    # One stand-in worker & no queue: a second request at once is rejected
+    api.start_pool(stand_in=True, workers=1, max_queue=0, timeout=10)
+    yield api.app.test_client()
+    api.pool.shutdown()
+    api.cache_keys.close()
+    api.cache.close()
+
+
+def test_cache_hit_and_miss(client):
+    data = encode_page(seed=1)
+    first, second = post_ocr(client, data), post_ocr(client, data)
+    assert (first.headers['X-OCR-Cache'], second.headers['X-OCR-Cache']) == ('miss', 'hit')
+    assert first.json == second.json and len(first.json['lines']) == 4 # A line every 80 pixels
+
+    # The same pixels in another file => found by the OCR task before the detection
+    reencoded = post_ocr(client, encode_page('.bmp', seed=1), '?format=text', 'page.bmp')
+    assert reencoded.headers['X-OCR-Cache'] == 'hit'
+    assert reencoded.data.decode('utf-8').startswith('page.bmp\t')
+    assert api.cache.stats()['memory_entries'] == 3 # 1 result & the keys of the 2 files
+
+
+def test_results_of_other_models_not_reused(client, monkeypatch):
+    data = encode_page(seed=9)
+    assert post_ocr(client, data).headers['X-OCR-Cache'] == 'miss'
+    monkeypatch.setattr(api, 'model_tag', 'upgraded') # e.g. restarted with new models & the same --cache_db
+    assert post_ocr(client, data).headers['X-OCR-Cache'] == 'miss'
+    assert post_ocr(client, encode_page('.bmp', seed=9), filename='page.bmp').headers['X-OCR-Cache'] == 'hit'
+
+
+def test_overlay_rendered_by_the_ocr_task(client):
+    response = post_ocr(client, encode_page(seed=2), '?include=image_url')
+    assert response.status_code == 200 and response.headers['X-OCR-Cache'] == 'miss'
+    image = client.get(response.json['image_url'])
+    assert image.status_code == 200 and image.data[:2] == b'\xff\xd8'
+    assert client.get('/ocr/unknown.jpg').status_code == 404
+
+
+def test_single_flight(client):
+    # The same file sent at once by 5 requests => recognized once, the others wait without taking a pool slot
+    data, responses = encode_page(seed=3), []
+    def send(): responses.append(post_ocr(api.app.test_client(), data))
+    threads = [threading.Thread(target=send) for _ in range(5)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert sorted(response.status_code for response in responses) == [200] * 5
+    assert sorted(response.headers['X-OCR-Cache'] for response in responses) == ['hit'] * 4 + ['miss']
+    assert not api.in_flight
+
+
+def test_busy_pool(client):
+    with api.pool.request() as pool_request:
+        pool_request.run(recognize_lines, []) # Holds the only slot
+        response = post_ocr(client, encode_page(seed=4))
+        assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    assert post_ocr(client, encode_page(seed=4)).status_code == 200
+    assert not api.in_flight
+
+
+def test_timeout(client, monkeypatch):
+    monkeypatch.setattr(api.pool, 'timeout', 0.01) # Shorter than the stand-in detection
+    response = post_ocr(client, encode_page(seed=5))
+    assert response.status_code == 504 and 'No result after 0.01 seconds' in response.json['error']
+    assert api.pool.wait(5)
+
+
+def download(client, files):
+    return client.post('/download-txt', data={'image': [(io.BytesIO(data), name) for name, data in files]})
+
+
+def test_download_several_images(client):
+    response = download(client, [('a.png', encode_page(seed=6)), ('b.bmp', encode_page('.bmp', seed=7))])
+    assert response.status_code == 200 and response.headers['Content-Disposition'] == 'attachment; filename=Label.txt'
+    lines = response.data.decode('utf-8').splitlines()
+    assert [line.split('\t')[0] for line in lines] == ['a.png', 'b.bmp']
+    assert [len(json.loads(line.split('\t')[1])) for line in lines] == [4, 4]
+
+
+def test_download_with_a_bad_image(client):
+    # After the first line, the error of an image is written in place of its labels, not dropped
+    response = download(client, [('a.png', encode_page(seed=6)), ('bad.png', b'not an image'), ('c.png', encode_page(seed=8))])
+    assert response.status_code == 200
+    lines = [line.split('\t') for line in response.data.decode('utf-8').splitlines()]
+    assert [name for name, _ in lines] == ['a.png', 'bad.png', 'c.png']
+    assert 'error' in json.loads(lines[1][1]) and len(json.loads(lines[2][1])) == 4
+
+    # The first image still gets its status code
+    response = download(client, [('bad.png', b'not an image'), ('a.png', encode_page(seed=6))])
+    assert response.status_code == 500 and 'error' in response.json
+    assert not api.in_flight
+
+
+def http_post_ocr(port, data):
+    # => status, JSON body of POST /ocr on a running server
+    body = b'--b\r\nContent-Disposition: form-data; name="image"; filename="page.png"\r\n\r\n' + data + b'\r\n--b--\r\n'
+    post = urllib.request.Request(
+        f'http://127.0.0.1:{port}/ocr', body, {'Content-Type': 'multipart/form-data; boundary=b'}
+    )
+    try:
+        with urllib.request.urlopen(post, timeout=30) as response: return response.status, json.load(response)
+    except urllib.error.HTTPError as error: return error.code, json.load(error)
+
+
+def test_graceful_shutdown():
+    # SIGTERM during a request => that request is answered, the next ones get 503, then the server stops
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, 'api.py', '--stand_in', '--workers', '1', '--host', '127.0.0.1', '--port', str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        assert server.stdout.readline().startswith('Serving on')
+        long_page = cv2.imencode('.png', np.zeros((30000, 100, 3), dtype=np.uint8))[1].tobytes() # 375 lines, ~1 s
+        responses = []
+        request = threading.Thread(target=lambda: responses.append(http_post_ocr(port, long_page)))
+        request.start()
+        threading.Event().wait(0.3)
+        server.send_signal(signal.SIGTERM)
+        threading.Event().wait(0.1)
+
+        assert http_post_ocr(port, encode_page())[0] == 503
+        request.join()
+        assert responses[0][0] == 200 and len(responses[0][1]['lines']) == 375
+        assert server.wait(10) == 0
+    finally:
+        server.kill()
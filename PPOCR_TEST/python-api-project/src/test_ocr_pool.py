@@ -0,0 +1,67 @@
+import concurrent.futures
+import time
+import pytest
+from ocr_pool import OCRWorkerPool, PoolBusyError, PoolClosedError, PoolTimeoutError
+from micro_batcher import MicroBatcher
+
+
+def load_nothing(): pass
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = OCRWorkerPool(load_nothing, workers=1, max_queue=1, timeout=5)
+    yield pool
+    pool.shutdown()
+
+
+def test_busy_pool_rejects_the_next_requests(pool):
+    futures = [pool.submit(sleep, 0.3), pool.submit(sleep, 0.3)] # Running & queued
+    with pytest.raises(PoolBusyError):
+        pool.submit(sleep, 0)
+    assert [future.result() for future in futures] == [0.3, 0.3]
+    assert pool.wait(1) and pool.run(sleep, 0) == 0
+
+
+def test_timeout_is_a_builtin_timeout_error(pool):
+    with pytest.raises(PoolTimeoutError) as error:
+        pool.run(sleep, 0.5, timeout=0.1)
+    assert isinstance(error.value, TimeoutError)
+    assert pool.wait(2) # The slot is released once the task is done
+
+
+def test_requests_made_of_several_tasks(pool):
+    with pool.request() as pool_request:
+        assert pool.stats()['pending'] == 0 # Admitted by its first task
+        assert pool_request.run(sleep, 0) == 0 and pool.stats()['pending'] == 1
+        assert pool_request.run(sleep, 0) == 0 and pool.stats()['pending'] == 1
+    assert pool.stats()['pending'] == 0
+
+
+def test_one_time_budget_per_request(pool):
+    with pool.request(timeout=0.5) as pool_request:
+        pool_request.run(sleep, 0.3)
+        with pytest.raises(PoolTimeoutError, match='0.5 seconds'):
+            pool_request.run(sleep, 0.3) # Within the timeout alone, not within what is left of the request's
+    assert pool.wait(2)
+
+
+def test_micro_batcher_timeout():
+    batcher = MicroBatcher(lambda items: time.sleep(0.5) or items, max_wait=0)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        batcher.map([1, 2], timeout=0.1)
+    assert batcher.map([3, 4], timeout=5) == [3, 4]
+    batcher.close()
+
+
+def test_closed_pool():
+    pool = OCRWorkerPool(load_nothing, workers=1, timeout=5)
+    pool.close()
+    with pytest.raises(PoolClosedError):
+        pool.run(sleep, 0)
+    pool.shutdown()
@@ -0,0 +1,68 @@
+import pickle
+from result_cache import ResultCache, CacheKeysServer, model_version
+
+RESULT = {'boxes': [[[1, 2], [3, 2], [3, 4], [1, 4]]], 'texts': ['門公'], 'scores': [0.9], 'order': [0]}
+
+
+def test_hits_and_misses():
+    cache = ResultCache()
+    assert cache.get('ocr:a') is None
+    cache.put('ocr:a', RESULT)
+    cache.put('ocr:a:overlay', b'\xff\xd8jpeg')
+    assert cache.get('ocr:a') == RESULT and cache.get('ocr:a:overlay') == b'\xff\xd8jpeg'
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['misses'], stats['memory_entries']) == (2, 1, 2)
+
+
+def test_lru_eviction_by_size():
+    cache = ResultCache(max_bytes=250)
+    for key in 'abc': cache.put(key, b'x' * 99) # 100 bytes serialized
+    assert cache.get('a') is None and cache.stats()['evictions'] == 1
+    cache.get('b') # => c is the least recently used
+    cache.put('d', b'x' * 99)
+    assert [key for key in 'bcd' if cache.get(key) is not None] == ['b', 'd']
+    cache.put('huge', b'x' * 1000) # Larger than the whole tier: not kept
+    assert cache.get('huge') is None and cache.stats()['memory_bytes'] <= 250
+
+
+def test_disk_tier_survives_restarts(tmp_path):
+    disk_path = str(tmp_path / 'cache.sqlite')
+    cache = ResultCache(disk_path=disk_path)
+    cache.put('ocr:a', RESULT)
+    cache.close()
+
+    cache = ResultCache(disk_path=disk_path)
+    assert cache.get('ocr:a') == RESULT and cache.get('ocr:a') == RESULT
+    stats = cache.stats()
+    assert (stats['disk_hits'], stats['memory_hits']) == (1, 1) # Promoted to memory by the first hit
+    cache.close()
+
+
+def test_disk_tier_eviction(tmp_path):
+    cache = ResultCache(disk_path=str(tmp_path / 'cache.sqlite'), disk_max_bytes=250)
+    for key in 'abc': cache.put(key, b'x' * 99)
+    assert cache.stats()['disk_bytes'] <= 250
+    cache.entries.clear() # Memory tier lost, like after a restart
+    assert cache.get('a') is None # Least recently accessed first
+    cache.close()
+
+
+def test_remote_cache_keys(tmp_path):
+    cache = ResultCache(max_bytes=250, disk_path=str(tmp_path / 'cache.sqlite'))
+    server = CacheKeysServer(cache)
+    keys = pickle.loads(pickle.dumps(server.keys)) # As sent to a worker process
+    cache.put('ocr:a', b'x' * 200)
+    cache.put('ocr:b', b'x' * 200) # ocr:a only on disk now
+    assert 'ocr:a' in keys and 'ocr:b' in keys and 'ocr:c' not in keys
+    assert cache.stats()['misses'] == 0 and cache.stats()['disk_hits'] == 0 # Not counted as lookups
+    server.close()
+    cache.close()
+
+
+def test_model_version(tmp_path):
+    (tmp_path / 'det').mkdir()
+    (tmp_path / 'det' / 'inference.pdmodel').write_bytes(b'model')
+    version = model_version(str(tmp_path / 'det'))
+    assert model_version(str(tmp_path / 'det')) == version
+    (tmp_path / 'det' / 'inference.pdmodel').write_bytes(b'other model')
+    assert model_version(str(tmp_path / 'det')) != version
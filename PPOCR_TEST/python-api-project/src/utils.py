@@ -11,4 +11,4 @@ def save_uploaded_file(uploaded_file, save_path):
 def validate_image_file(file):
     # Function to validate the uploaded file type
     allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
-    return '.' in file.name and file.name.rsplit('.', 1)[1].lower() in allowed_extensions
\ No newline at end of file
+    return '.' in file.name and file.name.rsplit('.', 1)[1].lower() in allowed_extensions